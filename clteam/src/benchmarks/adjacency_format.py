@@ -0,0 +1,71 @@
+"""
+Disk size, load time and peak RSS of the dense mc_adj_matrix.pkl against the mc_adj_edges.bin edge lists.
+
+Every format is loaded in a fresh process that reads all graphs, the way ChatDatasetWithGraph does.
+Run from clteam/src (after convert_adjacency.py):
+    python -m benchmarks.adjacency_format --split_dir ./../preprocessed/with_dialogue_history_exploded/train/en-de
+"""
+
+import argparse
+import pickle
+import resource
+import time
+from multiprocessing import get_context
+from pathlib import Path
+
+import torch
+
+from utils.sparse_adjacency import ADJ_EDGES_FILE, SparseAdjacency
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_pickle(path):
+    with open(path, 'rb') as f:
+        matrices = pickle.load(f)
+    # what ChatDatasetWithGraph.__getitem__ did for every item
+    return sum(int(torch.tensor(matrix).count_nonzero()) for matrix in matrices)
+
+
+def load_edges(path):
+    adjacency = SparseAdjacency(path)
+    return sum(int(adjacency.dense(i).count_nonzero()) for i in range(len(adjacency)))
+
+
+def measure(loader, path):
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    num_edges = loader(path)
+
+    return time.perf_counter() - start, peak_rss_mb() - rss_before, num_edges
+
+
+def run(args):
+    split_dir = Path(args.split_dir)
+    formats = {"pickle": (load_pickle, split_dir / args.adj_matrix_file),
+               "edges": (load_edges, split_dir / ADJ_EDGES_FILE)}
+
+    print(f"{'format':<8}{'disk MB':>10}{'load s':>9}{'peak RSS MB':>13}{'edges':>10}")
+    context = get_context("spawn")
+    for name, (loader, path) in formats.items():
+        if not path.exists():
+            print(f"{name:<8} missing {path}")
+            continue
+        with context.Pool(1) as pool:
+            seconds, rss, num_edges = pool.apply(measure, (loader, path))
+        print(f"{name:<8}{path.stat().st_size / 2 ** 20:>10.2f}{seconds:>9.2f}{rss:>13.1f}{num_edges:>10}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--split_dir', type=str, required=True)
+    parser.add_argument('--adj_matrix_file', type=str, default='mc_adj_matrix.pkl')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
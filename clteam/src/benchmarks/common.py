@@ -0,0 +1,150 @@
+import io
+import time
+import weakref
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+from torch.utils.data import Subset
+from transformers import T5Config
+
+from utils.dataset import ChatDatasetWithGraph
+from utils.model import T5GenerationWithGraph
+
+S_TOKEN_ID = 5
+
+
+def tiny_model(d_model=64, num_layers=2, num_heads=4, d_ff=None, **kwargs):
+    """
+    Randomly initialised T5GenerationWithGraph over 100 token ids, with S_TOKEN_ID as <s>. kwargs go to the model
+    (memory_efficient_gat, mask_padded_nodes, ...).
+    """
+    config = T5Config(vocab_size=100, d_model=d_model, d_kv=d_model // num_heads, d_ff=d_ff or 2 * d_model,
+                      num_layers=num_layers, num_heads=num_heads, decoder_start_token_id=0)
+
+    return T5GenerationWithGraph(config, s_token_id=S_TOKEN_ID, **kwargs)
+
+
+def load_dataset(args, tokenizer, split, limit=None, cache_dir=None):
+    """
+    ChatDatasetWithGraph of a split with dynamic padding, without its progress output. Data paths, language and
+    lengths come from the benchmark's args, the cache directory from args.cache_dir unless cache_dir is given. With a
+    limit, only the first items (a Subset).
+    """
+    data_args = SimpleNamespace(raw_data_root=args.raw_data_root, triple_data_root=args.triple_data_root,
+                                data_root=args.data_root, language=args.language, input_len=args.input_len,
+                                output_len=args.output_len, exclude_context=False, full_history=False,
+                                dynamic_padding=True, cache_dir=args.cache_dir if cache_dir is None else cache_dir,
+                                tokenize_num_proc=1)
+    with redirect_stdout(io.StringIO()):
+        dataset = ChatDatasetWithGraph(split, tokenizer, data_args)
+    if limit is not None:
+        dataset = Subset(dataset, range(min(limit, len(dataset))))
+
+    return dataset
+
+
+def sync(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_fn(fn, device="cpu", warmup=2, repeat=5):
+    """Return the mean wall-clock seconds of `fn()` over `repeat` runs."""
+    for _ in range(warmup):
+        fn()
+    sync(device)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    sync(device)
+
+    return (time.perf_counter() - start) / repeat
+
+
+def saved_activation_bytes(fn):
+    """Bytes of tensors saved for backward while running `fn()`, a device independent proxy for activation memory."""
+    total = [0]
+    seen = set()
+
+    def pack(tensor):
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+        if key not in seen:
+            seen.add(key)
+            total[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+
+    return total[0]
+
+
+def peak_memory_bytes(fn, device="cpu"):
+    """Peak allocated device memory while running `fn()`, or None on CPU."""
+    if torch.device(device).type != "cuda":
+        return None
+
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    fn()
+    sync(device)
+
+    return torch.cuda.max_memory_allocated(device)
+
+
+class _LiveTensorBytes(TorchDispatchMode):
+    # every new storage an operator returns is counted until it is freed, not those it shares with its inputs (views,
+    # in place results), which also keeps views of the weights and of earlier tensors out
+    def __init__(self):
+        super().__init__()
+        self.storages = set()
+        self.live = 0
+        self.peak = 0
+
+    def _free(self, key, num_bytes):
+        self.storages.discard(key)
+        self.live -= num_bytes
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        output = func(*args, **(kwargs or {}))
+        inputs = {(tensor.device, tensor.untyped_storage().data_ptr()) for tensor in tree_flatten((args, kwargs))[0]
+                  if isinstance(tensor, torch.Tensor)}
+        for tensor in tree_flatten(output)[0]:
+            if isinstance(tensor, torch.Tensor):
+                storage = tensor.untyped_storage()
+                key = (tensor.device, storage.data_ptr())
+                if storage.nbytes() > 0 and key not in self.storages and key not in inputs:
+                    self.storages.add(key)
+                    self.live += storage.nbytes()
+                    weakref.finalize(storage, self._free, key, storage.nbytes())
+        self.peak = max(self.peak, self.live)
+
+        return output
+
+
+def peak_tensor_bytes(fn):
+    """
+    Peak bytes of the tensors allocated while running `fn()` (above those that already existed), on any device. Unlike
+    the resident set size on CPU it only counts tensor storage, and only what is still alive, so it compares across runs
+    in one process. Operators are intercepted one by one, do not time `fn()` at the same time.
+    """
+    tracker = _LiveTensorBytes()
+    with tracker:
+        fn()
+
+    return tracker.peak
+
+
+def format_bytes(num_bytes):
+    if num_bytes is None:
+        return "n/a"
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f}{unit}"
+        num_bytes /= 1024
+
+    return f"{num_bytes:.1f}TB"
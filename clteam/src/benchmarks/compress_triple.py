@@ -0,0 +1,159 @@
+"""
+Property check and timing of the hash indexed compress_triple against the original quadratic version.
+
+The check runs both functions on the real graph files, with the coreference clusters stored by earlier
+preprocessing runs (per dialogue in with_dialogue_history, per utterance in with_dialogue_history_exploded; the
+first mention stands in for the main one, which is not stored), and on random triples over a small vocabulary so
+merges, edits of merged triples and chained clusters are frequent. Timing chains the turns of the longest dialogues.
+Run from clteam/src:
+    python -m benchmarks.compress_triple
+"""
+
+import argparse
+import itertools
+import json
+import random
+import time
+from pathlib import Path
+
+from dialogue_to_graph import compress_triple
+from utils.coreference import Cluster, Mention
+
+
+def legacy_compress_triple(dialogue, coref):
+    triples = [utt["triples"] for utt in dialogue["dialogue"]]
+    triples = list(itertools.chain.from_iterable(triples))
+
+    temp_set = []
+    for cur in triples:
+        cur_subject = cur['subject'].lower() if cur['subject'] else ""
+        cur_relation = cur['predicate'].lower() if cur['predicate'] else ""
+        cur_object = cur['object'].lower() if cur['object'] else ""
+
+        for cluster in coref:
+            span = [w.text.lower() for w in cluster.mentions]
+            if cur_subject in span:
+                cur_subject = cluster.main.text.lower()
+            if cur_object in span:
+                cur_object = cluster.main.text.lower()
+
+        if len(temp_set) == 0:
+            temp_set.append([cur_subject, cur_relation, cur_object])
+        else:
+            flag = 0
+            for j in range(0, len(temp_set)):
+                if temp_set[j][0] == cur_subject and temp_set[j][1] == cur_relation:
+                    if len(cur_object) > len(temp_set[j][2]):
+                        temp_set[j][2] = cur_object
+                    flag = 1
+                elif temp_set[j][0] == cur_subject and temp_set[j][2] == cur_object:
+                    if len(cur_relation) > len(temp_set[j][1]):
+                        temp_set[j][1] = cur_relation
+                    flag = 1
+                elif temp_set[j][2] == cur_object and temp_set[j][1] == cur_relation:
+                    if len(cur_subject) > len(temp_set[j][0]):
+                        temp_set[j][0] = cur_subject
+                    flag = 1
+
+            if flag == 0:
+                temp_set.append([cur_subject, cur_relation, cur_object])
+
+    return temp_set
+
+
+def to_clusters(stored):
+    """Clusters from mc_coref_clusters.json, which only keeps the text of the mentions."""
+    clusters = []
+    for mentions in stored:
+        mentions = [Mention(text.strip(), text, -1, -1) for text in mentions]
+        clusters.append(Cluster(mentions[0], mentions))
+
+    return clusters
+
+
+def real_cases(args):
+    preprocessed = Path(args.preprocessed_root)
+    for split, language in itertools.product(["valid", "test"], ["en-de", "en-fr", "en-nl", "en-pt"]):
+        with open(Path(args.data_root) / split / f"{language}.json", 'r', encoding='utf-8') as f:
+            dialogues = json.load(f)
+
+        path = preprocessed / "with_dialogue_history" / split / language / "mc_coref_clusters.json"
+        if path.exists():
+            with open(path, 'r') as f:
+                for dialogue, stored in zip(dialogues, json.load(f)):
+                    yield dialogue, to_clusters(stored)
+
+        path = preprocessed / "with_dialogue_history_exploded" / split / language / "mc_coref_clusters.json"
+        if path.exists():
+            with open(path, 'r') as f:
+                utterances = [utt for dialogue in dialogues for utt in dialogue["dialogue"]]
+                for utterance, stored in zip(utterances, json.load(f)):
+                    yield {"dialogue": [utterance]}, to_clusters(stored)
+
+
+def random_case(rng):
+    words = ["a", "bb", "ccc", "dd", "e", "fff", "", None]
+    triples = [{"subject": rng.choice(words), "predicate": rng.choice(words), "object": rng.choice(words)}
+               for _ in range(rng.randint(0, 60))]
+    clusters = []
+    for _ in range(rng.randint(0, 4)):
+        mentions = [Mention(word.upper(), word, -1, -1) for word in rng.sample(words[:6], rng.randint(2, 4))]
+        clusters.append(Cluster(rng.choice(mentions), mentions))
+
+    return {"dialogue": [{"triples": triples}]}, clusters
+
+
+def long_dialogue_case(dialogues, num_turns):
+    """The first num_turns turns of the dialogues chained together, longest dialogues first."""
+    dialogues = sorted(dialogues, key=lambda dialogue: len(dialogue["dialogue"]), reverse=True)
+    turns = list(itertools.islice((turn for dialogue in dialogues for turn in dialogue["dialogue"]), num_turns))
+
+    return {"dialogue": turns}
+
+
+def time_fn(fn, dialogue, coref, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(dialogue, coref)
+
+    return (time.perf_counter() - start) / repeat
+
+
+def run(args):
+    checked = 0
+    for dialogue, coref in real_cases(args):
+        assert compress_triple(dialogue, coref) == legacy_compress_triple(dialogue, coref), dialogue.get("Conversation ID")
+        checked += 1
+    rng = random.Random(0)
+    for _ in range(args.random_cases):
+        dialogue, coref = random_case(rng)
+        assert compress_triple(dialogue, coref) == legacy_compress_triple(dialogue, coref)
+    print(f"Same output on {checked} real and {args.random_cases} random cases")
+
+    with open(Path(args.data_root) / "valid" / "en-de.json", 'r', encoding='utf-8') as f:
+        dialogues = json.load(f)
+    # the clusters of a whole dialogue with the most mentions
+    coref = max((coref for _, coref in real_cases(args)),
+                key=lambda coref: sum(len(cluster.mentions) for cluster in coref))
+    print(f"{'turns':>6}{'triples':>9}{'legacy ms':>11}{'indexed ms':>12}{'speedup':>9}")
+    for num_turns in args.turns:
+        dialogue = long_dialogue_case(dialogues, num_turns)
+        num_triples = sum(len(turn["triples"]) for turn in dialogue["dialogue"])
+        legacy = time_fn(legacy_compress_triple, dialogue, coref, args.repeat)
+        indexed = time_fn(compress_triple, dialogue, coref, args.repeat)
+        print(f"{num_turns:>6}{num_triples:>9}{legacy * 1e3:>11.2f}{indexed * 1e3:>12.2f}{legacy / indexed:>9.1f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', type=str, default='./../graphs')
+    parser.add_argument('--preprocessed_root', type=str, default='./../preprocessed')
+    parser.add_argument('--random_cases', type=int, default=20000)
+    parser.add_argument('--turns', nargs="+", type=int, default=[48, 200, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,67 @@
+"""
+Wall clock time of the coreference modes of dialogue_to_graph, and how many utterance graphs they change.
+
+Every mode builds the mind charts of the same dialogues; graphs (node text and edges) are compared with the exact
+"prefix" mode. Needs spaCy with neuralcoref, run from clteam/src:
+    python -m benchmarks.coreference_modes --split valid --language en-de --num_dialogues 100
+"""
+
+import argparse
+import json
+import time
+from argparse import Namespace
+from pathlib import Path
+
+import numpy as np
+
+from dialogue_to_graph import dialogue_mind_charts
+
+
+def run_mode(dialogues, coref_mode, coref_window):
+    args = Namespace(exclude_context=False, coref_mode=coref_mode, coref_window=coref_window)
+    start = time.perf_counter()
+    charts = [dialogue_mind_charts(dialogue, args) for dialogue in dialogues]
+
+    return time.perf_counter() - start, charts
+
+
+def same_graphs(reference, charts):
+    same, total = 0, 0
+    for (ref_text, ref_edges, _), (text, edges, _) in zip(reference, charts):
+        for a_text, a_edges, b_text, b_edges in zip(ref_text, ref_edges, text, edges):
+            same += int(a_text == b_text and np.array_equal(a_edges, b_edges))
+            total += 1
+
+    return same, total
+
+
+def run(args):
+    with open(Path(args.data_root) / args.split / f"{args.language}.json", 'r', encoding='utf-8') as f:
+        dialogues = json.load(f)[:args.num_dialogues]
+    num_utterances = sum(len(dialogue["dialogue"]) for dialogue in dialogues)
+    print(f"{len(dialogues)} dialogues, {num_utterances} utterances, "
+          f"longest {max(len(dialogue['dialogue']) for dialogue in dialogues)} turns")
+
+    reference_seconds, reference = run_mode(dialogues, "prefix", args.coref_window)
+    print(f"{'mode':<18}{'seconds':>9}{'speedup':>9}{'same graphs':>14}")
+    print(f"{'prefix':<18}{reference_seconds:>9.1f}{1:>9.2f}{'100.0%':>14}")
+    for mode in ["window", "dialogue"]:
+        seconds, charts = run_mode(dialogues, mode, args.coref_window)
+        same, total = same_graphs(reference, charts)
+        name = f"window ({args.coref_window})" if mode == "window" else mode
+        print(f"{name:<18}{seconds:>9.1f}{reference_seconds / seconds:>9.2f}{100 * same / total:>13.1f}%")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', type=str, default='./../graphs')
+    parser.add_argument('--split', type=str, default='valid')
+    parser.add_argument('--language', type=str, default='en-de')
+    parser.add_argument('--num_dialogues', type=int, default=100)
+    parser.add_argument('--coref_window', type=int, default=5)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,77 @@
+"""
+Constructor time, peak resident memory and pickled size (what every DataLoader worker receives) of
+ChatDatasetWithGraph built in memory and served from its consolidated cache file.
+
+Every setting runs in a fresh process: "in memory" builds the dataset without --cache_dir, "first build" writes the
+cache and "from cache" is a later launch that only opens it. Run from clteam/src with preprocessed data:
+    python -m benchmarks.dataset_memory --splits valid test --language en-de --model declare-lab/flan-alpaca-base
+"""
+
+import argparse
+import json
+import pickle
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from transformers import AutoTokenizer
+
+from benchmarks.common import load_dataset
+
+
+def measure(args):
+    """Build one dataset in this process and print its measurements as JSON."""
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    tokenizer.add_special_tokens({'additional_special_tokens': ['<s>']})
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    dataset = load_dataset(args, tokenizer, args.measure_split, cache_dir=args.measure_cache_dir)
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    dataset[len(dataset) - 1]
+
+    print(json.dumps({"items": len(dataset), "seconds": seconds, "peak_mb": (peak - before) / 1024,
+                      "pickled_mb": len(pickle.dumps(dataset)) / 2 ** 20}))
+
+
+def run(args):
+    command = [sys.executable, "-m", "benchmarks.dataset_memory", "--raw_data_root", args.raw_data_root,
+               "--triple_data_root", args.triple_data_root, "--data_root", args.data_root,
+               "--language", args.language, "--model", args.model, "--input_len", str(args.input_len),
+               "--output_len", str(args.output_len)]
+    print(f"{'split':<8}{'setting':<14}{'items':>7}{'constructor':>13}{'peak RSS':>11}{'pickled':>11}")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for split in args.splits:
+            for setting, cache in [("in memory", ""), ("first build", cache_dir), ("from cache", cache_dir)]:
+                output = subprocess.run(command + ["--measure_split", split, "--measure_cache_dir", cache],
+                                        capture_output=True, text=True, check=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(f"{split:<8}{setting:<14}{result['items']:>7}{result['seconds']:>12.2f}s"
+                      f"{result['peak_mb']:>8.1f} MB{result['pickled_mb']:>8.2f} MB")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--raw_data_root', type=str, default='./../..')
+    parser.add_argument('--triple_data_root', type=str, default='./../graphs')
+    parser.add_argument('--data_root', type=str, default='./../preprocessed/with_dialogue_history_exploded')
+    parser.add_argument('--splits', nargs="+", type=str, default=["valid", "test"])
+    parser.add_argument('--language', type=str, default='en-de')
+    parser.add_argument('--model', type=str, default='declare-lab/flan-alpaca-base')
+    parser.add_argument('--input_len', type=int, default=512)
+    parser.add_argument('--output_len', type=int, default=256)
+    # used by the processes that run a single measurement
+    parser.add_argument('--measure_split', type=str, default=None)
+    parser.add_argument('--measure_cache_dir', type=str, default="")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.measure_split is not None:
+        measure(args)
+    else:
+        run(args)
@@ -0,0 +1,111 @@
+"""
+Training throughput with fixed max-length padding, with GraphDataCollator and with GraphDataCollator plus
+length-grouped batches, on synthetic items with chat-like lengths.
+
+Run from clteam/src:
+    python -m benchmarks.dynamic_padding --num_items 256 --bs 8
+"""
+
+import argparse
+import time
+from types import SimpleNamespace
+
+import torch
+from torch.utils.data import DataLoader
+from transformers.trainer_pt_utils import LengthGroupedSampler
+
+from benchmarks.common import S_TOKEN_ID, tiny_model
+from utils.dataset import GraphDataCollator
+
+PAD_TOKEN_ID = 0
+
+
+def make_items(num_items, args):
+    generator = torch.Generator().manual_seed(0)
+    items = []
+    for _ in range(num_items):
+        # most utterances are short, a few carry a long dialogue history
+        source_len = int(min(args.input_len, 20 + torch.empty(1).exponential_(1 / 80, generator=generator)))
+        target_len = int(min(args.output_len, 5 + torch.empty(1).exponential_(1 / 20, generator=generator)))
+        num_nodes = int(torch.randint(1, 12, (1,), generator=generator))
+        node_ids = []
+        for _ in range(num_nodes):
+            node_ids += [S_TOKEN_ID] + torch.randint(6, 100, (3,), generator=generator).tolist()
+        node_ids = node_ids[:args.input_len]
+        adj = torch.zeros(args.max_nodes, args.max_nodes)
+        adj[:num_nodes, :num_nodes] = (torch.rand(num_nodes, num_nodes, generator=generator) > 0.5).float()
+
+        items.append({"input_ids": torch.randint(6, 100, (source_len,), generator=generator),
+                      "attention_mask": torch.ones(source_len, dtype=torch.long),
+                      "labels": torch.randint(6, 100, (target_len,), generator=generator).tolist(),
+                      "got_adj_matrix": adj,
+                      "got_input_ids": torch.tensor(node_ids),
+                      "got_mask": torch.ones(len(node_ids), dtype=torch.long)})
+
+    return items
+
+
+def pad_to(tensor, length, value):
+    return torch.nn.functional.pad(torch.as_tensor(tensor), (0, length - len(tensor)), value=value)
+
+
+def fixed_collate(args):
+    # what ChatDatasetWithGraph + DataCollatorForSeq2Seq produce today
+    def collate(features):
+        return {"input_ids": torch.stack([pad_to(f["input_ids"], args.input_len, PAD_TOKEN_ID) for f in features]),
+                "attention_mask": torch.stack([pad_to(f["attention_mask"], args.input_len, 0) for f in features]),
+                "labels": torch.stack([pad_to(f["labels"], args.output_len, PAD_TOKEN_ID) for f in features]),
+                "got_adj_matrix": torch.stack([f["got_adj_matrix"] for f in features]),
+                "got_input_ids": torch.stack([pad_to(f["got_input_ids"], args.input_len, PAD_TOKEN_ID)
+                                              for f in features]),
+                "got_mask": torch.stack([pad_to(f["got_mask"], args.input_len, 0) for f in features])}
+
+    return collate
+
+
+def real_tokens(batch):
+    labels = batch["labels"]
+    return int(batch["attention_mask"].sum() + batch["got_mask"].sum()
+               + (labels.ne(-100) & labels.ne(PAD_TOKEN_ID)).sum())
+
+
+def run(args):
+    torch.manual_seed(0)
+    model = tiny_model(args.d_model, memory_efficient_gat=True).train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+
+    items = make_items(args.num_items, args)
+    collator = GraphDataCollator(SimpleNamespace(pad_token_id=PAD_TOKEN_ID), S_TOKEN_ID)
+    lengths = [len(item["input_ids"]) + len(item["got_input_ids"]) for item in items]
+    loaders = {"fixed": DataLoader(items, batch_size=args.bs, shuffle=True, collate_fn=fixed_collate(args)),
+               "dynamic": DataLoader(items, batch_size=args.bs, shuffle=True, collate_fn=collator),
+               "dynamic+grouped": DataLoader(items, batch_size=args.bs, collate_fn=collator,
+                                             sampler=LengthGroupedSampler(args.bs, lengths=lengths))}
+
+    print(f"{'mode':<17}{'s/epoch':>9}{'real tok/s':>12}{'padded tok/s':>14}")
+    for mode, loader in loaders.items():
+        tokens, padded, start = 0, 0, time.perf_counter()
+        for batch in loader:
+            optimizer.zero_grad()
+            model(**batch).loss.backward()
+            optimizer.step()
+            tokens += real_tokens(batch)
+            padded += batch["input_ids"].numel() + batch["got_input_ids"].numel() + batch["labels"].numel()
+        seconds = time.perf_counter() - start
+        print(f"{mode:<17}{seconds:>9.1f}{tokens / seconds:>12.0f}{padded / seconds:>14.0f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--d_model', type=int, default=64)
+    parser.add_argument('--input_len', type=int, default=512)
+    parser.add_argument('--output_len', type=int, default=256)
+    parser.add_argument('--max_nodes', type=int, default=100)
+    parser.add_argument('--num_items', type=int, default=128)
+    parser.add_argument('--bs', type=int, default=8)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
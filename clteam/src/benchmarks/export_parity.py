@@ -0,0 +1,111 @@
+"""
+Parity and CPU latency of the graphs written by utils.export.export_model against the eager model.
+
+The exported encoder and decoder steps are compared with the eager modules at several batch, text and node sizes
+(largest absolute difference), then greedy and beam search translations of ExportedTranslator are compared with those
+of T5GenerationWithGraph.translate (generate) and of ExportedTranslator on the eager modules, and timed.
+Run from clteam/src with a trained checkpoint and preprocessed data:
+    python -m benchmarks.export_parity --checkpoint <eval_dir> --formats onnx torchscript --num_items 64
+"""
+
+import argparse
+import tempfile
+import time
+
+import torch
+from transformers import AutoTokenizer
+
+from benchmarks.common import load_dataset
+from utils.export import ExportedTranslator, example_inputs, export_model
+from utils.model import T5GenerationWithGraph
+
+SHAPES = [(1, 5, 7, 3), (3, 40, 24, 6), (8, 128, 64, 12)]  # batch, text, node text, nodes
+
+
+def max_difference(a, b):
+    return max((x - y).abs().max().item() for x, y in zip(a, b))
+
+
+def check_graphs(model, exported, reference):
+    print(f"{'batch, text, node text, nodes':<32}{'encoder':>10}{'first step':>12}{'with past':>12}")
+    for shape in SHAPES:
+        batch = dict(zip(["input_ids", "attention_mask", "got_input_ids", "got_mask", "got_adj_matrix"],
+                         example_inputs(model, *shape)))
+        differences, outputs = [], []
+        for translator in [exported, reference]:
+            hidden_states = translator.encode(batch)
+            tokens = torch.full((shape[0], 2), model.config.decoder_start_token_id)
+            init = translator.decoder_init(tokens, hidden_states, batch["attention_mask"])
+            step = translator.decoder_with_past(tokens[:, -1:], hidden_states, batch["attention_mask"], *init[1:])
+            outputs.append(((hidden_states,), init, step))
+        for a, b in zip(*outputs):
+            differences.append(max_difference(a, b))
+        print(f"{str(shape):<32}" + "".join(f"{d:>12.2e}" for d in differences))
+
+
+def timed(translate):
+    start = time.perf_counter()
+    translations = translate()
+    return translations, time.perf_counter() - start
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    tokenizer = AutoTokenizer.from_pretrained(args.checkpoint)
+    dataset = load_dataset(args, tokenizer, args.split, limit=args.num_items)
+    items = [dataset[i] for i in range(len(dataset))]
+    model = T5GenerationWithGraph.from_pretrained(args.checkpoint, s_token_id=tokenizer.get_vocab()["<s>"]).eval()
+    eager = ExportedTranslator.from_model(model)
+    options = dict(batch_size=args.batch_size, max_length=args.output_len)
+
+    results = {"generate, greedy": timed(lambda: model.translate(tokenizer, items, **options)),
+               f"generate, {args.num_beams} beams": timed(lambda: model.translate(
+                   tokenizer, items, num_beams=args.num_beams, early_stopping=True, **options))}
+    with torch.no_grad():
+        results["eager, greedy"] = timed(lambda: eager.translate(tokenizer, items, **options))
+        results[f"eager, {args.num_beams} beams"] = timed(lambda: eager.translate(
+            tokenizer, items, num_beams=args.num_beams, **options))
+
+    with tempfile.TemporaryDirectory() as export_dir:
+        for fmt in args.formats:
+            export_model(model, f"{export_dir}/{fmt}", fmt=fmt)
+            exported = ExportedTranslator.load(f"{export_dir}/{fmt}", num_threads=args.threads)
+            print(f"\n{fmt}: largest absolute difference to eager")
+            check_graphs(model, exported, eager)
+            results[f"{fmt}, greedy"] = timed(lambda: exported.translate(tokenizer, items, **options))
+            results[f"{fmt}, {args.num_beams} beams"] = timed(lambda: exported.translate(
+                tokenizer, items, num_beams=args.num_beams, **options))
+
+    print(f"\n{len(items)} items of {args.split} {args.language}, batches of {args.batch_size}, "
+          f"{args.threads} thread(s)")
+    print(f"{'':<24}{'items/s':>9}{'ms/item':>9}{'speedup':>9}{'same as generate':>18}")
+    for name, (translations, seconds) in results.items():
+        baseline_name = "generate, greedy" if "greedy" in name else f"generate, {args.num_beams} beams"
+        baseline, baseline_seconds = results[baseline_name]
+        same = sum(a == b for a, b in zip(translations, baseline))
+        print(f"{name:<24}{len(items) / seconds:>9.2f}{1000 * seconds / len(items):>9.1f}"
+              f"{baseline_seconds / seconds:>9.2f}{same:>12}/{len(items)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--raw_data_root', type=str, default='./../..')
+    parser.add_argument('--triple_data_root', type=str, default='./../graphs')
+    parser.add_argument('--data_root', type=str, default='./../preprocessed/with_dialogue_history_exploded')
+    parser.add_argument('--cache_dir', type=str, default="")
+    parser.add_argument('--split', type=str, default='test')
+    parser.add_argument('--language', type=str, default='en-de')
+    parser.add_argument('--formats', nargs="+", choices=["onnx", "torchscript"], default=["onnx", "torchscript"])
+    parser.add_argument('--num_items', type=int, default=64)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_beams', type=int, default=4)
+    parser.add_argument('--input_len', type=int, default=512)
+    parser.add_argument('--output_len', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,90 @@
+"""
+Compare the pair-tensor and memory-efficient attention paths of the GAT used in JointEncoderWithGraph.
+
+Run from clteam/src:
+    python -m benchmarks.gat_attention --d_model 768 --nodes 10 50 100 --batch_sizes 1 4 8
+"""
+
+import argparse
+
+import torch
+
+from benchmarks.common import format_bytes, peak_memory_bytes, saved_activation_bytes, time_fn
+from utils.model import GAT
+
+
+def make_inputs(batch_size, num_nodes, d_model, device):
+    nodes = torch.randn(batch_size, num_nodes, d_model, device=device)
+    adj = (torch.rand(batch_size, num_nodes, num_nodes, device=device) > 0.8).float()
+    adj = adj + torch.eye(num_nodes, device=device)
+
+    return nodes, adj
+
+
+def set_memory_efficient(gat, memory_efficient):
+    for layer in list(gat.attentions) + [gat.out_att]:
+        layer.memory_efficient = memory_efficient
+
+
+def check_parity(d_model, device, rtol=1e-6, atol=1e-8):
+    # float64 so that the comparison is not dominated by float32 summation order
+    torch.manual_seed(0)
+    gat = GAT(nfeat=d_model, nhid=d_model, nheads=1).to(device).double().eval()
+    nodes, adj = make_inputs(2, 17, d_model, device)
+    nodes = nodes.double()
+
+    results = []
+    for memory_efficient in [False, True]:
+        set_memory_efficient(gat, memory_efficient)
+        gat.zero_grad()
+        x = nodes.clone().requires_grad_(True)
+        out = gat(x, adj)
+        out.square().sum().backward()
+        results.append((out.detach(), x.grad, [p.grad.clone() for p in gat.parameters()]))
+
+    (out_ref, x_grad_ref, p_grad_ref), (out_eff, x_grad_eff, p_grad_eff) = results
+    pairs = [(out_ref, out_eff), (x_grad_ref, x_grad_eff)] + list(zip(p_grad_ref, p_grad_eff))
+    for ref, eff in pairs:
+        assert torch.allclose(ref, eff, rtol=rtol, atol=atol), \
+            f"memory efficient GAT differs from the pair-tensor GAT by {(ref - eff).abs().max().item()}"
+    print(f"Parity OK (max abs output diff {(out_ref - out_eff).abs().max().item():.2e})")
+
+
+def run(args):
+    device = args.device
+    check_parity(args.d_model, device)
+
+    torch.manual_seed(0)
+    gat = GAT(nfeat=args.d_model, nhid=args.d_model, nheads=1).to(device).train()
+
+    print(f"{'mode':<10}{'B':>4}{'N':>6}{'saved act.':>14}{'peak mem':>12}{'ms/step':>10}{'graphs/s':>10}")
+    for batch_size in args.batch_sizes:
+        for num_nodes in args.nodes:
+            nodes, adj = make_inputs(batch_size, num_nodes, args.d_model, device)
+
+            def step():
+                gat(nodes, adj).sum().backward()
+
+            for memory_efficient in [False, True]:
+                set_memory_efficient(gat, memory_efficient)
+                saved = saved_activation_bytes(lambda: gat(nodes, adj))
+                peak = peak_memory_bytes(step, device)
+                seconds = time_fn(step, device, repeat=args.repeat)
+                mode = "efficient" if memory_efficient else "pair"
+                print(f"{mode:<10}{batch_size:>4}{num_nodes:>6}{format_bytes(saved):>14}{format_bytes(peak):>12}"
+                      f"{seconds * 1000:>10.2f}{batch_size / seconds:>10.1f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--d_model', type=int, default=768)
+    parser.add_argument('--nodes', type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument('--batch_sizes', type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,169 @@
+"""
+Peak memory and training step time of T5GenerationWithGraph with and without gradient checkpointing.
+
+With checkpointing the T5 blocks of both encoder passes (source text and node text) and of the decoder, the GAT and the
+graph fusion keep only their inputs and are recomputed in the backward pass. Every setting runs one forward and
+backward pass on a synthetic batch of the given shape in a fresh process, so that peak memory (CUDA max allocated,
+or the resident set size on CPU) is not shared between settings. The size of the activations saved for the backward
+pass is reported as well, it does not depend on the allocator. The gradients of both settings are compared on the
+smallest batch first. Run from clteam/src:
+    python -m benchmarks.gradient_checkpointing --model declare-lab/flan-alpaca-base --batch_sizes 4 8 16 32
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+from transformers import AutoTokenizer
+
+from utils.model import T5GenerationWithGraph
+
+
+def synthetic_batch(model, batch_size, args, device):
+    vocab_size = model.config.vocab_size
+    got_input_ids = torch.randint(2, vocab_size, (batch_size, args.node_len))
+    got_input_ids[:, 0:args.node_len:max(1, args.node_len // args.num_nodes)] = model.encoder.s_token_id
+    adjacency = (torch.rand(batch_size, args.num_nodes, args.num_nodes) < 0.2).float()
+    adjacency = torch.maximum(adjacency, torch.eye(args.num_nodes))
+    input_ids = torch.randint(2, vocab_size, (batch_size, args.input_len))
+    batch = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids), "got_input_ids": got_input_ids,
+             "got_mask": torch.ones_like(got_input_ids), "got_adj_matrix": adjacency,
+             "labels": torch.randint(2, vocab_size, (batch_size, args.output_len))}
+
+    return {name: value.to(device) for name, value in batch.items()}
+
+
+def load(args, checkpointing, device):
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    tokenizer.add_special_tokens({'additional_special_tokens': ['<s>']})
+    model = T5GenerationWithGraph.from_pretrained(args.model, s_token_id=tokenizer.get_vocab()["<s>"])
+    model.resize_token_embeddings(len(tokenizer))
+    if checkpointing:
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+
+    return model.to(device).train()
+
+
+def step(model, batch):
+    model.zero_grad(set_to_none=True)
+    loss = model(**batch).loss
+    loss.backward()
+
+    return loss
+
+
+def saved_activations_mb(model, batch):
+    """Size of the tensors (other than the weights) that the forward pass keeps for the backward pass."""
+    parameters = {p.data_ptr() for p in model.parameters()}
+    storages = {}
+
+    def pack(tensor):
+        pointer = tensor.untyped_storage().data_ptr()
+        if pointer not in parameters:
+            storages[pointer] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    model.zero_grad(set_to_none=True)
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = model(**batch).loss
+    loss.backward()
+
+    return sum(storages.values()) / 2 ** 20
+
+
+def check_gradients(args, device):
+    """Largest absolute gradient difference between the two settings on one small batch (same seed, same dropout)."""
+    gradients = []
+    for checkpointing in [False, True]:
+        torch.manual_seed(args.seed)
+        model = load(args, checkpointing, device)
+        torch.manual_seed(args.seed)
+        step(model, synthetic_batch(model, min(args.batch_sizes), args, device))
+        gradients.append({name: p.grad for name, p in model.named_parameters() if p.grad is not None})
+
+    assert gradients[0].keys() == gradients[1].keys()
+    return max((gradients[0][name] - gradients[1][name]).abs().max().item() for name in gradients[0])
+
+
+def measure(args):
+    """One setting in this process, printed as JSON."""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(args.seed)
+    model = load(args, args.measure_checkpointing == 1, device)
+    batch = synthetic_batch(model, args.measure_batch_size, args, device)
+    result = {"oom": False}
+    try:
+        result["saved_mb"] = saved_activations_mb(model, batch)  # also the warm up
+        if device == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            step(model, batch)
+        if device == "cuda":
+            torch.cuda.synchronize()
+            result["peak_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+        else:
+            # the warm up step already reached the peak, the growth over the load is what the step needs
+            result["peak_mb"] = max(before, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024
+        result["seconds"] = (time.perf_counter() - start) / args.steps
+    except torch.cuda.OutOfMemoryError:
+        result["oom"] = True
+
+    print(json.dumps(result))
+
+
+def run(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"largest gradient difference with checkpointing: {check_gradients(args, device):.2e}")
+
+    command = [sys.executable, "-m", "benchmarks.gradient_checkpointing", "--model", args.model,
+               "--input_len", str(args.input_len), "--node_len", str(args.node_len),
+               "--num_nodes", str(args.num_nodes), "--output_len", str(args.output_len),
+               "--steps", str(args.steps), "--seed", str(args.seed)]
+    print(f"{device}, text {args.input_len}, node text {args.node_len}, {args.num_nodes} nodes, "
+          f"labels {args.output_len}")
+    print(f"{'batch':>6}{'checkpointing':>15}{'saved for backward':>20}{'peak memory':>14}{'step':>10}")
+    for batch_size in args.batch_sizes:
+        for checkpointing in [0, 1]:
+            output = subprocess.run(command + ["--measure_batch_size", str(batch_size),
+                                               "--measure_checkpointing", str(checkpointing)],
+                                    capture_output=True, text=True)
+            lines = output.stdout.strip().splitlines()
+            result = json.loads(lines[-1]) if output.returncode == 0 and lines else {"oom": True}
+            setting = "on" if checkpointing else "off"
+            if result["oom"]:
+                print(f"{batch_size:>6}{setting:>15}{'out of memory':>44}")
+            else:
+                print(f"{batch_size:>6}{setting:>15}{result['saved_mb']:>17.1f} MB{result['peak_mb']:>11.0f} MB"
+                      f"{result['seconds']:>9.2f}s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='declare-lab/flan-alpaca-base')
+    parser.add_argument('--batch_sizes', nargs="+", type=int, default=[4, 8, 16, 32])
+    parser.add_argument('--input_len', type=int, default=512)
+    parser.add_argument('--node_len', type=int, default=256)
+    parser.add_argument('--num_nodes', type=int, default=32)
+    parser.add_argument('--output_len', type=int, default=256)
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    # used by the processes that run a single measurement
+    parser.add_argument('--measure_batch_size', type=int, default=None)
+    parser.add_argument('--measure_checkpointing', type=int, default=0)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.measure_batch_size is not None:
+        measure(args)
+    else:
+        run(args)
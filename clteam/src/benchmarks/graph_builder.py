@@ -0,0 +1,117 @@
+"""
+Equivalence and timing of utils.graph_builder.build_graphs against the original dict and loop based graph building of
+get_mind_chart.
+
+Checked on the compressed triples of the real graph files (with the stored coreference clusters, see
+benchmarks/compress_triple.py) and on random triples with a small max_nodes, so truncation, repeated elements and
+empty strings are frequent. All three adjacency outputs are compared with the original dense matrices.
+Run from clteam/src:
+    python -m benchmarks.graph_builder
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from benchmarks.compress_triple import real_cases
+from dialogue_to_graph import compress_triple
+from utils.graph_builder import build_graphs
+from utils.sparse_adjacency import dense_to_edges
+
+
+def legacy_graph(triples, max_nodes):
+    action_input = []
+    node2id = {}
+    adj_temp = np.zeros([max_nodes, max_nodes])
+    index = 0
+    if len(triples) == 0:
+        action_input.append('<pad>')
+    else:
+        temp_text = ' <s> '
+        for u in triples:
+            stop = False
+            for element in u:
+                if element not in node2id:
+                    node2id[element] = index
+                    if index < max_nodes:
+                        if temp_text == ' <s> ':
+                            temp_text = temp_text + element
+                        else:
+                            temp_text = temp_text + ' </s> <s> ' + element
+                        index = index + 1
+                    else:
+                        stop = True
+                        break
+            if stop:
+                break
+
+            adj_temp[node2id[u[0]]][node2id[u[0]]] = 1
+            adj_temp[node2id[u[1]]][node2id[u[1]]] = 1
+            adj_temp[node2id[u[2]]][node2id[u[2]]] = 1
+
+            adj_temp[node2id[u[0]]][node2id[u[1]]] = 1
+            adj_temp[node2id[u[1]]][node2id[u[0]]] = 1
+
+            adj_temp[node2id[u[1]]][node2id[u[2]]] = 1
+            adj_temp[node2id[u[2]]][node2id[u[1]]] = 1
+
+        action_input.append(temp_text)
+
+    return action_input, adj_temp
+
+
+def check(triple_lists, max_nodes):
+    edges = build_graphs(triple_lists, max_nodes, output="edges").adjacency
+    indptr, indices = build_graphs(triple_lists, max_nodes, output="csr").adjacency
+    graphs = build_graphs(triple_lists, max_nodes, output="dense")
+    for i, triples in enumerate(triple_lists):
+        action_input, adj = legacy_graph(triples, max_nodes)
+        assert [graphs.node_text[i]] == action_input, (triples, graphs.node_text[i], action_input)
+        assert np.array_equal(graphs.adjacency[i], adj)
+        assert np.array_equal(edges[1][edges[0][i]:edges[0][i + 1]], dense_to_edges(adj))
+        for row in range(max_nodes):
+            start, end = indptr[i * max_nodes + row], indptr[i * max_nodes + row + 1]
+            assert np.array_equal(indices[start:end], np.flatnonzero(adj[row]))
+
+
+def random_triples(rng):
+    words = ["", "a", "bb", "ccc", "dd", "e", "fff", "g", "hh", "i", "jj", "k"]
+    return [[rng.choice(words) for _ in range(3)] for _ in range(rng.randint(0, 12))]
+
+
+def run(args):
+    triple_lists = [compress_triple(dialogue, coref) for dialogue, coref in real_cases(args)]
+    for start in range(0, len(triple_lists), 512):
+        check(triple_lists[start:start + 512], args.max_nodes)
+    rng = random.Random(0)
+    for _ in range(args.random_batches):
+        check([random_triples(rng) for _ in range(16)], rng.randint(1, 8))
+    print(f"Same graphs on {len(triple_lists)} real and {16 * args.random_batches} random triple lists")
+
+    print(f"{'builder':<22}{'graphs/s':>10}")
+    start = time.perf_counter()
+    for triples in triple_lists:
+        dense_to_edges(legacy_graph(triples, args.max_nodes)[1])
+    print(f"{'legacy + argwhere':<22}{len(triple_lists) / (time.perf_counter() - start):>10.0f}")
+    for output in ["edges", "csr", "dense"]:
+        start = time.perf_counter()
+        for i in range(0, len(triple_lists), args.batch_size):
+            build_graphs(triple_lists[i:i + args.batch_size], args.max_nodes, output=output)
+        print(f"{'batched ' + output:<22}{len(triple_lists) / (time.perf_counter() - start):>10.0f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', type=str, default='./../graphs')
+    parser.add_argument('--preprocessed_root', type=str, default='./../preprocessed')
+    parser.add_argument('--max_nodes', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--random_batches', type=int, default=2000)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
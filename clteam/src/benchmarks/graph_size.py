@@ -0,0 +1,112 @@
+"""
+Real node counts of the graphs of each split, and the training step time with every adjacency padded to max_nodes
+(100 x 100, what DataCollatorForSeq2Seq gives) against graphs cut to the largest graph of each batch
+(GraphDataCollator).
+
+The model is built with mask_padded_nodes, so padded nodes take no part in the GAT and the fusion and both settings
+give the same loss, which is checked. Run from clteam/src with a trained checkpoint and preprocessed data:
+    python -m benchmarks.graph_size --checkpoint <eval_dir> --splits train valid test --language en-de
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import AutoTokenizer
+
+from benchmarks.common import load_dataset
+from utils.dataset import GraphDataCollator
+from utils.model import T5GenerationWithGraph
+
+BINS = [(0, 0), (1, 5), (6, 10), (11, 20), (21, 50), (51, 100)]
+
+
+def histogram(counts, max_nodes):
+    bins = BINS + [(101, max_nodes)] if max_nodes > 100 else BINS
+    print(f"{'nodes':>10}{'items':>8}{'share':>8}")
+    for low, high in bins:
+        num_items = int(np.sum((counts >= low) & (counts <= high)))
+        share = num_items / len(counts)
+        label = f"{low}" if low == high else f"{low}-{high}"
+        print(f"{label:>10}{num_items:>8}{100 * share:>7.1f}% {'#' * int(round(50 * share))}")
+    print(f"mean {counts.mean():.1f}, median {np.median(counts):.0f}, 95th percentile "
+          f"{np.percentile(counts, 95):.0f}, max {counts.max()} of {max_nodes}")
+
+
+def train_step(model, batch):
+    model.train()
+    model.zero_grad(set_to_none=True)
+    start = time.perf_counter()
+    model(**batch).loss.backward()
+    seconds = time.perf_counter() - start
+
+    # dropout draws differ with the graph size, the losses are compared without it
+    model.eval()
+    with torch.no_grad():
+        return model(**batch).loss.item(), seconds
+
+
+def time_steps(model, dataset, collator, args, max_nodes):
+    items = [dataset[i] for i in range(min(args.num_items, len(dataset)))]
+    results = {"padded to max_nodes": [0.0, [], []], "cut per batch": [0.0, [], []]}
+    for start in range(0, len(items), args.batch_size):
+        batch = collator(items[start:start + args.batch_size])
+        num_nodes = batch["got_adj_matrix"].shape[1]
+        padded = dict(batch, got_adj_matrix=F.pad(batch["got_adj_matrix"], (0, max_nodes - num_nodes,
+                                                                           0, max_nodes - num_nodes)))
+        for name, inputs in [("padded to max_nodes", padded), ("cut per batch", batch)]:
+            loss, seconds = train_step(model, inputs)
+            results[name][0] += seconds
+            results[name][1].append(loss)
+            results[name][2].append(inputs["got_adj_matrix"].shape[1])
+
+    print(f"\ntraining steps on {len(items)} items, batches of {args.batch_size}")
+    print(f"{'':<22}{'graph size':>12}{'seconds':>9}{'speedup':>9}")
+    baseline = results["padded to max_nodes"][0]
+    for name, (seconds, _, sizes) in results.items():
+        print(f"{name:<22}{np.mean(sizes):>12.1f}{seconds:>9.2f}{baseline / seconds:>9.2f}")
+    difference = np.abs(np.array(results["padded to max_nodes"][1]) - np.array(results["cut per batch"][1])).max()
+    print(f"largest loss difference {difference:.2e}")
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    tokenizer = AutoTokenizer.from_pretrained(args.checkpoint)
+    s_token_id = tokenizer.get_vocab()["<s>"]
+    collator = GraphDataCollator(tokenizer, s_token_id)
+    datasets = {}
+    for split in args.splits:
+        datasets[split] = dataset = load_dataset(args, tokenizer, split)
+        counts = np.array([collator.num_nodes(dataset[i]) for i in range(len(dataset))])
+        print(f"\n{split} {args.language}: real node counts of {len(dataset)} graphs")
+        histogram(counts, dataset.max_nodes or args.max_nodes)
+
+    model = T5GenerationWithGraph.from_pretrained(args.checkpoint, s_token_id=s_token_id, mask_padded_nodes=True)
+    dataset = datasets[args.splits[-1]]
+    time_steps(model, dataset, collator, args, dataset.max_nodes or args.max_nodes)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--raw_data_root', type=str, default='./../..')
+    parser.add_argument('--triple_data_root', type=str, default='./../graphs')
+    parser.add_argument('--data_root', type=str, default='./../preprocessed/with_dialogue_history_exploded')
+    parser.add_argument('--cache_dir', type=str, default="")
+    parser.add_argument('--splits', nargs="+", type=str, default=["train", "valid", "test"],
+                        help='splits to count, the training steps are timed on the last one')
+    parser.add_argument('--language', type=str, default='en-de')
+    parser.add_argument('--max_nodes', type=int, default=100, help='graph size of datasets stored as dense matrices')
+    parser.add_argument('--num_items', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--input_len', type=int, default=512)
+    parser.add_argument('--output_len', type=int, default=256)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,124 @@
+"""
+Prompt tokens per training sample with the full dialogue history (truncated from the right, as before) and with the
+token budgeted history of build_train_pair.
+
+Every utterance of the raw CSV of a split is turned into a prompt, as if all of them were matched to a graph.
+Reported: the distribution of prompt tokens before truncation, how many prompts lose their "Translation:" tail at
+--input_len, the history turns that are kept, and the time to build and tokenise the prompts with each builder.
+Run from clteam/src:
+    python -m benchmarks.history_budget --split train --language en-de --model declare-lab/flan-alpaca-base
+"""
+
+import argparse
+import io
+import time
+from contextlib import redirect_stdout
+
+import numpy as np
+from transformers import AutoTokenizer
+
+from utils.utils_data import load_raw_data
+from utils.utils_prompt import build_train_pair, count_tokens
+
+
+def legacy_build_train_pair(og, exclude_context=False):
+    all_inputs, all_targets, all_separator, all_matrix = [], [], [], []
+    for i in range(len(og)):
+        current_dialogue = og[:i + 1]
+        if current_dialogue[-1].get("matched", False):  # Check if 'matched' key exists and is True
+            # Format text to translate
+            to_translate = current_dialogue[-1]["source"]
+            if "reference" in current_dialogue[-1].keys():
+                target_translation = current_dialogue[-1]["reference"]
+            else:
+                target_translation = ""
+
+            # Create the prompt input
+            if exclude_context:
+                prompt_input = f"Source segment:\n{to_translate}\n\n" \
+                               f"Translation:\n"
+            else:
+                # Build dialogue history
+                dialogue_history = []
+                for utt in current_dialogue[:-1]:
+                    if utt["source_language"] == "en":
+                        dialogue_history.append(f'{utt["sender"]}: {utt["source"]}')
+                    else:
+                        if "reference" in utt.keys():
+                            dialogue_history.append(f'{utt["sender"]}: {utt["reference"]}')
+
+                dialogue_history = "\n".join(dialogue_history)
+
+                prompt_input = f"Dialogue History:\n{dialogue_history}\n\n" \
+                               f"Source segment:\n{to_translate}\n\n" \
+                               f"Translation:\n"
+
+            all_inputs.append(prompt_input)
+            all_targets.append(target_translation)
+            all_separator.append(current_dialogue[-1]["input_txt"])
+            all_matrix.append(current_dialogue[-1]["input_matrix"])
+        else:
+            print(f"No match found for dialogue at index {i}.")  # Log unmatched dialogues for debugging
+
+    return all_inputs, all_targets, all_separator, all_matrix
+
+
+def build_all(builder, dialogues, tokenizer, input_len):
+    """Prompts of all dialogues, and the time to build them and tokenise them the way ChatDatasetWithGraph does."""
+    start = time.perf_counter()
+    prompts = [prompt for og in dialogues for prompt in builder(og)[0]]
+    tokenizer([" ".join(prompt.split()) for prompt in prompts], max_length=input_len, truncation=True)
+
+    return prompts, time.perf_counter() - start
+
+
+def describe(name, tokens, input_len, seconds):
+    tokens = np.array(tokens)
+    percentiles = np.percentile(tokens, [50, 90, 99])
+    print(f"{name:<10}{percentiles[0]:>7.0f}{percentiles[1]:>7.0f}{percentiles[2]:>7.0f}{tokens.max():>8}"
+          f"{100 * np.mean(tokens > input_len):>11.1f}%{np.mean(np.minimum(tokens, input_len)):>12.1f}"
+          f"{seconds:>10.2f}s")
+
+
+def run(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    with redirect_stdout(io.StringIO()):
+        dialogues = load_raw_data(args, args.split)
+    for og in dialogues:
+        for utt in og:
+            utt.update({"matched": True, "input_txt": None, "input_matrix": None})
+    print(f"{sum(len(og) for og in dialogues)} samples from {len(dialogues)} dialogues of {args.split} {args.language}")
+
+    full, full_seconds = build_all(legacy_build_train_pair, dialogues, tokenizer, args.input_len)
+    budgeted, budgeted_seconds = build_all(
+        lambda og: build_train_pair(og, tokenizer=tokenizer, max_length=args.input_len), dialogues, tokenizer,
+        args.input_len)
+    full_tokens = count_tokens(tokenizer, full, add_special_tokens=True)
+    budgeted_tokens = count_tokens(tokenizer, budgeted, add_special_tokens=True)
+
+    print(f"prompt tokens, input_len {args.input_len}")
+    print(f"{'history':<10}{'p50':>7}{'p90':>7}{'p99':>7}{'max':>8}{'truncated':>12}{'mean kept':>12}{'build+tok':>11}")
+    describe("full", full_tokens, args.input_len, full_seconds)
+    describe("budgeted", budgeted_tokens, args.input_len, budgeted_seconds)
+
+    turns_full = np.array([prompt.split("\n\nSource segment:")[0].count("\n") for prompt in full])
+    turns_kept = np.array([prompt.split("\n\nSource segment:")[0].count("\n") for prompt in budgeted])
+    cut = turns_kept < turns_full
+    print(f"history turns: mean {turns_full.mean():.1f} in full, {turns_kept.mean():.1f} kept; "
+          f"{cut.sum()} prompts ({100 * cut.mean():.1f}%) drop older turns, "
+          f"which keep {turns_kept[cut].mean() if cut.any() else 0:.1f} turns on average")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--raw_data_root', type=str, default='./../..')
+    parser.add_argument('--split', type=str, default='train')
+    parser.add_argument('--language', type=str, default='en-de')
+    parser.add_argument('--model', type=str, default='declare-lab/flan-alpaca-base')
+    parser.add_argument('--input_len', type=int, default=512)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
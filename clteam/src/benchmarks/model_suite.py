@@ -0,0 +1,286 @@
+"""
+Microbenchmarks of the components of utils/model.py on CPU with synthetic inputs: GraphAttentionLayer, GAT,
+JointEncoderWithGraph and T5GenerationWithGraph, for randomly initialised T5 configs of the size of the tiny test
+models and of flan-t5-base, over a grid of batch sizes, text lengths and node counts.
+
+Every case reports the throughput of an inference forward pass (eval, no grad), of a training step (forward and
+backward, train mode) and, for the whole model, of greedy generate (items and generated tokens per second), with the
+peak memory of the tensors it allocates (benchmarks.common.peak_tensor_bytes, measured in a separate run since it slows
+every operator down). The node text is as long as the text and holds the nodes at regular positions, the adjacency is
+random with self loops. With --output the results are written as JSON; with --baseline, the cases in both files are
+compared and the script exits with status 1 when a throughput drops by more than --tolerance (plus the noise measured
+for the case) or a peak memory grows by more than --tolerance. Run from clteam/src:
+    python -m benchmarks.model_suite --configs tiny --output results.json
+    python -m benchmarks.model_suite --configs tiny --baseline results.json --output new.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import torch
+from transformers import T5Config
+
+from benchmarks.common import S_TOKEN_ID, format_bytes, peak_tensor_bytes
+from utils.model import GAT, GraphAttentionLayer, T5GenerationWithGraph
+
+CONFIGS = {
+    "tiny": dict(vocab_size=2048, d_model=64, d_kv=16, d_ff=128, num_layers=2, num_heads=4),
+    "base": dict(vocab_size=32128, d_model=768, d_kv=64, d_ff=2048, num_layers=12, num_heads=12,
+                 feed_forward_proj="gated-gelu"),
+}
+
+COMPONENTS = ["gat_layer", "gat", "encoder", "model"]
+
+
+def make_model(name, args):
+    config = T5Config(decoder_start_token_id=0, pad_token_id=0, eos_token_id=1, **CONFIGS[name])
+
+    return T5GenerationWithGraph(config, s_token_id=S_TOKEN_ID, memory_efficient_gat=args.memory_efficient_gat,
+                                 mask_padded_nodes=args.mask_padded_nodes)
+
+
+def synthetic_inputs(model, batch_size, seq_len, num_nodes, output_len):
+    vocab_size = model.config.vocab_size
+    got_input_ids = torch.randint(S_TOKEN_ID + 1, vocab_size, (batch_size, seq_len))
+    got_input_ids[:, torch.arange(num_nodes) * (seq_len // num_nodes)] = S_TOKEN_ID
+    adjacency = (torch.rand(batch_size, num_nodes, num_nodes) < 0.2).float()
+    adjacency = torch.maximum(adjacency, torch.eye(num_nodes))
+    input_ids = torch.randint(S_TOKEN_ID + 1, vocab_size, (batch_size, seq_len))
+
+    return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids), "got_input_ids": got_input_ids,
+            "got_mask": torch.ones_like(got_input_ids), "got_adj_matrix": adjacency,
+            "labels": torch.randint(S_TOKEN_ID + 1, vocab_size, (batch_size, output_len))}
+
+
+def component_passes(component, model, batch, args):
+    """The passes of one component on a batch, by name."""
+    batch_size, num_nodes = batch["got_adj_matrix"].shape[:2]
+    d_model = model.config.d_model
+    if component in ["gat_layer", "gat"]:
+        if component == "gat_layer":
+            module = GraphAttentionLayer(d_model, d_model, dropout=0.2, alpha=0.02,
+                                         memory_efficient=args.memory_efficient_gat)
+        else:
+            module = GAT(nfeat=d_model, nhid=d_model, nheads=1, memory_efficient=args.memory_efficient_gat)
+        nodes = torch.randn(batch_size, num_nodes, d_model)
+        node_mask = torch.ones(batch_size, num_nodes, dtype=torch.bool) if args.mask_padded_nodes else None
+
+        def forward():
+            return module(nodes, batch["got_adj_matrix"], node_mask)
+
+        def loss():
+            return forward().sum()
+    elif component == "encoder":
+        module = model.encoder
+        encoder_inputs = {name: batch[name] for name in ["input_ids", "attention_mask", "got_input_ids", "got_mask",
+                                                          "got_adj_matrix"]}
+
+        def forward():
+            return module(**encoder_inputs, return_dict=True).last_hidden_state
+
+        def loss():
+            return forward().sum()
+    else:
+        module = model
+
+        def forward():
+            return module(**batch).logits
+
+        def loss():
+            return module(**batch).loss
+
+    def forward_no_grad():
+        module.eval()
+        with torch.no_grad():
+            forward()
+
+    def train_step():
+        module.train()
+        module.zero_grad(set_to_none=True)
+        loss().backward()
+
+    passes = {"forward": forward_no_grad, "forward_backward": train_step}
+    if component == "model":
+        def generate():
+            module.eval()
+            module.generate(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"],
+                            got_input_ids=batch["got_input_ids"], got_mask=batch["got_mask"],
+                            got_adj_matrix=batch["got_adj_matrix"], max_new_tokens=args.output_len,
+                            min_new_tokens=args.output_len, num_beams=1, do_sample=False)
+
+        passes["generate"] = generate
+
+    return passes
+
+
+def best_seconds(fn, repeat, min_seconds):
+    """Fastest of at least `repeat` runs of `fn()` that take `min_seconds` together."""
+    seconds = []
+    while len(seconds) < repeat or sum(seconds) < min_seconds:
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+
+    return min(seconds)
+
+
+def case_key(case):
+    return "/".join(str(case[name]) for name in ["config", "component", "pass", "batch_size", "seq_len", "num_nodes"])
+
+
+def config_cases(name, args):
+    """The cases of one config over the grid, each with the callable of its pass."""
+    torch.manual_seed(0)
+    model = make_model(name, args)
+    cases = []
+    for batch_size in args.batch_sizes:
+        for seq_len in args.seq_lens:
+            for num_nodes in args.node_counts:
+                if num_nodes > seq_len:
+                    continue
+                batch = synthetic_inputs(model, batch_size, seq_len, num_nodes, args.output_len)
+                for component in args.components:
+                    if component.startswith("gat") and seq_len != args.seq_lens[0]:
+                        continue  # the GAT does not see the text, once per node count is enough
+                    for pass_name, fn in component_passes(component, model, batch, args).items():
+                        case = {"config": name, "component": component, "pass": pass_name, "batch_size": batch_size,
+                                "seq_len": None if component.startswith("gat") else seq_len, "num_nodes": num_nodes}
+                        cases.append((case, fn))
+
+    return cases
+
+
+def measure(cases, args):
+    """
+    Time every case in --rounds rounds over the whole grid and keep its fastest run, like timeit the minimum rather
+    than the mean: other work on the machine only ever adds time, and spreading the runs of a case over the suite keeps
+    a busy spell from deciding it. How much the best run of each round differs is kept as the noise of the case. Then
+    measure the peak memory of every case, which is deterministic.
+    """
+    rounds = [[] for _ in cases]
+    for round_index in range(args.rounds):
+        for i, (case, fn) in enumerate(cases):
+            if round_index == 0:
+                for _ in range(args.warmup):
+                    fn()
+            rounds[i].append(best_seconds(fn, args.repeat, args.min_seconds))
+
+    results = []
+    for (case, fn), seconds in zip(cases, rounds):
+        best = min(seconds)
+        case = dict(case, ms=round(1000 * best, 3), items_per_s=round(case["batch_size"] / best, 3),
+                    noise=round(max(seconds) / best - 1, 3), peak_bytes=peak_tensor_bytes(fn))
+        if case["pass"] == "generate":
+            case["tokens_per_s"] = round(case["batch_size"] * args.output_len / best, 3)
+        results.append(case)
+
+    return results
+
+
+def print_case(case):
+    seq_len = "-" if case["seq_len"] is None else case["seq_len"]
+    tokens = f"{case['tokens_per_s']:>10.1f}" if "tokens_per_s" in case else f"{'':>10}"
+    print(f"{case['config']:<6}{case['component']:<11}{case['pass']:<18}{case['batch_size']:>4}{seq_len:>6}"
+          f"{case['num_nodes']:>7}{case['ms']:>11.2f}{case['items_per_s']:>10.1f}{tokens}"
+          f"{100 * case['noise']:>7.1f}%{format_bytes(case['peak_bytes']):>11}")
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the cases of both runs side by side and return those that regressed: a throughput that dropped by more than
+    tolerance plus the noise of the noisier run, or a peak memory that grew by more than tolerance.
+    """
+    baseline_cases = {case_key(case): case for case in baseline["results"]}
+    regressions = []
+    print(f"\n{'case':<48}{'items/s':>10}{'baseline':>10}{'change':>9}{'peak':>11}{'baseline':>11}{'change':>9}")
+    for case in results:
+        old = baseline_cases.get(case_key(case))
+        if old is None:
+            continue
+        speed = case["items_per_s"] / old["items_per_s"] - 1
+        memory = case["peak_bytes"] / old["peak_bytes"] - 1 if old["peak_bytes"] else 0.0
+        flags = []
+        if speed < -(tolerance + max(case["noise"], old["noise"])):
+            flags.append("slower")
+        if memory > tolerance:
+            flags.append("more memory")
+        if flags:
+            regressions.append((case_key(case), flags))
+        print(f"{case_key(case):<48}{case['items_per_s']:>10.1f}{old['items_per_s']:>10.1f}{100 * speed:>+8.1f}%"
+              f"{format_bytes(case['peak_bytes']):>11}{format_bytes(old['peak_bytes']):>11}{100 * memory:>+8.1f}%"
+              f"  {', '.join(flags)}")
+
+    return regressions
+
+
+def environment():
+    return {"torch": torch.__version__, "python": platform.python_version(), "machine": platform.machine(),
+            "processor": platform.processor(), "threads": torch.get_num_threads()}
+
+
+def run(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    cases = [case for name in args.configs for case in config_cases(name, args)]
+    results = measure(cases, args)
+
+    print(f"cpu, {torch.get_num_threads()} threads, generate {args.output_len} tokens, best of {args.rounds} rounds of "
+          f"at least {args.repeat} runs")
+    print(f"{'':<6}{'component':<11}{'pass':<18}{'B':>4}{'text':>6}{'nodes':>7}{'ms':>11}{'items/s':>10}"
+          f"{'tokens/s':>10}{'noise':>8}{'peak':>11}")
+    for case in results:
+        print_case(case)
+
+    output = {"environment": environment(), "settings": {name: value for name, value in vars(args).items()
+                                                         if name not in ["output", "baseline", "tolerance"]},
+              "results": results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline["environment"] != output["environment"]:
+            print(f"\nwarning: the baseline ran in another environment: {baseline['environment']}")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {100 * args.tolerance:.0f}% "
+                  f"(plus the noise for throughput):")
+            for key, flags in regressions:
+                print(f"  {key}: {', '.join(flags)}")
+            sys.exit(1)
+        print(f"\nno regression beyond {100 * args.tolerance:.0f}% (plus the noise for throughput)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', type=str, nargs="+", default=["tiny", "base"], choices=list(CONFIGS))
+    parser.add_argument('--components', type=str, nargs="+", default=COMPONENTS, choices=COMPONENTS)
+    parser.add_argument('--batch_sizes', type=int, nargs="+", default=[1, 8])
+    parser.add_argument('--seq_lens', type=int, nargs="+", default=[64, 256],
+                        help='length of the text and of the node text')
+    parser.add_argument('--node_counts', type=int, nargs="+", default=[16, 64])
+    parser.add_argument('--output_len', type=int, default=16, help='label length and tokens generated')
+    parser.add_argument('--memory_efficient_gat', action='store_true')
+    parser.add_argument('--mask_padded_nodes', action='store_true')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--rounds', type=int, default=3, help='times the whole grid is timed')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of every case in each round, at least')
+    parser.add_argument('--min_seconds', type=float, default=0.2,
+                        help='time every case for at least this long in each round')
+    parser.add_argument('--threads', type=int, default=None, help='torch CPU threads, all cores by default')
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='JSON results of an earlier run to compare against, exit with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative drop of throughput or growth of peak memory that counts as a regression')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
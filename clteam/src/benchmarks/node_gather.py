@@ -0,0 +1,123 @@
+"""
+Check the batched node gather of JointEncoderWithGraph against the per-sample loop it replaced and time both.
+
+Run from clteam/src:
+    python -m benchmarks.node_gather --batch_sizes 4 16 --max_nodes 100
+"""
+
+import argparse
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from benchmarks.common import S_TOKEN_ID, time_fn, tiny_model
+from utils.model import JointEncoderWithGraph
+
+
+def legacy_gather_nodes(self, node_representations, got_input_ids, max_nodes):
+    # The per-sample loop JointEncoderWithGraph.forward used before the batched gather
+    nodes = [torch.zeros([max_nodes, node_representations.shape[-1]], device=node_representations.device)]
+    for i in range(0, got_input_ids.shape[0]):
+        segs = got_input_ids[i].eq(self.s_token_id)
+        nodes.append(node_representations[i][segs])
+    nodes = pad_sequence(nodes)
+    nodes = nodes[:, 1:, :]
+    nodes_padding_mask = nodes.sum(-1) == 0
+
+    return nodes.transpose(1, 0), ~nodes_padding_mask.transpose(1, 0)
+
+
+def make_node_input_ids(batch_size, seq_len, max_nodes, device):
+    got_input_ids = torch.randint(S_TOKEN_ID + 1, 100, (batch_size, seq_len), device=device)
+    for i in range(batch_size):
+        # the first sample has no nodes at all, like an utterance without triples
+        num_nodes = 0 if i == 0 else int(torch.randint(1, max_nodes + 1, (1,)))
+        positions = torch.randperm(seq_len, device=device)[:num_nodes]
+        got_input_ids[i, positions] = S_TOKEN_ID
+
+    return got_input_ids
+
+
+def check_gather(encoder, device, max_nodes, d_model):
+    torch.manual_seed(0)
+    got_input_ids = make_node_input_ids(6, 64, min(max_nodes, 64), device)
+    node_representations = torch.randn(6, 64, d_model, device=device)
+
+    nodes_ref, mask_ref = legacy_gather_nodes(encoder, node_representations, got_input_ids, max_nodes)
+    nodes, mask = encoder.gather_nodes(node_representations, got_input_ids, max_nodes)
+    assert torch.equal(nodes_ref, nodes), "gathered nodes differ"
+    assert torch.equal(mask_ref, mask), "node masks differ"
+
+
+def check_model(model, device, max_nodes):
+    torch.manual_seed(0)
+    batch = make_batch(4, 32, max_nodes, device)
+    model.eval()
+    with torch.no_grad():
+        logits = model(**batch).logits
+        JointEncoderWithGraph.gather_nodes, new_gather = legacy_gather_nodes, JointEncoderWithGraph.gather_nodes
+        try:
+            logits_ref = model(**batch).logits
+        finally:
+            JointEncoderWithGraph.gather_nodes = new_gather
+    assert torch.allclose(logits_ref, logits, atol=1e-5), "model outputs differ"
+
+
+def make_batch(batch_size, seq_len, max_nodes, device):
+    got_input_ids = make_node_input_ids(batch_size, seq_len, min(max_nodes, seq_len), device)
+    adj = (torch.rand(batch_size, max_nodes, max_nodes, device=device) > 0.9).float()
+
+    return {"input_ids": torch.randint(S_TOKEN_ID + 1, 100, (batch_size, seq_len), device=device),
+            "attention_mask": torch.ones(batch_size, seq_len, device=device),
+            "got_input_ids": got_input_ids,
+            "got_mask": torch.ones(batch_size, seq_len, device=device),
+            "got_adj_matrix": adj,
+            "labels": torch.randint(0, 100, (batch_size, 8), device=device)}
+
+
+def run(args):
+    device = args.device
+    model = tiny_model(args.d_model).to(device)
+    encoder = model.encoder
+
+    check_gather(encoder, device, args.max_nodes, args.d_model)
+    check_model(model, device, args.max_nodes)
+    print("Equivalence OK")
+
+    model.train()
+    print(f"{'B':>4}{'gather loop ms':>16}{'gather batched ms':>19}{'step loop ms':>14}{'step batched ms':>17}")
+    for batch_size in args.batch_sizes:
+        torch.manual_seed(0)
+        batch = make_batch(batch_size, args.seq_len, args.max_nodes, device)
+        node_representations = torch.randn(batch_size, args.seq_len, args.d_model, device=device)
+
+        def train_step():
+            model(**batch).loss.backward()
+
+        timings = []
+        for gather in [legacy_gather_nodes, JointEncoderWithGraph.gather_nodes]:
+            timings.append(time_fn(lambda: gather(encoder, node_representations, batch["got_input_ids"],
+                                                  args.max_nodes), device, repeat=args.repeat))
+            JointEncoderWithGraph.gather_nodes, new_gather = gather, JointEncoderWithGraph.gather_nodes
+            try:
+                timings.append(time_fn(train_step, device, repeat=args.repeat))
+            finally:
+                JointEncoderWithGraph.gather_nodes = new_gather
+        print(f"{batch_size:>4}{timings[0] * 1000:>16.3f}{timings[2] * 1000:>19.3f}"
+              f"{timings[1] * 1000:>14.2f}{timings[3] * 1000:>17.2f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--d_model', type=int, default=64)
+    parser.add_argument('--seq_len', type=int, default=128)
+    parser.add_argument('--max_nodes', type=int, default=100)
+    parser.add_argument('--batch_sizes', type=int, nargs="+", default=[4, 16, 32])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,85 @@
+"""
+chrF drift and generation speed of int8 dynamic quantisation (utils.quantization.quantize_model, used by
+train_model.py --quantize) against the float32 checkpoint.
+
+Both models translate the same items greedily with T5GenerationWithGraph.translate; chrF is computed against the
+references like train_model.py does (postprocess_text, then sacrebleu chrF), and tokens/s counts the tokens of the
+translations. Run from clteam/src with a trained checkpoint and preprocessed data:
+    python -m benchmarks.quantized_inference --checkpoint <eval_dir> --split valid --language en-de --num_items 256
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+from sacrebleu.metrics import CHRF
+from transformers import AutoTokenizer
+
+from benchmarks.common import load_dataset
+from utils.model import T5GenerationWithGraph
+from utils.quantization import quantize_model
+from utils.utils_prompt import postprocess_text
+
+
+def size_mb(model):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "weights.pt")
+        torch.save(model.state_dict(), path)
+        return os.path.getsize(path) / 2 ** 20
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    tokenizer = AutoTokenizer.from_pretrained(args.checkpoint)
+    dataset = load_dataset(args, tokenizer, args.split, limit=args.num_items)
+    items = [dataset[i] for i in range(len(dataset))]
+    references = tokenizer.batch_decode([[token for token in item["labels"] if token >= 0] for item in items],
+                                        skip_special_tokens=True, clean_up_tokenization_spaces=True)
+
+    model = T5GenerationWithGraph.from_pretrained(args.checkpoint, s_token_id=tokenizer.get_vocab()["<s>"]).eval()
+    start = time.perf_counter()
+    quantized = quantize_model(model)
+    print(f"quantised in {time.perf_counter() - start:.1f}s, {len(items)} items of {args.split} {args.language}, "
+          f"batches of {args.batch_size}, {args.threads} thread(s)")
+
+    chrf = CHRF()
+    results = {}
+    for name, translator in [("float32", model), ("int8 dynamic", quantized)]:
+        start = time.perf_counter()
+        translations = translator.translate(tokenizer, items, batch_size=args.batch_size, max_length=args.output_len)
+        seconds = time.perf_counter() - start
+        num_tokens = sum(len(ids) for ids in tokenizer(translations, add_special_tokens=False)["input_ids"])
+        predictions, labels = postprocess_text(translations, references)
+        results[name] = (translations, chrf.corpus_score(predictions, [labels]).score, num_tokens / seconds,
+                         size_mb(translator))
+
+    reference_translations, reference_chrf, reference_speed, _ = results["float32"]
+    print(f"{'':<14}{'chrF':>8}{'drift':>8}{'tokens/s':>10}{'speedup':>9}{'weights':>11}{'same output':>13}")
+    for name, (translations, score, speed, size) in results.items():
+        same = sum(a == b for a, b in zip(translations, reference_translations))
+        print(f"{name:<14}{score:>8.2f}{score - reference_chrf:>+8.2f}{speed:>10.1f}{speed / reference_speed:>9.2f}"
+              f"{size:>8.1f} MB{same:>8}/{len(items)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--raw_data_root', type=str, default='./../..')
+    parser.add_argument('--triple_data_root', type=str, default='./../graphs')
+    parser.add_argument('--data_root', type=str, default='./../preprocessed/with_dialogue_history_exploded')
+    parser.add_argument('--cache_dir', type=str, default="")
+    parser.add_argument('--split', type=str, default='valid')
+    parser.add_argument('--language', type=str, default='en-de')
+    parser.add_argument('--num_items', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--input_len', type=int, default=512)
+    parser.add_argument('--output_len', type=int, default=256)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,74 @@
+"""
+Utterances per second of the coreference step of dialogue_to_graph against the number of spaCy processes.
+
+Texts are the per utterance contexts of the default "prefix" mode. Like dialogue_to_graph, dialogues are split into
+shards of shard_size and the texts of each shard go through nlp.pipe (utils.coreference.resolve), in this process or
+in a pool of workers that each load spaCy once. The one-by-one nlp(s) baseline is also used to check that every
+setting returns the same clusters in the same order. Needs spaCy with neuralcoref, run from clteam/src on a
+multi-core machine:
+    python -m benchmarks.spacy_pipeline --num_dialogues 40 --processes 1 2 4 8
+"""
+
+import argparse
+import json
+import os
+import time
+from argparse import Namespace
+from functools import partial
+from multiprocessing import get_context
+from pathlib import Path
+
+from dialogue_to_graph import coref_texts, coreference
+from utils.coreference import load_nlp, resolve
+
+
+def run(args):
+    with open(Path(args.data_root) / args.split / f"{args.language}.json", 'r', encoding='utf-8') as f:
+        dialogues = json.load(f)[:args.num_dialogues]
+    mode = Namespace(exclude_context=False, coref_mode="prefix", coref_window=0)
+    texts = [text for dialogue in dialogues for text in coref_texts(dialogue, mode)]
+    print(f"{len(texts)} utterances from {len(dialogues)} dialogues, {os.cpu_count()} CPUs")
+
+    coreference("warm up")
+    start = time.perf_counter()
+    reference = [coreference(text) for text in texts]
+    baseline = len(texts) / (time.perf_counter() - start)
+    print(f"{'setting':<24}{'utt/s':>9}{'speedup':>9}")
+    print(f"{'nlp(s), 1 process':<24}{baseline:>9.1f}{1:>9.2f}")
+
+    shards = [[text for dialogue in dialogues[start:start + args.shard_size] for text in coref_texts(dialogue, mode)]
+              for start in range(0, len(dialogues), args.shard_size)]
+    resolve_shard = partial(resolve, batch_size=args.batch_size)
+    for n_process in args.processes:
+        if n_process > 1:
+            # spaCy is loaded by every worker when it starts, which is not what we measure
+            with get_context("spawn").Pool(n_process, initializer=load_nlp) as pool:
+                pool.map(resolve_shard, [["warm up"]] * n_process, chunksize=1)
+                start = time.perf_counter()
+                clusters = [clusters for shard in pool.imap(resolve_shard, shards) for clusters in shard]
+                throughput = len(texts) / (time.perf_counter() - start)
+        else:
+            start = time.perf_counter()
+            clusters = [clusters for shard in map(resolve_shard, shards) for clusters in shard]
+            throughput = len(texts) / (time.perf_counter() - start)
+
+        assert clusters == reference, f"clusters with {n_process} processes differ from nlp(s)"
+        name = f"pipe, {n_process} process" + ("es" if n_process > 1 else "")
+        print(f"{name:<24}{throughput:>9.1f}{throughput / baseline:>9.2f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', type=str, default='./../graphs')
+    parser.add_argument('--split', type=str, default='valid')
+    parser.add_argument('--language', type=str, default='en-de')
+    parser.add_argument('--num_dialogues', type=int, default=40)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--shard_size', type=int, default=5, help='dialogues per task, as in dialogue_to_graph')
+    parser.add_argument('--processes', nargs="+", type=int, default=[1, 2, 4, 8])
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
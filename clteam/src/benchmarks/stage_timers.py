@@ -0,0 +1,82 @@
+"""
+Where a training step of JointEncoderWithGraph goes, by stage (utils.profiling.StageProfiler), and what the stage timers
+cost: training steps on synthetic batches without a profiler, with one that does not synchronise and with one that
+does (the default, the same on CPU). Run from clteam/src:
+    python -m benchmarks.stage_timers --model declare-lab/flan-alpaca-base --batch_size 8 --steps 20
+"""
+
+import argparse
+import time
+
+import torch
+from transformers import AutoTokenizer
+
+from benchmarks.gradient_checkpointing import synthetic_batch
+from utils.model import T5GenerationWithGraph
+from utils.profiling import StageProfiler
+
+
+def time_steps(model, batch, steps):
+    seconds = []
+    for _ in range(steps):
+        model.zero_grad(set_to_none=True)
+        start = time.perf_counter()
+        model(**batch).loss.backward()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        seconds.append(time.perf_counter() - start)
+
+    return sorted(seconds)[len(seconds) // 2]
+
+
+def run(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(0)
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    tokenizer.add_special_tokens({'additional_special_tokens': ['<s>']})
+    model = T5GenerationWithGraph.from_pretrained(args.model, s_token_id=tokenizer.get_vocab()["<s>"])
+    model.resize_token_embeddings(len(tokenizer))
+    model = model.to(device).train()
+    batch = synthetic_batch(model, args.batch_size, args, device)
+    time_steps(model, batch, 2)  # warm up
+
+    results = {}
+    for name, profiler in [("no profiler", None), ("timers, no sync", StageProfiler(synchronize=False)),
+                           ("timers", StageProfiler())]:
+        model.encoder.profiler = profiler
+        results[name] = time_steps(model, batch, args.steps)
+        if profiler is not None:
+            summary = profiler.summary(args.steps)
+    model.encoder.profiler = None
+
+    print(f"{device}, batch {args.batch_size}, text {args.input_len}, node text {args.node_len}, "
+          f"{args.num_nodes} nodes, median of {args.steps} steps")
+    print(f"{'':<18}{'step':>10}{'overhead':>10}")
+    for name, seconds in results.items():
+        overhead = 100 * (seconds / results["no profiler"] - 1)
+        print(f"{name:<18}{1000 * seconds:>8.1f}ms{overhead:>+9.1f}%")
+
+    print(f"\n{'forward stage':<24}{'ms/step':>9}{'share of step':>15}")
+    step_ms = 1000 * results["timers"]
+    for key, value in summary.items():
+        if key.endswith("_ms"):
+            print(f"{key[len('stage/'):-len('_ms')]:<24}{value:>9.2f}{100 * value / step_ms:>14.1f}%")
+        else:
+            print(f"{key[len('stage/'):]:<24}{value:>9.2f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='declare-lab/flan-alpaca-base')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--input_len', type=int, default=256)
+    parser.add_argument('--node_len', type=int, default=128)
+    parser.add_argument('--num_nodes', type=int, default=12)
+    parser.add_argument('--output_len', type=int, default=64)
+    parser.add_argument('--steps', type=int, default=20)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,110 @@
+"""
+GraphSeq2SeqTrainer.evaluate with the streaming chrF (utils.metrics.StreamingChrf) against the compute_metrics that
+train_model.py used before, which received every padded prediction and label array at once.
+
+Reports the evaluation time, the prediction and label arrays held for the metric and the reported scores: chrF must
+be the same (the old metric reported it times 100). The old gen_len was meant to count the tokens of each prediction
+but compared the decoded string with the pad id, so it was always 1; it is now the mean number of generated tokens. The old metric needs evaluate's chrF script, from the hub
+or a local copy given with --legacy_metric. Run from clteam/src with a trained checkpoint and preprocessed data:
+    python -m benchmarks.streaming_metrics --checkpoint <eval_dir> --split valid --language en-de --num_items 512
+"""
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import torch
+from transformers import AutoTokenizer, Seq2SeqTrainingArguments
+
+from benchmarks.common import load_dataset
+from utils.dataset import GraphDataCollator
+from utils.metrics import StreamingChrf
+from utils.model import T5GenerationWithGraph
+from utils.trainer import GraphSeq2SeqTrainer
+from utils.utils_prompt import postprocess_text
+
+
+def legacy_compute_metrics(tokenizer, metric, held):
+    def compute_metrics_rougel(eval_preds):
+        preds, targets = eval_preds
+        if isinstance(preds, tuple):
+            preds = preds[0]
+        held.append(preds.nbytes + targets.nbytes)
+
+        pred_result = np.where(preds != -100, preds, tokenizer.pad_token_id)
+        preds = tokenizer.batch_decode(pred_result, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        targets = np.where(targets != -100, targets, tokenizer.pad_token_id)
+        targets = tokenizer.batch_decode(targets, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        decoded_preds, decoded_labels = postprocess_text(preds, targets)
+
+        result = metric.compute(predictions=decoded_preds, references=decoded_labels)
+        result = {k: round(v * 100, 4) for k, v in result.items()}
+        prediction_lens = [np.count_nonzero(pred != tokenizer.pad_token_id) for pred in preds]
+        result["gen_len"] = np.mean(prediction_lens)
+        return result
+
+    return compute_metrics_rougel
+
+
+def evaluate_with(model, tokenizer, dataset, args, output_dir, **metric_kwargs):
+    training_args = Seq2SeqTrainingArguments(output_dir, per_device_eval_batch_size=args.batch_size,
+                                             predict_with_generate=True, generation_max_length=args.output_len,
+                                             remove_unused_columns=False, report_to="none", disable_tqdm=True,
+                                             eval_accumulation_steps=args.eval_acc)
+    trainer = GraphSeq2SeqTrainer(model=model, args=training_args,
+                                  data_collator=GraphDataCollator(tokenizer, model.encoder.s_token_id),
+                                  tokenizer=tokenizer, **metric_kwargs)
+    start = time.perf_counter()
+    metrics = trainer.evaluate(eval_dataset=dataset)
+
+    return metrics, time.perf_counter() - start
+
+
+def run(args):
+    import evaluate
+
+    torch.set_num_threads(args.threads)
+    tokenizer = AutoTokenizer.from_pretrained(args.checkpoint)
+    dataset = load_dataset(args, tokenizer, args.split, limit=args.num_items)
+    model = T5GenerationWithGraph.from_pretrained(args.checkpoint, s_token_id=tokenizer.get_vocab()["<s>"]).eval()
+
+    held = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        legacy, legacy_seconds = evaluate_with(
+            model, tokenizer, dataset, args, output_dir,
+            compute_metrics=legacy_compute_metrics(tokenizer, evaluate.load(args.legacy_metric), held))
+        streaming = StreamingChrf(tokenizer)
+        metrics, seconds = evaluate_with(model, tokenizer, dataset, args, output_dir, streaming_metric=streaming)
+
+    print(f"{len(dataset)} items of {args.split} {args.language}, batches of {args.batch_size}")
+    print(f"{'':<16}{'chrF':>9}{'gen_len':>9}{'loss':>9}{'seconds':>9}{'held for metric':>17}")
+    print(f"{'compute_metrics':<16}{legacy['eval_score'] / 100:>9.4f}{legacy['eval_gen_len']:>9.2f}"
+          f"{legacy['eval_loss']:>9.4f}{legacy_seconds:>9.2f}{held[0] / 2 ** 20:>14.2f} MB")
+    print(f"{'streaming':<16}{metrics['eval_score']:>9.4f}{metrics['eval_gen_len']:>9.2f}"
+          f"{metrics['eval_loss']:>9.4f}{seconds:>9.2f}{streaming.totals.nbytes / 2 ** 20:>14.2f} MB")
+    assert abs(legacy["eval_score"] / 100 - metrics["eval_score"]) < 1e-3, "chrF differs"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--raw_data_root', type=str, default='./../..')
+    parser.add_argument('--triple_data_root', type=str, default='./../graphs')
+    parser.add_argument('--data_root', type=str, default='./../preprocessed/with_dialogue_history_exploded')
+    parser.add_argument('--cache_dir', type=str, default="")
+    parser.add_argument('--split', type=str, default='valid')
+    parser.add_argument('--language', type=str, default='en-de')
+    parser.add_argument('--legacy_metric', type=str, default='chrf', help='evaluate metric name or local path')
+    parser.add_argument('--num_items', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--eval_acc', type=int, default=None)
+    parser.add_argument('--input_len', type=int, default=512)
+    parser.add_argument('--output_len', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
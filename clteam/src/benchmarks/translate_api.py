@@ -0,0 +1,128 @@
+"""
+Throughput of T5GenerationWithGraph.translate against Seq2SeqTrainer.predict, and a check that translate runs the
+graph encoder once per batch.
+
+trainer.predict is timed with the prepare_inputs_for_generation the model had before (which dropped the KV cache, so
+every step decoded the whole prefix again) and with the current one, translate with batches in input order and sorted
+by length. Greedy translations are compared with the first; translations can depend on the other items of a batch,
+as padded graph nodes are not fully masked in the fusion attention (unless the model uses mask_padded_nodes).
+Run from clteam/src with a trained checkpoint and preprocessed data:
+    python -m benchmarks.translate_api --checkpoint <eval_dir> --split test --language en-de --num_items 256
+"""
+
+import argparse
+import math
+import tempfile
+import time
+import types
+
+import numpy as np
+import torch
+from transformers import AutoTokenizer, Seq2SeqTrainingArguments
+
+from benchmarks.common import load_dataset
+from utils.dataset import GraphDataCollator
+from utils.model import T5GenerationWithGraph
+from utils.trainer import GraphSeq2SeqTrainer
+
+
+def legacy_prepare_inputs_for_generation(
+        self, decoder_input_ids, past=None, attention_mask=None, use_cache=None, encoder_outputs=None, **kwargs
+):
+    # cut decoder_input_ids if past is used
+    if past is not None:
+        decoder_input_ids = decoder_input_ids[:, -1:]
+
+    output = {
+        "input_ids": None,  # encoder_outputs is defined. input_ids not needed
+        "encoder_outputs": encoder_outputs,
+        "past_key_values": past,
+        "decoder_input_ids": decoder_input_ids,
+        "attention_mask": attention_mask,
+        "use_cache": use_cache,  # change this to avoid caching (presumably for debugging)
+    }
+
+    if "image_ids" in kwargs:
+        output["image_ids"] = kwargs['image_ids']
+    if "got_adj_matrix" in kwargs:
+        output["got_adj_matrix"] = kwargs['got_adj_matrix']
+    if "got_input_ids" in kwargs:
+        output["got_input_ids"] = kwargs['got_input_ids']
+    if "got_mask" in kwargs:
+        output["got_mask"] = kwargs['got_mask']
+
+    return output
+
+
+def predict(model, tokenizer, dataset, args, output_dir):
+    training_args = Seq2SeqTrainingArguments(output_dir, per_device_eval_batch_size=args.batch_size,
+                                             predict_with_generate=True, generation_max_length=args.output_len,
+                                             remove_unused_columns=False, report_to="none",
+                                             disable_tqdm=True)
+    trainer = GraphSeq2SeqTrainer(model=model, args=training_args,
+                                  data_collator=GraphDataCollator(tokenizer, model.encoder.s_token_id),
+                                  tokenizer=tokenizer)
+    start = time.perf_counter()
+    preds = trainer.predict(test_dataset=dataset, max_length=args.output_len).predictions
+    seconds = time.perf_counter() - start
+    preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
+
+    return [pred.strip() for pred in tokenizer.batch_decode(preds, skip_special_tokens=True)], seconds
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    tokenizer = AutoTokenizer.from_pretrained(args.checkpoint)
+    dataset = load_dataset(args, tokenizer, args.split, limit=args.num_items)
+    model = T5GenerationWithGraph.from_pretrained(args.checkpoint, s_token_id=tokenizer.get_vocab()["<s>"]).eval()
+
+    graph_calls = []
+    model.encoder.got_encoder.register_forward_hook(lambda module, inputs, output: graph_calls.append(1))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as output_dir:
+        model.prepare_inputs_for_generation = types.MethodType(legacy_prepare_inputs_for_generation, model)
+        results["trainer.predict, before"] = predict(model, tokenizer, dataset, args, output_dir)
+        del model.prepare_inputs_for_generation
+        results["trainer.predict"] = predict(model, tokenizer, dataset, args, output_dir)
+
+    num_batches = math.ceil(len(dataset) / args.batch_size)
+    for name, sort_by_length in [("translate, input order", False), ("translate", True)]:
+        graph_calls.clear()
+        start = time.perf_counter()
+        translations = model.translate(tokenizer, [dataset[i] for i in range(len(dataset))],
+                                       batch_size=args.batch_size, sort_by_length=sort_by_length,
+                                       max_length=args.output_len)
+        results[name] = translations, time.perf_counter() - start
+        assert len(graph_calls) == num_batches, f"graph encoder ran {len(graph_calls)} times for {num_batches} batches"
+    print(f"{len(dataset)} items of {args.split} {args.language} in {num_batches} batches of {args.batch_size}, "
+          f"graph encoder ran {len(graph_calls)} times in translate")
+
+    reference = results["trainer.predict, before"][0]
+    print(f"{'':<26}{'items/s':>9}{'speedup':>9}{'same output':>13}")
+    for name, (outputs, seconds) in results.items():
+        same = sum(a == b for a, b in zip(outputs, reference))
+        print(f"{name:<26}{len(outputs) / seconds:>9.2f}"
+              f"{results['trainer.predict, before'][1] / seconds:>9.2f}{same:>8}/{len(reference)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--raw_data_root', type=str, default='./../..')
+    parser.add_argument('--triple_data_root', type=str, default='./../graphs')
+    parser.add_argument('--data_root', type=str, default='./../preprocessed/with_dialogue_history_exploded')
+    parser.add_argument('--cache_dir', type=str, default="")
+    parser.add_argument('--split', type=str, default='test')
+    parser.add_argument('--language', type=str, default='en-de')
+    parser.add_argument('--num_items', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--input_len', type=int, default=512)
+    parser.add_argument('--output_len', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
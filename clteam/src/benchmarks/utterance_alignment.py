@@ -0,0 +1,188 @@
+"""
+Agreement and timing of the dynamic programming alignment of match_utterances against the original greedy one.
+
+Both align the raw CSV utterances of a split to the utterances after prompting. Reported: utterances each one
+matches, how many raw utterances get the same graph text, and the time of the greedy version, of the alignment
+(with rapidfuzz if installed) and of a launch that finds it in the cache. Run from clteam/src:
+    python -m benchmarks.utterance_alignment --split valid --language en-de
+"""
+
+import argparse
+import copy
+import io
+import pickle
+import tempfile
+import time
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+from typing import Tuple
+
+from fuzzywuzzy import fuzz
+
+from utils.alignment import alignment_cache_path, process
+from utils.utils_data import load_raw_data, load_triple_data, raw_data_path, triple_data_path
+from utils.utils_prompt import match_utterances
+
+
+def texts_approximately_equal(text1: str, text2: str, threshold: int = 95, look_ahead: str = "") -> Tuple[bool, bool]:
+    # Single utterance, fuzzy matching
+    if fuzz.ratio(text1, text2) >= threshold:
+        return True, False
+
+    # Try two utterances
+    elif fuzz.ratio(text1 + look_ahead, text2) >= threshold:
+        return True, True
+
+    return False, False
+
+
+def clean_text_for_comparison(og_utt, potential_triples):
+    # Check which is the text we need to clean
+    if og_utt["source_language"] == "en":
+        text_to_compare = og_utt["source"]
+    else:
+        if "reference" in og_utt.keys():
+            text_to_compare = og_utt["reference"]
+        else:
+            text_to_compare = [trip["translated_triple"].replace("_", " ") for trip in potential_triples["triples"]]
+            text_to_compare = " ".join(text_to_compare)
+
+    # Clean
+    if text_to_compare.startswith("NAME-M_TEXT:"):
+        text_to_compare = text_to_compare[12:]
+
+    return text_to_compare
+
+
+def legacy_match_utterances(raw_dialogues, tripled_dialogues, input_txt, input_matrix):
+    super_idx = 0
+    fixed_og = []
+    for og, post_prompt in zip(raw_dialogues, tripled_dialogues):
+        # Initialize 'matched' key for all utterances
+        for og_utt in og:
+            og_utt["matched"] = False  # Default to False
+
+        # This dialogue is the right length, leave it alone
+        if len(og) == len(post_prompt["dialogue"]):
+            for i, og_utt in enumerate(og):
+                og_utt["matched"] = True
+                og_utt["input_txt"] = input_txt[super_idx]
+                og_utt["input_matrix"] = input_matrix[super_idx]
+                og_utt["post_prompt"] = post_prompt["dialogue"][i]["text"]
+                super_idx += 1
+
+        # These lengths do not match, try to match
+        else:
+            skipped, count_doubles = 0, 0
+            double_match = False
+            for i, og_utt in enumerate(og):
+                try:
+                    if double_match:
+                        # This was already a match
+                        count_doubles += 1
+                        og_utt["matched"] = True
+                        og_utt["input_txt"] = input_txt[super_idx - 1]
+                        og_utt["input_matrix"] = input_matrix[super_idx - 1]
+                        og_utt["post_prompt"] = post_prompt["dialogue"][i - count_doubles - skipped]["text"]
+                        double_match = False
+                    else:
+                        # Prepare texts to compare
+                        current_prompted_utt = post_prompt["dialogue"][i - count_doubles - skipped]
+                        text_to_compare = clean_text_for_comparison(og_utt, current_prompted_utt)
+                        next_text = ""
+                        if (i + 1) < len(og):
+                            next_text = clean_text_for_comparison(og[i + 1],
+                                                                  post_prompt["dialogue"][
+                                                                      i + 1 - count_doubles - skipped])
+
+                        # Compare
+                        this_match, double_match = texts_approximately_equal(text_to_compare,
+                                                                             current_prompted_utt["text"],
+                                                                             look_ahead=next_text)
+
+                        # Assign accordingly
+                        if this_match:
+                            # This is a match
+                            og_utt["matched"] = True
+                            og_utt["input_txt"] = input_txt[super_idx]
+                            og_utt["input_matrix"] = input_matrix[super_idx]
+                            og_utt["reference"] = " ".join([trip["translated_triple"].replace("_", " ")
+                                                            for trip in current_prompted_utt["triples"]])
+                            og_utt["post_prompt"] = post_prompt["dialogue"][i - count_doubles - skipped]["text"]
+                            super_idx += 1
+                        else:
+                            # Move index by 1
+                            og_utt["matched"] = False
+                            og_utt["post_prompt"] = post_prompt["dialogue"][i - count_doubles - skipped]["text"]
+                            skipped += 1
+
+                except KeyError as e:
+                    print(f"KeyError: {e}")
+                except Exception as e:
+                    print(f"Unhandled exception: {e}")
+                    continue
+        fixed_og.append(og)
+
+    return fixed_og
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+
+    return result, time.perf_counter() - start
+
+
+def run(args):
+    with redirect_stdout(io.StringIO()):
+        raw_data = load_raw_data(args, args.split)
+        triple_data = load_triple_data(args, args.split)
+    # stand-in graphs: the position of every utterance after prompting, so the assignment can be compared
+    num_prompted = sum(len(dialogue["dialogue"]) for dialogue in triple_data)
+    graphs = [[f"graph {i}"] for i in range(num_prompted)]
+    num_raw = sum(len(og) for og in raw_data)
+
+    with redirect_stdout(io.StringIO()):
+        legacy, legacy_seconds = timed(legacy_match_utterances, copy.deepcopy(raw_data), triple_data, graphs, graphs)
+        aligned, aligned_seconds = timed(match_utterances, copy.deepcopy(raw_data), triple_data, graphs, graphs)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_path = alignment_cache_path(cache_dir, raw_data_path(args, args.split),
+                                              triple_data_path(args, args.split))
+            match_utterances(copy.deepcopy(raw_data), triple_data, graphs, graphs, cache_path=cache_path)
+            cached, cached_seconds = timed(lambda: match_utterances(copy.deepcopy(raw_data), triple_data, graphs,
+                                                                    graphs, cache_path=alignment_cache_path(
+                                                                        cache_dir, raw_data_path(args, args.split),
+                                                                        triple_data_path(args, args.split))))
+    assert pickle.dumps(cached) == pickle.dumps(aligned)
+
+    def assignment(dialogues):
+        # utterance after prompting each raw utterance is matched to, and the graph it gets
+        return [(utt.get("post_prompt") if utt["matched"] else None, utt.get("input_txt") if utt["matched"] else None)
+                for og in dialogues for utt in og]
+
+    legacy_assignment, aligned_assignment = assignment(legacy), assignment(aligned)
+    same_utterance = sum(a[0] == b[0] for a, b in zip(legacy_assignment, aligned_assignment))
+    same_graph = sum(a == b for a, b in zip(legacy_assignment, aligned_assignment))
+    print(f"{num_raw} raw utterances, {num_prompted} after prompting, "
+          f"scorer: {'rapidfuzz' if process is not None else 'fuzzywuzzy'}")
+    print(f"matched: greedy {sum(u is not None for u, _ in legacy_assignment)}, "
+          f"aligned {sum(u is not None for u, _ in aligned_assignment)}")
+    print(f"same utterance after prompting: {same_utterance} ({100 * same_utterance / num_raw:.1f}%), "
+          f"and same graph: {same_graph} ({100 * same_graph / num_raw:.1f}%)")
+    print(f"{'greedy':<22}{legacy_seconds:>8.2f}s")
+    print(f"{'aligned':<22}{aligned_seconds:>8.2f}s")
+    print(f"{'aligned, from cache':<22}{cached_seconds:>8.2f}s (includes hashing both files)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--raw_data_root', type=str, default='./../..')
+    parser.add_argument('--triple_data_root', type=str, default='./../graphs')
+    parser.add_argument('--split', type=str, default='valid')
+    parser.add_argument('--language', type=str, default='en-de')
+
+    return SimpleNamespace(**vars(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    run(parse_args())
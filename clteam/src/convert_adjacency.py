@@ -0,0 +1,40 @@
+import argparse
+import pickle
+from pathlib import Path
+
+from utils.sparse_adjacency import ADJ_EDGES_FILE, dense_to_edges, save_edges
+
+
+def convert(pickle_path, overwrite=False):
+    edges_path = pickle_path.parent / ADJ_EDGES_FILE
+    if edges_path.exists() and not overwrite:
+        print(f"\tSkipping {pickle_path.parent}, {ADJ_EDGES_FILE} exists already")
+        return
+
+    with open(pickle_path, 'rb') as f:
+        matrices = pickle.load(f)
+    max_nodes = matrices[0].shape[0] if len(matrices) > 0 else 100
+    save_edges(edges_path, [dense_to_edges(matrix) for matrix in matrices], max_nodes)
+
+    print(f"\t{pickle_path.parent}: {len(matrices)} graphs, "
+          f"{pickle_path.stat().st_size / 2 ** 20:.1f}MB -> {edges_path.stat().st_size / 2 ** 20:.2f}MB")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=f"Convert every mc_adj_matrix.pkl under data_root to {ADJ_EDGES_FILE}")
+    parser.add_argument('--data_root', type=str, default='./../preprocessed/with_dialogue_history_exploded')
+    parser.add_argument('--adj_matrix_file', type=str, default='mc_adj_matrix.pkl')
+    parser.add_argument('--overwrite', action='store_true')
+
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    for pickle_path in sorted(Path(args.data_root).rglob(args.adj_matrix_file)):
+        convert(pickle_path, overwrite=args.overwrite)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
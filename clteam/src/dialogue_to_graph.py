@@ -1,20 +1,19 @@
 import argparse
 import itertools
-import json
-import pickle
 import string
+import time
+from multiprocessing import get_context
 from pathlib import Path
 
-import neuralcoref
 import numpy as np
-import spacy
-from tqdm import tqdm
 
+from utils.coreference import clusters_up_to, load_nlp, resolve, to_clusters
+from utils.graph_builder import build_graphs
+from utils.graph_shards import GraphShardWriter, write_shard
+from utils.sparse_adjacency import ADJ_EDGES_FILE
 from utils.utils_data import load_all_data
 
 # stanza.install_corenlp()
-nlp = spacy.load('en_core_web_sm')
-neuralcoref.add_to_pipe(nlp)  # Add neural coref to SpaCy's pipe
 punc = string.punctuation
 alphabets = "([A-Za-z])"
 prefixes = "(Mr|St|Mrs|Ms|Dr|Prof|Capt|Cpt|Lt|Mt)[.]"
@@ -26,135 +25,114 @@ max_nodes = 100
 
 
 def coreference(s):
-    doc = nlp(s)
-    return doc._.coref_clusters
+    return to_clusters(load_nlp()(s))
+
+
+def line_ends(lines):
+    """Character offset where every line ends once the lines are joined by spaces (see coref_texts)."""
+    return [end - 1 for end in itertools.accumulate(len(line) + 1 for line in lines)]
+
+
+def mention_map(coref):
+    """
+    Lower cased entity each mention string resolves to. Clusters are applied in order, so a mention replaced by the
+    main entity of one cluster can be replaced again by a later cluster that mentions that entity.
+    """
+    clusters = [({mention.text.lower() for mention in cluster.mentions}, cluster.main.text.lower())
+                for cluster in coref]
+    mapping = {}
+    for mentions, _ in clusters:
+        for mention in mentions:
+            if mention in mapping:
+                continue
+            entity = mention
+            for cluster_mentions, main in clusters:
+                if entity in cluster_mentions:
+                    entity = main
+            mapping[mention] = entity
+
+    return mapping
+
+
+# pairs of triple positions that identify a triple to merge with: (subject, relation), (subject, object), (object, relation)
+MERGE_KEYS = ((0, 1), (0, 2), (2, 1))
 
 
 def compress_triple(dialogue, coref):
     triples = [utt["triples"] for utt in dialogue["dialogue"]]
     triples = list(itertools.chain.from_iterable(triples))
+    entities = mention_map(coref)
 
     temp_set = []
+    # position pair and values -> indices in temp_set, kept up to date when a triple is edited
+    index = {}
+
+    def add_to_index(j):
+        for a, b in MERGE_KEYS:
+            index.setdefault((a, b, temp_set[j][a], temp_set[j][b]), set()).add(j)
+
+    def edit(j, position, value):
+        for a, b in MERGE_KEYS:
+            if position in (a, b):
+                index[(a, b, temp_set[j][a], temp_set[j][b])].discard(j)
+        temp_set[j][position] = value
+        for a, b in MERGE_KEYS:
+            if position in (a, b):
+                index.setdefault((a, b, temp_set[j][a], temp_set[j][b]), set()).add(j)
+
     for cur in triples:
         cur_subject = cur['subject'].lower() if cur['subject'] else ""
         cur_relation = cur['predicate'].lower() if cur['predicate'] else ""
         cur_object = cur['object'].lower() if cur['object'] else ""
-
-        for cluster in coref:
-            span = [w.text.lower() for w in cluster.mentions]
-            if cur_subject in span:
-                cur_subject = cluster.main.text.lower()
-            if cur_object in span:
-                cur_object = cluster.main.text.lower()
-
-        if len(temp_set) == 0:
-            temp_set.append([cur_subject, cur_relation, cur_object])
-        else:
-            flag = 0
-            # print(temp_set)
-            for j in range(0, len(temp_set)):
-                ###save the longest when have two same entities
-                if temp_set[j][0] == cur_subject and temp_set[j][1] == cur_relation:
-
-                    if len(cur_object) > len(temp_set[j][2]):
-                        temp_set[j][2] = cur_object
-                    flag = 1
-
-                elif temp_set[j][0] == cur_subject and temp_set[j][2] == cur_object:
-                    if len(cur_relation) > len(temp_set[j][1]):
-                        temp_set[j][1] = cur_relation
-                    flag = 1
-
-                elif temp_set[j][2] == cur_object and temp_set[j][1] == cur_relation:
-                    if len(cur_subject) > len(temp_set[j][0]):
-                        temp_set[j][0] = cur_subject
-                    flag = 1
-
-            if flag == 0:
-                ##if no editing, then it is a new triplet, add to temp
-                temp_set.append([cur_subject, cur_relation, cur_object])
+        cur_subject = entities.get(cur_subject, cur_subject)
+        cur_object = entities.get(cur_object, cur_object)
+        current = [cur_subject, cur_relation, cur_object]
+
+        # every triple sharing two of the three elements, in the order they were added
+        matches = sorted(set().union(*[index.get((a, b, current[a], current[b]), ()) for a, b in MERGE_KEYS]))
+        for j in matches:
+            ###save the longest when have two same entities
+            if temp_set[j][0] == cur_subject and temp_set[j][1] == cur_relation:
+                if len(cur_object) > len(temp_set[j][2]):
+                    edit(j, 2, cur_object)
+
+            elif temp_set[j][0] == cur_subject and temp_set[j][2] == cur_object:
+                if len(cur_relation) > len(temp_set[j][1]):
+                    edit(j, 1, cur_relation)
+
+            elif temp_set[j][2] == cur_object and temp_set[j][1] == cur_relation:
+                if len(cur_subject) > len(temp_set[j][0]):
+                    edit(j, 0, cur_subject)
+
+        if len(matches) == 0:
+            ##if no editing, then it is a new triplet, add to temp
+            temp_set.append(current)
+            add_to_index(len(temp_set) - 1)
 
     return temp_set
 
 
-def get_mind_chart(mc_context, annotate_result, max_nodes):
+def get_mind_chart(mc_context, annotate_result, max_nodes, coref=None):
     """get mind chart
 
     Args:
         mc_context (string): the context to construct mind chart (question+" "+context+" "+lecture+" "+solution+" "+choice)
+        coref (list of clusters): coreference clusters of mc_context when already known, resolved here otherwise
 
     Returns:
         triples(list of triplets list): [[I, love, NLP],[NLP,is,fun]]
         action_input(list):["I</s><s>love</s><s>NLP</s><s>NLP</s><s>is</s><s>fun"]
         action_adj(list): [adjecent matrix] 
     """
-    mc_context = mc_context.replace("\n", " ")
-    coref = coreference(mc_context)
+    if coref is None:
+        mc_context = mc_context.replace("\n", " ")
+        coref = coreference(mc_context)
     triples = compress_triple(annotate_result, coref)
 
-    action_input = []
-    coref_clusters = []
-
-    id2node = {}
-    node2id = {}
-    adj_temp = np.zeros([max_nodes, max_nodes])
-    index = 0
-    if len(triples) == 0:
-        action_input.append('<pad>')
-    else:
-        temp_text = ' <s> '
-        for u in triples:
-            if u[0] not in node2id:
-                node2id[u[0]] = index
-                id2node[index] = u[0]
-                if index < max_nodes:
-                    if temp_text == ' <s> ':
-                        temp_text = temp_text + u[0]
-                    else:
-                        temp_text = temp_text + ' </s> <s> ' + u[0]
-
-                    index = index + 1
-                else:
-                    break
-            if u[1] not in node2id:
-                node2id[u[1]] = index
-                id2node[index] = u[1]
-
-                if index < max_nodes:
-                    if temp_text == ' <s> ':
-                        temp_text = temp_text + u[1]
-                    else:
-                        temp_text = temp_text + ' </s> <s> ' + u[1]
-                    index = index + 1
-                else:
-                    break
-
-            if u[2] not in node2id:
-                node2id[u[2]] = index
-                id2node[index] = u[2]
-
-                if index < max_nodes:
-                    if temp_text == ' <s> ':
-                        temp_text = temp_text + u[2]
-                    else:
-                        temp_text = temp_text + ' </s> <s> ' + u[2]
-                    index = index + 1
-                else:
-                    break
-
-            adj_temp[node2id[u[0]]][node2id[u[0]]] = 1
-            adj_temp[node2id[u[1]]][node2id[u[1]]] = 1
-            adj_temp[node2id[u[2]]][node2id[u[2]]] = 1
-
-            adj_temp[node2id[u[0]]][node2id[u[1]]] = 1
-            adj_temp[node2id[u[1]]][node2id[u[0]]] = 1
-
-            adj_temp[node2id[u[1]]][node2id[u[2]]] = 1
-            adj_temp[node2id[u[2]]][node2id[u[1]]] = 1
-
-        action_input.append(temp_text)
-        coref_clusters = [[el.string for el in cluster.mentions] for cluster in coref]
-    # action_adj.append(adj_temp)
+    graphs = build_graphs([triples], max_nodes, output="dense")
+    action_input = [graphs.node_text[0]]
+    adj_temp = graphs.adjacency[0].astype(np.float64)
+    coref_clusters = [[el.string for el in cluster.mentions] for cluster in coref] if len(triples) > 0 else []
 
     return action_input, adj_temp, coref_clusters
 
@@ -171,18 +149,65 @@ def make_output_directory(args, split, language):
     return outpath
 
 
-def save_data(mc_input_text_list, mc_adj_matrix_list, mc_coref_clusters_list, outpath, args):
-    mc_input_text_path = outpath / args.input_text_file
-    with open(mc_input_text_path, 'wb') as f:
-        pickle.dump(mc_input_text_list, f)
+def utterance_contexts(dialogue, args):
+    """Text to build the mind chart of every utterance from: the utterance and (part of) the history before it."""
+    utterances = dialogue["dialogue"]
+    lines = [f'{utt["sender"]}: {utt["text"]}' for utt in utterances]
+
+    contexts = []
+    for i in range(len(utterances)):
+        to_translate = utterances[i]["text"]
+        if args.exclude_context:
+            contexts.append(f"{to_translate}")
+        else:
+            history_start = max(0, i - args.coref_window) if args.coref_mode == "window" else 0
+            dialogue_history = "\n".join(lines[history_start:i])
+            contexts.append(f"{dialogue_history}\n{to_translate}")
+
+    return contexts
+
+
+def coref_texts(dialogue, args):
+    """Texts to resolve coreference in for a dialogue: one per utterance, or the whole dialogue in "dialogue" mode."""
+    if args.coref_mode == "dialogue" and not args.exclude_context:
+        return [" ".join(f'{utt["sender"]}: {utt["text"]}' for utt in dialogue["dialogue"])]
+
+    return [context.replace("\n", " ") for context in utterance_contexts(dialogue, args)]
 
-    mc_adj_matrix_path = outpath / args.adj_matrix_file
-    with open(mc_adj_matrix_path, 'wb') as f:
-        pickle.dump(mc_adj_matrix_list, f)
 
-    mc_coref_clusters_path = outpath / args.coref_clusters_file
-    with open(mc_coref_clusters_path, 'w') as f:
-        json.dump(mc_coref_clusters_list, f)
+def dialogue_mind_charts(dialogue, args, clusters=None):
+    """
+    Mind chart of every utterance of a dialogue, with the utterance as target and the turns before it as context.
+    clusters are the coreference clusters of coref_texts(dialogue, args), resolved here when not given.
+
+    With coref_mode "prefix" coreference is resolved again over every prefix of the dialogue, which is quadratic in
+    its length. "window" only keeps the last coref_window turns of history, and "dialogue" resolves the whole
+    dialogue once and cuts the clusters to every prefix (see clusters_up_to). In "dialogue" mode clusters are decided
+    with all turns in view, so a prefix may get (or miss) a cluster that only later turns make (un)likely, and the
+    target utterance keeps its "sender: " prefix; no text after the target ever reaches its graph.
+    """
+    utterances = dialogue["dialogue"]
+    if clusters is None:
+        clusters = [coreference(text) for text in coref_texts(dialogue, args)]
+    if args.coref_mode == "dialogue" and not args.exclude_context:
+        ends = line_ends([f'{utt["sender"]}: {utt["text"]}' for utt in utterances])
+        clusters = [clusters_up_to(clusters[0], end) for end in ends]
+
+    # Loop through utterances to make the last turn the target, and build all their graphs at once
+    triple_lists, mc_coref_clusters_list = [], []
+    for i in range(len(utterances)):
+        current_dialogue = {"dialogue": [utterances[i]]}
+        triples = compress_triple(current_dialogue, clusters[i])
+        triple_lists.append(triples)
+        mc_coref_clusters_list.append([[el.string for el in cluster.mentions] for cluster in clusters[i]]
+                                      if len(triples) > 0 else [])
+
+    graphs = build_graphs(triple_lists, max_nodes, output="edges")
+    offsets, edges = graphs.adjacency
+    mc_input_text_list = [[text] for text in graphs.node_text]
+    mc_adj_matrix_list = [edges[offsets[i]:offsets[i + 1]] for i in range(len(utterances))]
+
+    return mc_input_text_list, mc_adj_matrix_list, mc_coref_clusters_list
 
 
 def parse_args():
@@ -196,15 +221,42 @@ def parse_args():
 
     parser.add_argument('--output_dir', type=str, default='./../preprocessed/with_dialogue_history_exploded/')
     parser.add_argument('--input_text_file', type=str, default='mc_input_text.pkl')
-    parser.add_argument('--adj_matrix_file', type=str, default='mc_adj_matrix.pkl')
+    parser.add_argument('--adj_edges_file', type=str, default=ADJ_EDGES_FILE)
     parser.add_argument('--coref_clusters_file', type=str, default='mc_coref_clusters.json')
     parser.add_argument('--exclude_context', action='store_true', help='remove dialogue history from the prompt')
+    parser.add_argument('--coref_mode', type=str, default='prefix', choices=['prefix', 'window', 'dialogue'],
+                        help='resolve coreference over every dialogue prefix, over the last coref_window turns, '
+                             'or once per dialogue (see dialogue_mind_charts)')
+    parser.add_argument('--coref_window', type=int, default=5, help='turns of history with --coref_mode window')
+    parser.add_argument('--nlp_batch_size', type=int, default=64, help='texts per nlp.pipe batch')
+    parser.add_argument('--n_process', type=int, default=1,
+                        help='worker processes, each loads spaCy once and builds whole shards of all splits/languages')
+    parser.add_argument('--shard_size', type=int, default=50,
+                        help='dialogues per output shard and per task; a restarted run skips finished shards')
 
     args = parser.parse_args()
     return args
 
 
+def process_shard(task):
+    """Build the graphs of a shard worth of dialogues and write them as shard name, in a worker or in the main process."""
+    split, language, shard_dir, name, dialogues, args = task
+    start = time.perf_counter()
+
+    texts = [coref_texts(dialogue, args) for dialogue in dialogues]
+    clusters = iter(resolve([text for dialogue_texts in texts for text in dialogue_texts], args.nlp_batch_size))
+    results = []
+    for dialogue, dialogue_texts in zip(dialogues, texts):
+        dialogue_clusters = [next(clusters) for _ in dialogue_texts]
+        results.append((dialogue['Conversation ID'], *dialogue_mind_charts(dialogue, args, clusters=dialogue_clusters)))
+    entry = write_shard(shard_dir, name, results, max_nodes)
+
+    return split, language, entry, time.perf_counter() - start
+
+
 def main(args):
+    # Split every split and language into shards of dialogues that have not been processed yet
+    jobs, tasks = {}, []
     for split in args.splits:
         # Read data
         data_per_language = load_all_data(args, split)
@@ -214,33 +266,56 @@ def main(args):
             # Create directories
             outpath = make_output_directory(args, split, language)
 
-            # Analyze
-            mc_input_text_list, mc_adj_matrix_list, mc_coref_clusters_list = [], [], []
-            print(f"Processing split: {split}, language: {language}")
-            for dialogue in tqdm(dialogues, desc="dialogues"):
-                print(f"\tProcessing dialogue: {dialogue['Conversation ID']}")
-
-                # Loop through utterances to make the last turn the target
-                for i in tqdm(range(len(dialogue["dialogue"])), desc="utterances"):
-                    current_dialogue = dialogue["dialogue"][:i + 1]
-                    dialogue_history = "\n".join([f'{utt["sender"]}: {utt["text"]}' for utt in current_dialogue[:-1]])
-                    to_translate = current_dialogue[-1]["text"]
-
-                    if args.exclude_context:
-                        mc_context_text = f"{to_translate}"
-                        current_dialogue = {"dialogue": [current_dialogue[-1]]}
-                    else:
-                        mc_context_text = f"{dialogue_history}\n{to_translate}"
-                        current_dialogue = {"dialogue": [current_dialogue[-1]]}
-
-                    mc_input_text, mc_adj_matrix, mc_coref_clusters = get_mind_chart(mc_context_text, current_dialogue,
-                                                                                     max_nodes)
-                    mc_input_text_list.append(mc_input_text)
-                    mc_adj_matrix_list.append(mc_adj_matrix)
-                    mc_coref_clusters_list.append(mc_coref_clusters)
-
-            # Save data
-            save_data(mc_input_text_list, mc_adj_matrix_list, mc_coref_clusters_list, outpath, args)
+            # Shards are recorded as they finish, so a restarted run picks up where it stopped
+            settings = {"exclude_context": args.exclude_context, "max_nodes": max_nodes,
+                        "coref_mode": args.coref_mode, "coref_window": args.coref_window}
+            writer = GraphShardWriter(outpath, settings, max_nodes=max_nodes)
+            todo = [dialogue for dialogue in dialogues if dialogue['Conversation ID'] not in writer.done]
+            print(f"Split: {split}, language: {language}, {len(dialogues) - len(todo)} dialogues processed before, "
+                  f"{len(todo)} to go")
+
+            shards = [todo[start:start + args.shard_size] for start in range(0, len(todo), args.shard_size)]
+            tasks.extend((split, language, writer.shard_dir, writer.next_shard_name(), shard, args) for shard in shards)
+            jobs[(split, language)] = {"writer": writer, "dialogues": dialogues, "outpath": outpath,
+                                       "pending": len(shards)}
+
+    def save(split, language):
+        # Merge the shards in the order of the input file
+        job = jobs[(split, language)]
+        job["writer"].finalize([dialogue['Conversation ID'] for dialogue in job["dialogues"]],
+                               job["outpath"] / args.input_text_file, job["outpath"] / args.adj_edges_file,
+                               job["outpath"] / args.coref_clusters_file)
+        print(f"Saved split: {split}, language: {language}")
+
+    for split, language in jobs:
+        if jobs[(split, language)]["pending"] == 0:
+            save(split, language)
+
+    def record(results):
+        utterances = 0
+        for finished, (split, language, entry, seconds) in enumerate(results, start=1):
+            job = jobs[(split, language)]
+            job["writer"].record(entry)
+            job["pending"] -= 1
+            utterances += sum(entry['utterances'])
+            print(f"\t[{finished}/{len(tasks)}] {split}/{language} {entry['shard']}: {len(entry['dialogues'])} "
+                  f"dialogues, {sum(entry['utterances'])} utterances in {seconds:.1f}s")
+            if job["pending"] == 0:
+                save(split, language)
+
+        return utterances
+
+    # Process the shards of all splits and languages together, each worker loads spaCy once
+    start = time.perf_counter()
+    if args.n_process > 1:
+        with get_context("spawn").Pool(args.n_process, initializer=load_nlp) as pool:
+            utterances = record(pool.imap_unordered(process_shard, tasks))
+    else:
+        utterances = record(map(process_shard, tasks))
+    seconds = time.perf_counter() - start
+    # wall clock throughput, to compare runs with different --n_process
+    print(f"{utterances} utterances in {seconds:.1f}s ({utterances / max(seconds, 1e-9):.1f}/s) with "
+          f"{args.n_process} process(es)")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,30 @@
+import argparse
+
+from transformers import AutoTokenizer
+
+from utils.export import FORMATS, export_model
+from utils.model import T5GenerationWithGraph
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export the encoder and decoder of a trained checkpoint for "
+                                                 "utils.export.ExportedTranslator")
+    parser.add_argument('--eval_dir', type=str, required=True, help='checkpoint saved by train_model.py')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--format', choices=list(FORMATS), default="onnx")
+
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.eval_dir)
+    model = T5GenerationWithGraph.from_pretrained(args.eval_dir, s_token_id=tokenizer.get_vocab()["<s>"])
+    export_model(model, args.output_dir, fmt=args.format)
+    tokenizer.save_pretrained(args.output_dir)
+    print(f"Exported {args.eval_dir} to {args.output_dir} ({args.format})")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,58 @@
+from utils.alignment import MATCHED, MERGED, SAME_LENGTH, UNMATCHED, align_dialogue
+
+SENTENCES = ["Hello, I would like to book a table for two tonight.",
+             "Of course, at what time would you like to come in?",
+             "Around eight o'clock would be perfect for us.",
+             "I am sorry, we are fully booked at eight this evening.",
+             "Could we come at half past nine instead then?"]
+
+
+def raw(*texts):
+    return [{"source_language": "en", "source": text} for text in texts]
+
+
+def prompted(*texts):
+    return [{"text": text, "triples": []} for text in texts]
+
+
+def test_same_length_is_aligned_one_to_one():
+    indices, kinds = align_dialogue(raw(*SENTENCES[:3]), prompted("a", "b", "c"))
+
+    assert indices == [0, 1, 2]
+    assert kinds == [SAME_LENGTH] * 3
+
+
+def test_raw_utterance_without_match_is_skipped():
+    og = raw(SENTENCES[0], "Let me just check the list of reservations first.", SENTENCES[1], SENTENCES[2])
+    indices, kinds = align_dialogue(og, prompted(SENTENCES[0], SENTENCES[1], SENTENCES[2]))
+
+    assert indices == [0, -1, 1, 2]
+    assert kinds == [MATCHED, UNMATCHED, MATCHED, MATCHED]
+
+
+def test_two_raw_utterances_merged_into_one():
+    og = raw(SENTENCES[0], SENTENCES[1], SENTENCES[2], SENTENCES[3])
+    indices, kinds = align_dialogue(og, prompted(SENTENCES[0], SENTENCES[1] + " " + SENTENCES[2], SENTENCES[3]))
+
+    assert indices == [0, 1, 1, 2]
+    assert kinds == [MATCHED, MATCHED, MERGED, MATCHED]
+
+
+def test_bad_comparison_does_not_shift_the_rest():
+    # the second utterance was rewritten after prompting and an extra utterance was added at the end
+    og = raw(*SENTENCES[:4])
+    post = prompted(SENTENCES[0], "Sure, when?", SENTENCES[2], SENTENCES[3], SENTENCES[4])
+    indices, kinds = align_dialogue(og, post)
+
+    assert indices == [0, -1, 2, 3]
+    assert kinds == [MATCHED, UNMATCHED, MATCHED, MATCHED]
+
+
+def test_utterance_without_own_text_matches_its_triples():
+    og = raw(SENTENCES[0]) + [{"source_language": "de"}] + raw(SENTENCES[2])
+    post = prompted(SENTENCES[0], "book table", SENTENCES[2], SENTENCES[3])
+    post[1]["triples"] = [{"translated_triple": "book_table"}]
+    indices, kinds = align_dialogue(og, post)
+
+    assert indices == [0, 1, 2]
+    assert kinds == [MATCHED, MATCHED, MATCHED]
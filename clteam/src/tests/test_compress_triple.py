@@ -0,0 +1,42 @@
+import random
+
+from benchmarks.compress_triple import legacy_compress_triple, random_case
+from dialogue_to_graph import compress_triple
+from utils.coreference import Cluster, Mention
+
+
+def cluster(main, *others):
+    mentions = [Mention(text, text, -1, -1) for text in (main,) + others]
+    return Cluster(mentions[0], mentions)
+
+
+def dialogue(*triples):
+    return {"dialogue": [{"triples": [{"subject": s, "predicate": p, "object": o} for s, p, o in triples]}]}
+
+
+def test_same_output_as_quadratic_version_on_random_cases():
+    rng = random.Random(0)
+    for _ in range(2000):
+        case, coref = random_case(rng)
+        assert compress_triple(case, coref) == legacy_compress_triple(case, coref)
+
+
+def test_merges_keep_longest_element_and_resolve_mentions():
+    case = dialogue(("Anna", "likes", "tea"),
+                    ("she", "likes", "green tea"),
+                    ("Anna", "drinks", "coffee"),
+                    ("Anna", "really drinks", "coffee"),
+                    ("Tom", None, "milk"))
+    coref = [cluster("Anna", "she")]
+
+    expected = [["anna", "likes", "green tea"], ["anna", "really drinks", "coffee"], ["tom", "", "milk"]]
+    assert compress_triple(case, coref) == expected
+    assert legacy_compress_triple(case, coref) == expected
+
+
+def test_chained_clusters():
+    # "he" resolves to "the man", which a later cluster resolves to "Bob"
+    case = dialogue(("he", "owns", "a dog"), ("Bob", "owns", "a dog"))
+    coref = [cluster("the man", "he"), cluster("Bob", "the man")]
+
+    assert compress_triple(case, coref) == legacy_compress_triple(case, coref) == [["bob", "owns", "a dog"]]
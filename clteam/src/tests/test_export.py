@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+from benchmarks.common import tiny_model
+from utils.export import ENCODER_INPUTS, ExportedTranslator, example_inputs, export_model
+
+# batch, text, node text, nodes: none of them the size the graphs were traced at
+SHAPES = [(1, 5, 7, 3), (3, 20, 16, 6)]
+MAX_LENGTH = 8
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    model = tiny_model(32).eval()
+    # weights wider than the T5 initialisation, so the generated tokens depend on the input
+    with torch.no_grad():
+        for parameter in model.parameters():
+            parameter.normal_(0, 0.5)
+
+    return model
+
+
+@pytest.fixture(scope="module", params=["onnx", "torchscript"])
+def exported(request, model, tmp_path_factory):
+    if request.param == "onnx":
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+    export_dir = tmp_path_factory.mktemp(request.param)
+    export_model(model, export_dir, fmt=request.param)
+
+    return ExportedTranslator.load(export_dir)
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+def test_encoder_matches_eager(model, exported, shape):
+    torch.manual_seed(1)
+    batch = dict(zip(ENCODER_INPUTS, example_inputs(model, *shape)))
+
+    hidden_states = exported.encode(batch)
+    expected = ExportedTranslator.from_model(model).encode(batch)
+
+    assert hidden_states.shape == expected.shape
+    assert torch.allclose(hidden_states, expected, atol=1e-4)
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+def test_greedy_tokens_match_generate(model, exported, shape):
+    torch.manual_seed(2)
+    batch = dict(zip(ENCODER_INPUTS, example_inputs(model, *shape)))
+
+    tokens = exported.greedy(exported.encode(batch), batch["attention_mask"], MAX_LENGTH)
+    with torch.no_grad():
+        expected = model.generate(**batch, max_length=MAX_LENGTH)
+
+    assert torch.equal(tokens, expected)
@@ -0,0 +1,51 @@
+import pytest
+import torch
+
+from benchmarks.common import S_TOKEN_ID, tiny_model
+from benchmarks.node_gather import legacy_gather_nodes, make_batch, make_node_input_ids
+from utils.model import JointEncoderWithGraph
+
+D_MODEL = 16
+
+
+@pytest.fixture
+def encoder():
+    torch.manual_seed(0)
+    return tiny_model(D_MODEL).encoder
+
+
+@pytest.mark.parametrize("max_nodes", [1, 8, 40])
+def test_gather_matches_per_sample_loop(encoder, max_nodes):
+    torch.manual_seed(max_nodes)
+    got_input_ids = make_node_input_ids(5, 32, min(max_nodes, 32), "cpu")
+    node_representations = torch.randn(5, 32, D_MODEL)
+
+    nodes_ref, mask_ref = legacy_gather_nodes(encoder, node_representations, got_input_ids, max_nodes)
+    nodes, mask = encoder.gather_nodes(node_representations, got_input_ids, max_nodes)
+
+    assert nodes.shape == (5, max_nodes, D_MODEL)
+    assert torch.equal(nodes_ref, nodes)
+    assert torch.equal(mask_ref, mask)
+
+
+def test_nodes_beyond_max_nodes_are_dropped(encoder):
+    got_input_ids = torch.full((1, 10), S_TOKEN_ID + 1)
+    got_input_ids[0, [1, 4, 6, 9]] = S_TOKEN_ID
+    node_representations = torch.arange(10, dtype=torch.float).view(1, 10, 1).expand(1, 10, D_MODEL)
+
+    nodes, mask = encoder.gather_nodes(node_representations, got_input_ids, 3)
+
+    assert torch.equal(nodes[0, :, 0], torch.tensor([1.0, 4.0, 6.0]))
+    assert mask.tolist() == [[True, True, True]]
+
+
+def test_model_outputs_match_per_sample_loop(monkeypatch):
+    torch.manual_seed(0)
+    model = tiny_model(D_MODEL).eval()
+    batch = make_batch(3, 24, 12, "cpu")
+    with torch.no_grad():
+        logits = model(**batch).logits
+        monkeypatch.setattr(JointEncoderWithGraph, "gather_nodes", legacy_gather_nodes)
+        logits_ref = model(**batch).logits
+
+    assert torch.allclose(logits_ref, logits, atol=1e-5)
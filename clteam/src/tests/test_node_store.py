@@ -0,0 +1,43 @@
+import json
+
+import numpy as np
+
+from utils.node_store import NodeEmbeddingStore
+
+HIDDEN_SIZE = 4
+
+
+def open_store(store_dir):
+    return NodeEmbeddingStore(store_dir, "checkpoint", HIDDEN_SIZE)
+
+
+def test_rows_without_index_entry_are_dropped(tmp_path):
+    store = open_store(tmp_path)
+    store._add([("a", np.ones((2, HIDDEN_SIZE)))])
+    # a run that stopped after writing the rows of an entry but before its index line
+    with open(tmp_path / "embeddings.bin", 'ab') as f:
+        f.write(np.full((3, HIDDEN_SIZE), 9, dtype=np.float32).tobytes())
+
+    store = open_store(tmp_path)
+    store._add([("b", np.full((1, HIDDEN_SIZE), 2.0))])
+    store = open_store(tmp_path)
+
+    assert store.index == {"a": (0, 2), "b": (2, 1)}
+    np.testing.assert_array_equal(store._rows(*store.index["a"]), np.ones((2, HIDDEN_SIZE)))
+    np.testing.assert_array_equal(store._rows(*store.index["b"]), np.full((1, HIDDEN_SIZE), 2.0))
+
+
+def test_truncated_index_line_is_dropped(tmp_path):
+    store = open_store(tmp_path)
+    store._add([("a", np.ones((1, HIDDEN_SIZE)))])
+    with open(tmp_path / "index.jsonl", 'a') as f:
+        f.write('{"key": "b", "offs')
+
+    store = open_store(tmp_path)
+    store._add([("c", np.full((1, HIDDEN_SIZE), 3.0))])
+    store = open_store(tmp_path)
+
+    assert store.index == {"a": (0, 1), "c": (1, 1)}
+    with open(tmp_path / "index.jsonl", 'r') as f:
+        assert [json.loads(line)["key"] for line in f] == ["a", "c"]
+    np.testing.assert_array_equal(store._rows(*store.index["c"]), np.full((1, HIDDEN_SIZE), 3.0))
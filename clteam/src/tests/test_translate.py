@@ -0,0 +1,73 @@
+import pytest
+import torch
+
+from benchmarks.common import S_TOKEN_ID, tiny_model
+
+# without repeated tokens, as the greedy output of a random model is mostly one token over and over
+GENERATE_KWARGS = {"max_length": 8, "no_repeat_ngram_size": 1}
+
+
+class IdTokenizer:
+    """The two things translate needs from a tokenizer, with token ids as text."""
+    pad_token_id = 0
+
+    def batch_decode(self, sequences, skip_special_tokens=False):
+        return [" ".join(str(token) for token in sequence.tolist() if token > 1) for sequence in sequences]
+
+
+def make_item(rng, text_len, num_nodes):
+    got_input_ids = torch.randint(S_TOKEN_ID + 1, 100, (3 * num_nodes + 1,), generator=rng)
+    got_input_ids[torch.arange(num_nodes) * 3] = S_TOKEN_ID
+
+    return {"input_ids": torch.randint(S_TOKEN_ID + 1, 100, (text_len,), generator=rng),
+            "attention_mask": torch.ones(text_len, dtype=torch.long),
+            "got_input_ids": got_input_ids,
+            "got_mask": torch.ones_like(got_input_ids),
+            "got_adj_matrix": (torch.rand(num_nodes, num_nodes, generator=rng) > 0.5).float()}
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    # padded nodes are masked, so an item translates the same whatever else is in its batch
+    model = tiny_model(32, mask_padded_nodes=True).eval()
+    # weights wider than the T5 initialisation, so the generated tokens depend on the input
+    with torch.no_grad():
+        for parameter in model.parameters():
+            parameter.normal_(0, 0.5)
+
+    return model
+
+
+@pytest.fixture
+def items():
+    rng = torch.Generator().manual_seed(0)
+    return [make_item(rng, text_len, num_nodes) for text_len, num_nodes in [(9, 3), (4, 1), (14, 5), (6, 2), (11, 4)]]
+
+
+def generate_one(model, item, **kwargs):
+    inputs = {name: value.unsqueeze(0) for name, value in item.items()}
+    with torch.no_grad():
+        return model.generate(**inputs, **GENERATE_KWARGS, **kwargs)
+
+
+@pytest.mark.parametrize("use_cache", [True, False])
+def test_translate_matches_generate(model, items, use_cache):
+    tokenizer = IdTokenizer()
+    expected = [tokenizer.batch_decode(generate_one(model, item, use_cache=False))[0] for item in items]
+
+    assert model.translate(tokenizer, items, batch_size=2, use_cache=use_cache, **GENERATE_KWARGS) == expected
+
+
+def test_cache_does_not_change_generated_tokens(model, items):
+    for item in items:
+        assert torch.equal(generate_one(model, item, use_cache=True), generate_one(model, item, use_cache=False))
+
+
+def test_graph_encoder_runs_once_per_batch(model, items):
+    graph_calls = []
+    model.encoder.got_encoder.register_forward_hook(lambda module, inputs, output: graph_calls.append(1))
+
+    model.translate(IdTokenizer(), items, batch_size=2, **GENERATE_KWARGS)
+
+    assert len(graph_calls) == 3
@@ -2,22 +2,50 @@ import argparse
 import json
 import os
 import random
+import time
 
-import evaluate
 import numpy as np
 import torch
-from transformers import AutoTokenizer, DataCollatorForSeq2Seq, Seq2SeqTrainingArguments, Seq2SeqTrainer
+from transformers import AutoTokenizer, DataCollatorForSeq2Seq, Seq2SeqTrainingArguments
 
-from utils.dataset import ChatDatasetWithGraph
+from utils.dataset import ChatDatasetWithGraph, GraphDataCollator
+from utils.metrics import StreamingChrf
 from utils.model import T5GenerationWithGraph
+from utils.node_store import NodeEmbeddingStore
+from utils.profiling import StageProfiler
+from utils.quantization import quantize_model
+from utils.trainer import GraphSeq2SeqTrainer
 from utils.utils_data import make_save_directory
-from utils.utils_prompt import postprocess_text
 
 os.environ["WANDB_PROJECT"] = "WMT_24"
 
 
-def T5Trainer(args):
+def create_tokenizer(model_name):
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.add_special_tokens({'additional_special_tokens': ['<s>']})
+
+    return tokenizer
+
+
+def load_model(args, model_path, tokenizer):
+    """T5GenerationWithGraph from model_path, with the embeddings resized to the tokenizer (which adds <s>)."""
+    model = T5GenerationWithGraph.from_pretrained(model_path, s_token_id=tokenizer.get_vocab()["<s>"],
+                                                  memory_efficient_gat=args.memory_efficient_gat,
+                                                  mask_padded_nodes=args.mask_padded_nodes)
+    model.resize_token_embeddings(len(tokenizer))
+
+    return model
+
+
+def T5Trainer(args, tokenizer=None, model=None):
+    """
+    Train (or with --eval_dir, evaluate) a model for args.language. A tokenizer and model that are already loaded can
+    be passed in, as train_models.py does to load them once for several languages. Returns the seconds spent on each
+    stage.
+    """
     set_random_seeds(args)
+    timings = {}
+    start = time.perf_counter()
 
     # make directories for output
     print('====Make directories====')
@@ -25,10 +53,14 @@ def T5Trainer(args):
 
     # Create tokenizer
     print(f'====Create tokenizer====')
-    tokenizer = AutoTokenizer.from_pretrained(args.model)
-    tokenizer.add_special_tokens({'additional_special_tokens': ['<s>']})
+    if tokenizer is None:
+        tokenizer = create_tokenizer(args.model)
     s_token_id = tokenizer.get_vocab()["<s>"]
-    datacollator = DataCollatorForSeq2Seq(tokenizer)
+    if args.dynamic_padding or args.mask_padded_nodes:
+        # with masked node padding, cutting the graphs of each batch to its largest one gives the same outputs
+        datacollator = GraphDataCollator(tokenizer, s_token_id)
+    else:
+        datacollator = DataCollatorForSeq2Seq(tokenizer)
 
     # Load data as dataset
     print('====Load dataset====')
@@ -43,31 +75,25 @@ def T5Trainer(args):
         train_set = None
         eval_set = ChatDatasetWithGraph("test", tokenizer, args)
         args.model = args.eval_dir
+    timings["dataset"] = time.perf_counter() - start
 
     # Load model
     print(f'====Load model: {args.model} ====')
-    model = T5GenerationWithGraph.from_pretrained(args.model, s_token_id=s_token_id)
-    model.resize_token_embeddings(len(tokenizer))
+    start = time.perf_counter()
+    if model is None:
+        model = load_model(args, args.model, tokenizer)
     print("model parameters: ", model.num_parameters())
-
-    # chrf for cn generation
-    metric = evaluate.load("chrf")
-
-    def compute_metrics_rougel(eval_preds):
-        preds, targets = eval_preds
-        if isinstance(preds, tuple):
-            preds = preds[0]
-
-        pred_result = np.where(preds != -100, preds, tokenizer.pad_token_id)
-        preds = tokenizer.batch_decode(pred_result, skip_special_tokens=True, clean_up_tokenization_spaces=True)
-        targets = tokenizer.batch_decode(targets, skip_special_tokens=True, clean_up_tokenization_spaces=True)
-        decoded_preds, decoded_labels = postprocess_text(preds, targets)
-
-        result = metric.compute(predictions=decoded_preds, references=decoded_labels)
-        result = {k: round(v * 100, 4) for k, v in result.items()}
-        prediction_lens = [np.count_nonzero(pred != tokenizer.pad_token_id) for pred in preds]
-        result["gen_len"] = np.mean(prediction_lens)
-        return result
+    # only evaluation is quantised, --quantize is ignored in training
+    quantize = args.eval_dir != "" and args.quantize
+    if quantize:
+        model = quantize_model(model)
+    if args.eval_dir != "" and args.node_store_dir != "":
+        model.encoder.node_store = NodeEmbeddingStore(args.node_store_dir, checkpoint=args.eval_dir,
+                                                      hidden_size=model.config.d_model, quantized=quantize)
+    timings["model"] = time.perf_counter() - start
+
+    # chrF of the valid set, accumulated batch by batch during evaluation
+    metric = StreamingChrf(tokenizer)
 
     # evaluate at each epoch
     print('====Load training arguments====')
@@ -91,32 +117,40 @@ def T5Trainer(args):
                                              predict_with_generate=True,
                                              generation_max_length=args.output_len,
                                              load_best_model_at_end=False,
-                                             report_to="wandb",
-                                             bf16=args.bf16
+                                             group_by_length=args.group_by_length,
+                                             remove_unused_columns=False,
+                                             report_to=args.report_to,
+                                             bf16=args.bf16,
+                                             gradient_checkpointing=args.gradient_checkpointing,
+                                             gradient_checkpointing_kwargs={"use_reentrant": False},
+                                             use_cpu=quantize  # quantised kernels run on CPU only
                                              )
 
     print('====Load trainer====')
-    trainer = Seq2SeqTrainer(model=model,
-                             args=training_args,
-                             train_dataset=train_set,
-                             eval_dataset=eval_set,
-                             data_collator=datacollator,
-                             tokenizer=tokenizer,
-                             compute_metrics=compute_metrics_rougel,
-                             preprocess_logits_for_metrics=None
-                             )
+    trainer = GraphSeq2SeqTrainer(model=model,
+                                  args=training_args,
+                                  train_dataset=train_set,
+                                  eval_dataset=eval_set,
+                                  data_collator=datacollator,
+                                  tokenizer=tokenizer,
+                                  streaming_metric=metric,
+                                  stage_profiler=StageProfiler() if args.profile_stages else None
+                                  )
 
     # Train
     if args.eval_dir == "":
         print('====Train====')
+        start = time.perf_counter()
         trainer.train(resume_from_checkpoint=args.resume_from_checkpoint)
         trainer.save_model(save_dir)
+        timings["train"] = time.perf_counter() - start
 
     def generate_predictions(dataset):
         predict_results = trainer.predict(test_dataset=dataset, max_length=args.output_len)
         preds, targets = predict_results.predictions, predict_results.label_ids
         preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
         preds = tokenizer.batch_decode(preds, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        targets = np.where(targets != -100, targets, tokenizer.pad_token_id)
         targets = tokenizer.batch_decode(targets, skip_special_tokens=True, clean_up_tokenization_spaces=True)
         preds = [pred.strip() for pred in preds]
 
@@ -126,7 +160,9 @@ def T5Trainer(args):
     print('====Generate predictions====')
     torch.cuda.empty_cache()
     if trainer.is_world_process_zero():
+        start = time.perf_counter()
         preds, targets = generate_predictions(eval_set)
+        timings["generate"] = time.perf_counter() - start
         output_data = {"preds": preds,
                        "labels": targets}
 
@@ -139,6 +175,8 @@ def T5Trainer(args):
         with open(output_prediction_file, "w") as writer:
             writer.write(json.dumps(output_data, indent=4))
 
+    return timings
+
 
 def set_random_seeds(args):
     torch.manual_seed(args.seed)  # pytorch random seed
@@ -146,7 +184,7 @@ def set_random_seeds(args):
     torch.backends.cudnn.deterministic = True
 
 
-def parse_args():
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--raw_data_root', type=str, default='./../..',
                         help='the directory of the original csvs')
@@ -158,6 +196,9 @@ def parse_args():
                         help='the directory where to save the model and its checkpoints')
     parser.add_argument('--exclude_context', action='store_true',
                         help='remove dialogue history from the prompt')
+    parser.add_argument('--full_history', action='store_true',
+                        help='keep the whole dialogue history and truncate the prompt from the right, as before '
+                             '(by default only the most recent turns that fit next to the source segment are kept)')
     parser.add_argument('--lr', type=float, default=5e-5)
     parser.add_argument('--eval_acc', type=int, default=None, help='evaluate accumulation step')
     parser.add_argument('--input_len', type=int, default=512)
@@ -168,6 +209,30 @@ def parse_args():
     parser.add_argument('--weight_decay', type=float, default=0.05, help='weight decay')
     parser.add_argument('--bf16', action='store_true', help='use bf16 dtype')
     parser.add_argument('--eval_dir', type=str, default="", help='the directory of model for evaluation')
+    parser.add_argument('--memory_efficient_gat', action='store_true',
+                        help='compute GAT attention scores without building the N x N x 2d pair tensor')
+    parser.add_argument('--node_store_dir', type=str, default="",
+                        help='with --eval_dir, cache the node embeddings of each node text in this directory')
+    parser.add_argument('--cache_dir', type=str, default="",
+                        help='directory for the pre-tokenised dataset caches, empty to tokenise on the fly')
+    parser.add_argument('--tokenize_num_proc', type=int, default=1,
+                        help='processes used to build the token caches (the fast tokenizer is already multi-threaded)')
+    parser.add_argument('--dynamic_padding', action='store_true',
+                        help='pad each batch to its longest item and its largest graph instead of the max lengths')
+    parser.add_argument('--mask_padded_nodes', action='store_true',
+                        help='mask padded graph nodes in the GAT and the fusion and cut the graphs of each batch to '
+                             'its largest one (saved with the checkpoint, changes the outputs of earlier checkpoints)')
+    parser.add_argument('--group_by_length', action='store_true',
+                        help='batch training items of similar length together (use with --dynamic_padding)')
+    parser.add_argument('--gradient_checkpointing', action='store_true',
+                        help='recompute the activations of the T5 blocks (both encoder passes and the decoder), the '
+                             'GAT and the graph fusion in the backward pass, to train with larger batches')
+    parser.add_argument('--quantize', action='store_true',
+                        help='with --eval_dir, evaluate with int8 dynamic quantisation of the linear layers (CPU only)')
+    parser.add_argument('--profile_stages', action='store_true',
+                        help='time the text encode, node encode, node gather, GAT and fusion stages of the encoder '
+                             '(with CUDA syncs) and log them per step, also to stage_timings.json in the output dir')
+    parser.add_argument('--report_to', type=str, default="wandb", help='integration to report results to, or none')
 
     parser.add_argument('--language', default='en-de', help='language pair for data loader')
     parser.add_argument('--model', type=str, default='declare-lab/flan-alpaca-base')
@@ -182,7 +247,11 @@ def parse_args():
     # parser.add_argument('--bs', type=int, default=4)
     # parser.add_argument('--eval_bs', type=int, default=4)
 
-    args = parser.parse_args()
+    return parser
+
+
+def parse_args():
+    args = build_parser().parse_args()
 
     print("args", args)
     print('====Input Arguments====')
@@ -0,0 +1,142 @@
+"""
+Train or evaluate models for several languages in one launch (replaces looping over train_model.py in
+train_models.sh).
+
+The tokenizer and the base checkpoint are loaded once per process. For training every language starts from a copy
+of the base model; for evaluation the weights of each language's checkpoint are loaded into the model that is already
+built (safetensors checkpoints are memory mapped). With --cache_dir the datasets are served from their cache files
+after the first launch. Languages run one after the other in this process (--jobs 1) or --jobs at a time in worker
+processes that share --cores CPU threads. All other arguments are those of train_model.py, e.g.:
+    python train_models.py --languages en-de en-fr en-nl en-pt --mode eval --cache_dir ./../cache \
+        --eval_dir_template ./../experiments/with_dialogue_history/{language}_declare-lab-flan-alpaca-base_ep50
+"""
+
+import copy
+import os
+import re
+import time
+from multiprocessing import get_context
+
+import torch
+from transformers import T5Config
+from transformers.modeling_utils import load_sharded_checkpoint, load_state_dict
+from transformers.utils import SAFE_WEIGHTS_NAME, WEIGHTS_NAME
+
+from train_model import T5Trainer, build_parser, create_tokenizer, load_model, set_random_seeds
+
+STAGES = ["dataset", "model", "train", "generate"]
+# config entries that do not change the architecture
+IGNORED_CONFIG_KEYS = {"_name_or_path", "architectures", "transformers_version", "torch_dtype"}
+
+_tokenizer, _model = None, None
+
+
+def same_architecture(model, checkpoint):
+    config = T5Config.from_pretrained(checkpoint).to_dict()
+    loaded = model.config.to_dict()
+
+    return all(config.get(key) == loaded.get(key) for key in (set(config) | set(loaded)) - IGNORED_CONFIG_KEYS)
+
+
+def load_weights(model, checkpoint):
+    """Load the weights saved by train_model.py in checkpoint into a model of the same architecture."""
+    for name in [SAFE_WEIGHTS_NAME, WEIGHTS_NAME]:
+        path = os.path.join(checkpoint, name)
+        if os.path.exists(path):
+            result = model.load_state_dict(load_state_dict(path), strict=False)
+            break
+    else:
+        result = load_sharded_checkpoint(model, checkpoint, strict=False)
+
+    missing = [key for key in result.missing_keys
+               if not any(re.search(pattern, key) for pattern in model._keys_to_ignore_on_load_missing)]
+    if len(missing) > 0:
+        raise ValueError(f"{checkpoint} has no weights for {missing[:5]}")
+    model.tie_weights()
+
+    return model
+
+
+def language_args(args, language):
+    args = copy.deepcopy(args)
+    args.language = language
+    args.output_dir = os.path.join(args.output_dir, language)
+    if args.mode == "eval":
+        args.eval_dir = args.eval_dir_template.format(language=language)
+
+    return args
+
+
+def setup(args, num_threads):
+    """Load what every language shares, once per process."""
+    global _tokenizer, _model
+    # the graph layers the base checkpoint lacks are initialised here, with the seed train_model.py would use
+    set_random_seeds(args)
+    torch.set_num_threads(num_threads)
+    os.environ["RAYON_RS_NUM_CPUS"] = str(num_threads)  # threads of the fast tokenizer
+
+    _tokenizer = create_tokenizer(args.model)
+    if args.mode == "train":
+        _model = load_model(args, args.model, _tokenizer)
+
+
+def run_language(args):
+    """Train or evaluate one language with the shared tokenizer and model; returns (language, stage timings)."""
+    global _model
+    start = time.perf_counter()
+    if args.mode == "train":
+        model = copy.deepcopy(_model)
+    elif _model is not None and same_architecture(_model, args.eval_dir):
+        model = load_weights(_model, args.eval_dir)
+    else:
+        model = _model = load_model(args, args.eval_dir, _tokenizer)
+    weights = time.perf_counter() - start
+
+    timings = T5Trainer(args, tokenizer=_tokenizer, model=model)
+    timings["model"] += weights
+    if args.report_to == "wandb":
+        import wandb
+
+        wandb.finish()  # one run per language
+
+    return args.language, timings
+
+
+def main():
+    parser = build_parser()
+    parser.add_argument('--languages', nargs="+", default=["en-de", "en-fr", "en-nl", "en-pt"])
+    parser.add_argument('--mode', choices=["train", "eval"], default="train")
+    parser.add_argument('--eval_dir_template', type=str, default="",
+                        help='with --mode eval, checkpoint of each language, with {language} in place of the pair')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='languages run at the same time, each in its own process; 1 runs them in this process')
+    parser.add_argument('--cores', type=int, default=os.cpu_count(), help='CPU threads shared by all jobs')
+    args = parser.parse_args()
+    if args.mode == "eval" and "{language}" not in args.eval_dir_template:
+        parser.error("--mode eval needs an --eval_dir_template containing {language}")
+
+    start = time.perf_counter()
+    tasks = [language_args(args, language) for language in args.languages]
+    num_threads = max(1, args.cores // args.jobs)
+    if args.jobs == 1:
+        setup(args, num_threads)
+        startup = time.perf_counter() - start
+        results = [run_language(task) for task in tasks]
+    else:
+        # every worker loads the shared state once and then takes languages as they come
+        with get_context("spawn").Pool(args.jobs, initializer=setup, initargs=(args, num_threads)) as pool:
+            results = pool.map(run_language, tasks, chunksize=1)
+    total = time.perf_counter() - start
+
+    print(f"\n{'language':<10}" + "".join(f"{stage:>10}" for stage in STAGES) + f"{'total':>10}")
+    for language, timings in results:
+        print(f"{language:<10}" + "".join(f"{timings.get(stage, 0.0):>9.1f}s" for stage in STAGES)
+              + f"{sum(timings.values()):>9.1f}s")
+    generation = sum(timings.get("generate", 0.0) for _, timings in results)
+    setup_time = f"shared setup {startup:.1f}s" if args.jobs == 1 else "shared setup in every worker"
+    print(f"{len(results)} languages in {total:.1f}s with {args.jobs} job(s) of {num_threads} thread(s); "
+          f"{setup_time}, generation {generation:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
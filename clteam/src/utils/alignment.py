@@ -0,0 +1,192 @@
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+
+from utils.array_store import load_arrays, save_arrays
+
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:
+    from fuzzywuzzy import fuzz
+
+    process = None
+
+ALIGNMENT_VERSION = 1
+
+# how an utterance of the raw data is aligned to the utterances after prompting
+UNMATCHED = 0
+MATCHED = 1  # similar enough to one utterance after prompting (or the first of two merged into one)
+MERGED = 2  # second of two raw utterances merged into one utterance after prompting
+SAME_LENGTH = 3  # dialogue of the same length after prompting, aligned one to one without comparing
+
+
+def clean_text(text):
+    if text.startswith("NAME-M_TEXT:"):
+        text = text[12:]
+
+    return text
+
+
+def triples_text(prompted_utt):
+    """Translated triples of an utterance after prompting as text, None when they have not been translated."""
+    if any("translated_triple" not in trip for trip in prompted_utt["triples"]):
+        return None
+
+    return " ".join([trip["translated_triple"].replace("_", " ") for trip in prompted_utt["triples"]])
+
+
+def own_text(og_utt):
+    """Text to compare a raw utterance with (as the greedy matching compared it), None if it comes from the triples."""
+    if og_utt["source_language"] == "en":
+        return clean_text(og_utt["source"])
+    if "reference" in og_utt.keys():
+        return clean_text(og_utt["reference"])
+
+    return None
+
+
+def ratio(text1, text2):
+    return int(round(fuzz.ratio(text1, text2)))
+
+
+def score_matrix(queries, choices):
+    """fuzz.ratio of every query against every choice, rounded like fuzzywuzzy, in one batched call with rapidfuzz."""
+    if len(queries) == 0 or len(choices) == 0:
+        return np.zeros((len(queries), len(choices)))
+    if process is not None:
+        return np.rint(process.cdist(queries, choices, scorer=fuzz.ratio))
+
+    return np.array([[ratio(query, choice) for choice in choices] for query in queries], dtype=float)
+
+
+def _scores(og, prompted, texts):
+    """
+    Similarity of every raw utterance i (single[i, j]) and of raw utterances i and i + 1 together (merged[i, j]) with
+    every utterance j after prompting. Raw utterances without their own text use the triples of the utterance they are
+    compared with (of j + 1 for the second of a merged pair), as match_utterances always did, and cannot match
+    utterances whose triples have not been translated.
+    """
+    n, m = len(og), len(texts)
+    own = [own_text(og_utt) for og_utt in og]
+    from_triples = [triples_text(prompted_utt) for prompted_utt in prompted]
+    from_triples = [clean_text(text) if text is not None else None for text in from_triples]
+
+    single = np.zeros((n, m))
+    rows = [i for i in range(n) if own[i] is not None]
+    single[rows] = score_matrix([own[i] for i in rows], texts)
+    own_triples = np.array([ratio(from_triples[j], texts[j]) if from_triples[j] is not None else 0
+                            for j in range(m)], dtype=float)
+    for i in range(n):
+        if own[i] is None:
+            single[i] = own_triples
+
+    merged = np.full((n, m), -1.0)
+    rows = [i for i in range(n - 1) if own[i] is not None and own[i + 1] is not None]
+    merged[rows] = score_matrix([own[i] + own[i + 1] for i in rows], texts)
+    for i in range(n - 1):
+        if own[i] is None or own[i + 1] is None:
+            for j in range(m - 1 if own[i + 1] is None else m):
+                first = own[i] if own[i] is not None else from_triples[j]
+                second = own[i + 1] if own[i + 1] is not None else from_triples[j + 1]
+                if first is not None and second is not None:
+                    merged[i, j] = ratio(first + second, texts[j])
+
+    return single, merged
+
+
+def align_dialogue(og, prompted, threshold=95):
+    """
+    Monotone alignment of the raw utterances of a dialogue to its utterances after prompting.
+
+    Raw utterances can be skipped, utterances after prompting can be left unused, and two consecutive raw utterances
+    can be merged into one utterance after prompting. Pairs only count when their fuzz.ratio reaches threshold; the
+    alignment with the most aligned raw utterances (then the highest total similarity) is chosen by dynamic
+    programming, so one bad comparison cannot shift the rest of the dialogue.
+
+    Returns the index after prompting (-1 when unmatched) and the kind (UNMATCHED, MATCHED, MERGED, SAME_LENGTH) of
+    every raw utterance.
+    """
+    n, m = len(og), len(prompted)
+    if n == m:
+        return list(range(n)), [SAME_LENGTH] * n
+
+    single, merged = _scores(og, prompted, [prompted_utt["text"] for prompted_utt in prompted])
+
+    # best[i][j]: (aligned raw utterances, total similarity) of og[:i] against prompted[:j]
+    best = [[(-1, 0.0)] * (m + 1) for _ in range(n + 1)]
+    step = [[None] * (m + 1) for _ in range(n + 1)]
+    best[0][0] = (0, 0.0)
+    for i in range(n + 1):
+        for j in range(m + 1):
+            count, score = best[i][j]
+            if count < 0:
+                continue
+            moves = [(i + 1, j, 0, 0.0, "skip_og"), (i, j + 1, 0, 0.0, "skip_prompted")]
+            if i < n and j < m and single[i, j] >= threshold:
+                moves.append((i + 1, j + 1, 1, single[i, j], "match"))
+            if i < n - 1 and j < m and merged[i, j] >= threshold:
+                moves.append((i + 2, j + 1, 2, merged[i, j], "merge"))
+            for next_i, next_j, gained, similarity, move in moves:
+                if next_i <= n and next_j <= m and (count + gained, score + similarity) > best[next_i][next_j]:
+                    best[next_i][next_j] = (count + gained, score + similarity)
+                    step[next_i][next_j] = (i, j, move)
+
+    indices, kinds = [-1] * n, [UNMATCHED] * n
+    i, j = n, m
+    while (i, j) != (0, 0):
+        i, j, move = step[i][j]
+        if move == "match":
+            indices[i], kinds[i] = j, MATCHED
+        elif move == "merge":
+            indices[i], kinds[i] = j, MATCHED
+            indices[i + 1], kinds[i + 1] = j, MERGED
+
+    return indices, kinds
+
+
+def align_dialogues(raw_dialogues, tripled_dialogues, threshold=95):
+    """Alignment of every raw utterance, as flat arrays over all dialogues (see align_dialogue)."""
+    indices, kinds = [], []
+    for og, post_prompt in zip(raw_dialogues, tripled_dialogues):
+        dialogue_indices, dialogue_kinds = align_dialogue(og, post_prompt["dialogue"], threshold=threshold)
+        indices.extend(dialogue_indices)
+        kinds.extend(dialogue_kinds)
+
+    return np.array(indices, dtype=np.int32), np.array(kinds, dtype=np.uint8)
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def alignment_cache_path(cache_dir, raw_path, triple_path, threshold=95):
+    """Cache file for the alignment of a CSV and JSON file, keyed on their content."""
+    key = {"version": ALIGNMENT_VERSION,
+           "threshold": threshold,
+           "raw": file_digest(raw_path),
+           "triples": file_digest(triple_path)}
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+    return Path(cache_dir) / "alignment" / f"{Path(raw_path).parent.name}_{Path(raw_path).stem}_{digest}.bin"
+
+
+def load_or_align(raw_dialogues, tripled_dialogues, cache_path=None, threshold=95):
+    """align_dialogues, read from cache_path when it has been computed before and stored there otherwise."""
+    num_utterances = sum(len(og) for og, _ in zip(raw_dialogues, tripled_dialogues))
+    if cache_path is not None and Path(cache_path).exists():
+        arrays, _ = load_arrays(cache_path)
+        if len(arrays["indices"]) == num_utterances:
+            return np.array(arrays["indices"]), np.array(arrays["kinds"])
+
+    indices, kinds = align_dialogues(raw_dialogues, tripled_dialogues, threshold=threshold)
+    if cache_path is not None:
+        save_arrays(cache_path, {"indices": indices, "kinds": kinds}, meta={"threshold": threshold})
+
+    return indices, kinds
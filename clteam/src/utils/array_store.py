@@ -0,0 +1,97 @@
+import json
+import os
+import struct
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b"CLTARR01"
+ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+@contextmanager
+def open_arrays(path, specs, meta=None):
+    """
+    Allocate a store for arrays of the given {name: (dtype, shape)} and yield writable memory maps to fill in, so large
+    stores can be written piece by piece. Layout: magic, header length, JSON header, then each array's raw bytes
+    aligned to 64 bytes. The file is written to a temporary name first and only moved into place when the block
+    exits without an error, so a crash never leaves a half written store behind.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    entries, offset = {}, 0
+    for name, (dtype, shape) in specs.items():
+        entries[name] = {"dtype": np.dtype(dtype).str, "shape": list(shape), "offset": offset}
+        offset = _aligned(offset + np.dtype(dtype).itemsize * int(np.prod(shape)))
+    header = json.dumps({"meta": meta or {}, "arrays": entries}).encode()
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.truncate(data_start + offset)
+
+    arrays = {}
+    for name, entry in entries.items():
+        shape = tuple(entry["shape"])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=np.dtype(entry["dtype"]))
+        else:
+            arrays[name] = np.memmap(tmp_path, dtype=np.dtype(entry["dtype"]), mode='r+',
+                                     offset=data_start + entry["offset"], shape=shape)
+    try:
+        yield arrays
+    except BaseException:
+        del arrays
+        os.remove(tmp_path)
+        raise
+
+    for array in arrays.values():
+        if isinstance(array, np.memmap):
+            array.flush()
+    del arrays
+    os.replace(tmp_path, path)
+
+
+def save_arrays(path, arrays, meta=None):
+    """
+    Write a dict of numpy arrays (plus a JSON serialisable meta dict) to a single file that load_arrays can memory
+    map, see open_arrays for the layout.
+    """
+    arrays = {name: np.asarray(array) for name, array in arrays.items()}
+    with open_arrays(path, {name: (array.dtype, array.shape) for name, array in arrays.items()}, meta) as out:
+        for name, array in arrays.items():
+            out[name][...] = array
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an array store")
+        header_len, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+
+    return header, _aligned(len(MAGIC) + 8 + header_len)
+
+
+def load_arrays(path):
+    """Return ({name: read-only memory mapped array}, meta) of a file written by save_arrays."""
+    header, data_start = read_header(path)
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        shape = tuple(entry["shape"])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=np.dtype(entry["dtype"]))
+        else:
+            arrays[name] = np.memmap(path, dtype=np.dtype(entry["dtype"]), mode='r',
+                                     offset=data_start + entry["offset"], shape=shape)
+
+    return arrays, header["meta"]
@@ -0,0 +1,54 @@
+from collections import namedtuple
+
+# plain copies of neuralcoref clusters: they can be sent between processes and cut to a prefix of their text
+Mention = namedtuple("Mention", ["text", "string", "start_char", "end_char"])
+Cluster = namedtuple("Cluster", ["main", "mentions"])
+
+_nlp = None
+
+
+def load_nlp():
+    """en_core_web_sm with neuralcoref, loaded on first use (once per process)."""
+    global _nlp
+    if _nlp is None:
+        import neuralcoref
+        import spacy
+
+        _nlp = spacy.load('en_core_web_sm')
+        neuralcoref.add_to_pipe(_nlp)  # Add neural coref to SpaCy's pipe
+
+    return _nlp
+
+
+def to_mention(span):
+    return Mention(span.text, span.string, span.start_char, span.end_char)
+
+
+def to_clusters(doc):
+    return [Cluster(to_mention(cluster.main), [to_mention(mention) for mention in cluster.mentions])
+            for cluster in doc._.coref_clusters]
+
+
+def clusters_up_to(clusters, end_char):
+    """
+    Clusters as they look in the text up to end_char: later mentions are dropped, clusters left with a single mention
+    are dropped, and a main mention beyond end_char is replaced by the first mention left.
+    """
+    cut = []
+    for cluster in clusters:
+        mentions = [mention for mention in cluster.mentions if mention.end_char <= end_char]
+        if len(mentions) < 2:
+            continue
+        main = cluster.main if cluster.main.end_char <= end_char else mentions[0]
+        cut.append(Cluster(main, mentions))
+
+    return cut
+
+
+def resolve(texts, batch_size=64):
+    """
+    Coreference clusters of many texts with nlp.pipe, in input order. Runs in the calling process; dialogue_to_graph
+    spreads whole shards of dialogues over worker processes that each load spaCy once (spaCy's own n_process is not
+    used because neuralcoref clusters do not survive its Doc serialisation).
+    """
+    return [to_clusters(doc) for doc in load_nlp().pipe(texts, batch_size=batch_size)]
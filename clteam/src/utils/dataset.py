@@ -2,9 +2,13 @@ import os
 import pickle
 
 import torch
+from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import Dataset
 
-from utils.utils_data import load_raw_data, load_triple_data
+from utils.alignment import alignment_cache_path
+from utils.sparse_adjacency import ADJ_EDGES_FILE, SparseAdjacency, dense_to_edges, edges_to_dense
+from utils.token_cache import TokenCache, build_token_cache, token_cache_path
+from utils.utils_data import load_raw_data, load_triple_data, raw_data_path, triple_data_path
 from utils.utils_prompt import build_train_pair, match_utterances
 
 
@@ -18,25 +22,73 @@ class ChatDatasetWithGraph(Dataset):
 
     def __init__(self, split, tokenizer, args, dry_run=False):
         self.tokenizer = tokenizer
-        self.raw_data = load_raw_data(args, split, dry_run=dry_run)
-        self.triple_data = load_triple_data(args, split, dry_run=dry_run)
         self.source_len = args.input_len
         self.summ_len = args.output_len
+        self.padding = False if args.dynamic_padding else "max_length"
+        self._lengths = None
         self.target_text = []
         self.source_text = []
         self.input_sep = []
         self.input_mat = []
+        self.max_nodes = None
+        self.token_cache = None
+
+        data_dir = os.path.join(args.data_root, split, args.language)
+        input_text_path = os.path.join(data_dir, 'mc_input_text.pkl')
+        # compact edge lists (see convert_adjacency.py), or the dense matrices of older preprocessing runs
+        adj_path = os.path.join(data_dir, ADJ_EDGES_FILE)
+        if not os.path.exists(adj_path):
+            adj_path = os.path.join(data_dir, 'mc_adj_matrix.pkl')
+
+        if args.cache_dir != "":
+            # one file with the tokens and graphs of every item: once it is written, nothing else is read or kept in
+            # memory, and items are sliced from its memory maps on demand
+            cache_path = token_cache_path(args, split, tokenizer, dry_run=dry_run,
+                                          sources=[raw_data_path(args, split, dry_run=dry_run),
+                                                   triple_data_path(args, split, dry_run=dry_run),
+                                                   input_text_path, adj_path])
+            if not cache_path.exists() or not TokenCache(cache_path).has_graphs:
+                self._build(split, args, dry_run, input_text_path, adj_path)
+                build_token_cache(cache_path, tokenizer, self.source_text, self.target_text,
+                                  [text[0] for text in self.input_sep], self.source_len, self.summ_len,
+                                  num_proc=args.tokenize_num_proc,
+                                  edge_lists=[self._edges(matrix) for matrix in self.input_mat],
+                                  max_nodes=self._graph_size())
+                self.target_text, self.source_text, self.input_sep, self.input_mat = [], [], [], []
+            self.token_cache = TokenCache(cache_path)
+            self.max_nodes = self.token_cache.max_nodes
+            print(f"Dataset ({split}) loaded from {cache_path}: {len(self)} items\n")
+            return
+
+        self._build(split, args, dry_run, input_text_path, adj_path)
 
-        with open(os.path.join(args.data_root, split, args.language, 'mc_input_text.pkl'), 'rb') as f:
+    def _build(self, split, args, dry_run, input_text_path, adj_path):
+        """Read the raw and prompted dialogues and the graphs, and build the prompt of every matched utterance."""
+        self.raw_data = load_raw_data(args, split, dry_run=dry_run)
+        self.triple_data = load_triple_data(args, split, dry_run=dry_run)
+
+        with open(input_text_path, 'rb') as f:
             self.got_input_text_list = pickle.load(f)
-        with open(os.path.join(args.data_root, split, args.language, 'mc_adj_matrix.pkl'), 'rb') as f:
-            self.got_adj_matrix_list = pickle.load(f)
+        if adj_path.endswith(ADJ_EDGES_FILE):
+            self.got_adj_matrix_list = SparseAdjacency(adj_path)
+            self.max_nodes = self.got_adj_matrix_list.max_nodes
+        else:
+            with open(adj_path, 'rb') as f:
+                self.got_adj_matrix_list = pickle.load(f)
+            self.max_nodes = None
 
+        alignment_path = None
+        if args.cache_dir != "":
+            alignment_path = alignment_cache_path(args.cache_dir, raw_data_path(args, split, dry_run=dry_run),
+                                                  triple_data_path(args, split, dry_run=dry_run))
         self.data = match_utterances(self.raw_data, self.triple_data,
-                                     self.got_input_text_list, self.got_adj_matrix_list)
+                                     self.got_input_text_list, self.got_adj_matrix_list, cache_path=alignment_path)
 
+        # the dialogue history is cut to the tokens left next to the source segment, unless asked for in full
+        history_tokenizer = None if args.full_history else self.tokenizer
         for og in self.data:
-            source, target, separator, matrix = build_train_pair(og, args.exclude_context)
+            source, target, separator, matrix = build_train_pair(og, args.exclude_context, history_tokenizer,
+                                                                 self.source_len)
             self.target_text.extend(target)
             self.source_text.extend(source)
             self.input_sep.extend(separator)
@@ -48,10 +100,71 @@ class ChatDatasetWithGraph(Dataset):
               f"matched text: {len(self.target_text)}, and matched graphs: {len(self.input_sep)}")
         print("\n")
 
+        if args.cache_dir != "":
+            # everything needed from here on goes into the token cache
+            del self.raw_data, self.triple_data, self.data, self.got_input_text_list, self.got_adj_matrix_list
+
+    def _edges(self, matrix):
+        return matrix if self.max_nodes is not None else dense_to_edges(matrix)
+
+    def _graph_size(self):
+        if self.max_nodes is not None:
+            return self.max_nodes
+
+        return max([len(matrix) for matrix in self.input_mat], default=1)
+
     def __len__(self):
+        if self.token_cache is not None:
+            return len(self.token_cache)
+
         return len(self.target_text)
 
+    @property
+    def lengths(self):
+        """Number of encoder tokens (source and node text) of every item, used to group items of similar length."""
+        if self._lengths is None and self.token_cache is not None:
+            self._lengths = (self.token_cache.lengths("source") + self.token_cache.lengths("nodes")).tolist()
+        elif self._lengths is None:
+            source = self.tokenizer([" ".join(str(text).split()) for text in self.source_text],
+                                    max_length=self.source_len, truncation=True)
+            nodes = self.tokenizer([text[0] for text in self.input_sep], max_length=self.source_len, truncation=True)
+            self._lengths = [len(s) + len(n) for s, n in zip(source["input_ids"], nodes["input_ids"])]
+
+        return self._lengths
+
+    def _adjacency(self, index):
+        matrix = self.token_cache.edges(index) if self.token_cache is not None else self.input_mat[index]
+        if self.max_nodes is None:
+            return {"got_adj_matrix": torch.tensor(matrix)}
+        if self.padding is False:
+            # densified per batch by GraphDataCollator
+            return {"got_adj_edges": torch.from_numpy(matrix.astype("int64"))}
+
+        return {"got_adj_matrix": edges_to_dense(matrix, self.max_nodes)}
+
+    def _from_cache(self, field, index, max_length):
+        ids = torch.from_numpy(self.token_cache.get(field, index).astype("int64"))
+        mask = torch.ones_like(ids)
+        if self.padding == "max_length":
+            ids = torch.nn.functional.pad(ids, (0, max_length - len(ids)), value=self.tokenizer.pad_token_id)
+            mask = torch.nn.functional.pad(mask, (0, max_length - len(mask)), value=0)
+
+        return ids, mask
+
     def __getitem__(self, index):
+        if self.token_cache is not None:
+            source_ids, source_mask = self._from_cache("source", index, self.source_len)
+            target_ids, _ = self._from_cache("target", index, self.summ_len)
+            got_input_ids, got_mask = self._from_cache("nodes", index, self.source_len)
+
+            return {"input_ids": source_ids,
+                    "attention_mask": source_mask,
+                    "labels": target_ids.tolist(),
+                    "got_input_ids": got_input_ids,
+                    "got_mask": got_mask,
+                    **self._adjacency(index),
+                    }
+
         source_text = str(self.source_text[index])
         target_text = str(self.target_text[index])
 
@@ -60,43 +173,98 @@ class ChatDatasetWithGraph(Dataset):
         target_text = " ".join(target_text.split())
 
         got_input_text = self.input_sep[index]
-        got_adj_matrix = self.input_mat[index]
-        got_adj_matrix = torch.tensor(got_adj_matrix)
 
         source = self.tokenizer.batch_encode_plus([source_text],
                                                   max_length=self.source_len,
-                                                  pad_to_max_length=True,
                                                   truncation=True,
-                                                  padding="max_length",
+                                                  padding=self.padding,
                                                   return_tensors="pt",
                                                   )
         target = self.tokenizer.batch_encode_plus([target_text],
                                                   max_length=self.summ_len,
-                                                  pad_to_max_length=True,
                                                   truncation=True,
-                                                  padding="max_length",
+                                                  padding=self.padding,
                                                   return_tensors="pt",
                                                   )
 
         encoded_got_input_text = self.tokenizer.batch_encode_plus(got_input_text,
                                                                   max_length=self.source_len,
-                                                                  pad_to_max_length=True,
                                                                   truncation=True,
-                                                                  padding="max_length",
+                                                                  padding=self.padding,
                                                                   return_tensors="pt",
                                                                   )
 
-        source_ids = source["input_ids"].squeeze()
-        source_mask = source["attention_mask"].squeeze()
-        target_ids = target["input_ids"].squeeze().tolist()
+        source_ids = source["input_ids"].squeeze(0)
+        source_mask = source["attention_mask"].squeeze(0)
+        target_ids = target["input_ids"].squeeze(0).tolist()
 
-        encoded_got_input_text_ids = encoded_got_input_text["input_ids"].squeeze()
-        encoded_got_input_text_mask = encoded_got_input_text["attention_mask"].squeeze()
+        encoded_got_input_text_ids = encoded_got_input_text["input_ids"].squeeze(0)
+        encoded_got_input_text_mask = encoded_got_input_text["attention_mask"].squeeze(0)
 
         return {"input_ids": source_ids,
                 "attention_mask": source_mask,
                 "labels": target_ids,
-                "got_adj_matrix": got_adj_matrix,
                 "got_input_ids": encoded_got_input_text_ids,
                 "got_mask": encoded_got_input_text_mask,
+                **self._adjacency(index),
                 }
+
+
+class GraphDataCollator:
+    """
+    Pad the items of ChatDatasetWithGraph (built with dynamic padding) to the longest item of the batch.
+
+    Text fields are padded with the pad token (labels with label_pad_token_id), and the adjacency matrices are cut
+    to the largest node count in the batch: the number of <s> tokens in the node text, or the highest node index
+    with an edge if that is larger. Items with edge lists (got_adj_edges) are densified at that size directly.
+    """
+
+    def __init__(self, tokenizer, s_token_id, label_pad_token_id=-100, pad_to_multiple_of=None):
+        self.pad_token_id = tokenizer.pad_token_id
+        self.s_token_id = s_token_id
+        self.label_pad_token_id = label_pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def _pad(self, sequences, padding_value):
+        sequences = [torch.as_tensor(seq, dtype=torch.long) for seq in sequences]
+        padded = pad_sequence(sequences, batch_first=True, padding_value=padding_value)
+        if self.pad_to_multiple_of is not None and padded.shape[1] % self.pad_to_multiple_of != 0:
+            extra = self.pad_to_multiple_of - padded.shape[1] % self.pad_to_multiple_of
+            padded = torch.nn.functional.pad(padded, (0, extra), value=padding_value)
+
+        return padded
+
+    def num_nodes(self, feature):
+        num_nodes = int(torch.as_tensor(feature["got_input_ids"]).eq(self.s_token_id).sum())
+        if "got_adj_edges" in feature:
+            edges = feature["got_adj_edges"]
+            if len(edges) > 0:
+                num_nodes = max(num_nodes, int(edges.max()) + 1)
+        else:
+            adj = torch.as_tensor(feature["got_adj_matrix"])
+            used = adj.ne(0).any(dim=0) | adj.ne(0).any(dim=1)
+            if used.any():
+                num_nodes = max(num_nodes, int(used.nonzero().max()) + 1)
+
+        return num_nodes
+
+    def __call__(self, features):
+        batch = {"input_ids": self._pad([f["input_ids"] for f in features], self.pad_token_id),
+                 "attention_mask": self._pad([f["attention_mask"] for f in features], 0),
+                 "got_input_ids": self._pad([f["got_input_ids"] for f in features], self.pad_token_id),
+                 "got_mask": self._pad([f["got_mask"] for f in features], 0)}
+        if "labels" in features[0]:
+            batch["labels"] = self._pad([f["labels"] for f in features], self.label_pad_token_id)
+
+        num_nodes = max(1, max(self.num_nodes(f) for f in features))
+        adj_matrices = []
+        for f in features:
+            if "got_adj_edges" in f:
+                adj_matrices.append(edges_to_dense(f["got_adj_edges"], num_nodes))
+                continue
+            adj = torch.as_tensor(f["got_adj_matrix"])[:num_nodes, :num_nodes]
+            adj_matrices.append(torch.nn.functional.pad(adj, (0, num_nodes - adj.shape[1], 0,
+                                                              num_nodes - adj.shape[0])))
+        batch["got_adj_matrix"] = torch.stack(adj_matrices)
+
+        return batch
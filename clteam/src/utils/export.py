@@ -0,0 +1,319 @@
+import inspect
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from utils.dataset import GraphDataCollator
+
+FORMATS = {"onnx": ".onnx", "torchscript": ".pt"}
+ENCODER_INPUTS = ["input_ids", "attention_mask", "got_input_ids", "got_mask", "got_adj_matrix"]
+
+
+class EncoderForExport(nn.Module):
+    """The text and graph encoder as a function of tensors only: text tokens, node tokens and adjacency."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.encoder
+        self.train(model.training)  # exporters restore the mode of the wrapper, and with it that of the model
+
+    def forward(self, input_ids, attention_mask, got_input_ids, got_mask, got_adj_matrix):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, got_input_ids=got_input_ids,
+                            got_mask=got_mask, got_adj_matrix=got_adj_matrix, return_dict=False)[0]
+
+
+class DecoderForExport(nn.Module):
+    """
+    One decoding step: the logits of the last position and the key/value states of every layer.
+
+    Without past (the first step), the self and cross attention states of every layer are returned (4 per layer). With
+    past, the 4 states per layer are inputs and only the updated self attention states are returned (2 per layer),
+    the cross attention states do not change.
+    """
+
+    def __init__(self, model, with_past):
+        super().__init__()
+        self.model = model
+        self.with_past = with_past
+        self.train(model.training)
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask, *past):
+        past_key_values = None
+        if self.with_past:
+            past_key_values = tuple(tuple(past[4 * i:4 * i + 4]) for i in range(len(past) // 4))
+        logits, presents = self.model(encoder_outputs=(encoder_hidden_states,), attention_mask=encoder_attention_mask,
+                                      decoder_input_ids=decoder_input_ids, past_key_values=past_key_values,
+                                      use_cache=True, return_dict=False)[:2]
+        states = [state for layer in presents for state in (layer[:2] if self.with_past else layer)]
+
+        return (logits[:, -1],) + tuple(states)
+
+
+def past_names(num_layers, prefix):
+    return [f"{prefix}.{i}.{name}" for i in range(num_layers) for name in ["self_key", "self_value",
+                                                                           "cross_key", "cross_value"]]
+
+
+def example_inputs(model, batch_size=2, text_len=12, node_len=10, num_nodes=4):
+    """Small random inputs to trace with; every dimension differs so that none is mistaken for another."""
+    vocab_size = model.config.vocab_size
+    input_ids = torch.randint(2, vocab_size, (batch_size, text_len))
+    got_input_ids = torch.randint(2, vocab_size, (batch_size, node_len))
+    got_input_ids[:, 0:node_len:3] = model.encoder.s_token_id
+    adjacency = torch.eye(num_nodes).expand(batch_size, num_nodes, num_nodes).contiguous()
+
+    return (input_ids, torch.ones_like(input_ids), got_input_ids, torch.ones_like(got_input_ids), adjacency)
+
+
+def _export(module, inputs, path, input_names, output_names, dynamic_axes, fmt):
+    if fmt == "torchscript":
+        torch.jit.save(torch.jit.trace(module, inputs, check_trace=False), str(path))
+        return
+
+    options = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        options["dynamo"] = False  # dynamic_axes are an option of the TorchScript based exporter
+    torch.onnx.export(module, inputs, str(path), input_names=input_names, output_names=output_names,
+                      dynamic_axes=dynamic_axes, opset_version=17, do_constant_folding=True, **options)
+
+
+@torch.no_grad()
+def export_model(model, output_dir, fmt="onnx"):
+    """
+    Export the encoder and the decoder (first step, and later steps with past) of a T5GenerationWithGraph to
+    output_dir as ONNX or TorchScript, with dynamic batch, sequence and node axes, plus the config ExportedTranslator
+    needs. The node text is encoded on every call; a NodeEmbeddingStore cannot be exported.
+    """
+    if model.encoder.node_store is not None:
+        raise ValueError("Remove the node store before exporting, its lookups cannot be traced")
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    model = model.float().eval()
+    # with key is value, MultiheadAttention projects both with one packed matmul whose split the ONNX exporter ties
+    # to the number of nodes seen while tracing; a distinct (identical) value tensor takes the other path
+    hook = model.encoder.mha_layer_got.register_forward_pre_hook(
+        lambda module, args: args[:2] + (args[2].view_as(args[2]),) + args[3:] if args[1] is args[2] else None)
+    num_layers, suffix = model.config.num_decoder_layers, FORMATS[fmt]
+
+    inputs = example_inputs(model)
+    text_axes, node_axes = {0: "batch", 1: "text"}, {0: "batch", 1: "node_text"}
+    _export(EncoderForExport(model), inputs, output_dir / f"encoder{suffix}", ENCODER_INPUTS,
+            ["encoder_hidden_states"],
+            {"input_ids": text_axes, "attention_mask": text_axes, "got_input_ids": node_axes,
+             "got_mask": node_axes, "got_adj_matrix": {0: "batch", 1: "nodes", 2: "nodes"},
+             "encoder_hidden_states": text_axes}, fmt)
+
+    hidden_states, encoder_mask = model.encoder(*inputs[:2], got_input_ids=inputs[2], got_mask=inputs[3],
+                                                got_adj_matrix=inputs[4], return_dict=False)[0], inputs[1]
+    decoder_input_ids = torch.full((inputs[0].shape[0], 3), model.config.decoder_start_token_id)
+    init_outputs = DecoderForExport(model, with_past=False)(decoder_input_ids, hidden_states, encoder_mask)
+    presents = past_names(num_layers, "present")
+    past_axes = {name: ({0: "batch", 2: "past"} if "self" in name else {0: "batch", 2: "text"})
+                 for name in past_names(num_layers, "past") + presents}
+    step_axes = {"decoder_input_ids": {0: "batch", 1: "target"}, "encoder_hidden_states": text_axes,
+                 "encoder_attention_mask": text_axes, "logits": {0: "batch"}}
+    _export(DecoderForExport(model, with_past=False), (decoder_input_ids, hidden_states, encoder_mask),
+            output_dir / f"decoder_init{suffix}", ["decoder_input_ids", "encoder_hidden_states",
+                                                   "encoder_attention_mask"],
+            ["logits"] + presents, {**step_axes, **past_axes}, fmt)
+
+    self_presents = [name for name in presents if "self" in name]
+    _export(DecoderForExport(model, with_past=True), (decoder_input_ids[:, -1:], hidden_states, encoder_mask,
+                                                      *init_outputs[1:]),
+            output_dir / f"decoder_with_past{suffix}", ["decoder_input_ids", "encoder_hidden_states",
+                                                        "encoder_attention_mask"] + past_names(num_layers, "past"),
+            ["logits"] + self_presents, {**step_axes, **past_axes}, fmt)
+
+    hook.remove()
+    config = {"format": fmt, "num_layers": num_layers, "s_token_id": model.encoder.s_token_id,
+              "decoder_start_token_id": model.config.decoder_start_token_id,
+              "eos_token_id": model.config.eos_token_id, "pad_token_id": model.config.pad_token_id}
+    with open(output_dir / "export_config.json", 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+class _OnnxGraph:
+    def __init__(self, path, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        self.input_names = [graph_input.name for graph_input in self.session.get_inputs()]
+
+    def __call__(self, *inputs):
+        feed = {name: value.numpy() for name, value in zip(self.input_names, inputs)}
+        return tuple(torch.from_numpy(output) for output in self.session.run(None, feed))
+
+
+class _TorchGraph:
+    def __init__(self, module):
+        self.module = module
+
+    @torch.no_grad()
+    def __call__(self, *inputs):
+        outputs = self.module(*inputs)
+        return outputs if isinstance(outputs, tuple) else (outputs,)
+
+
+class ExportedTranslator:
+    """
+    Greedy and beam search decoding with the graphs written by export_model, on CPU.
+
+    Takes ChatDatasetWithGraph items like T5GenerationWithGraph.translate: they are sorted by length, padded per
+    batch, encoded once per batch and decoded with the past key values. from_model builds the same translator on
+    the eager modules, to check exported graphs against.
+    """
+
+    def __init__(self, encoder, decoder_init, decoder_with_past, config):
+        self.encoder = encoder
+        self.decoder_init = decoder_init
+        self.decoder_with_past = decoder_with_past
+        self.config = config
+
+    @classmethod
+    def load(cls, export_dir, num_threads=None):
+        export_dir = Path(export_dir)
+        with open(export_dir / "export_config.json", 'r') as f:
+            config = json.load(f)
+        suffix = FORMATS[config["format"]]
+        if config["format"] == "onnx":
+            graphs = [_OnnxGraph(export_dir / f"{name}{suffix}", num_threads)
+                      for name in ["encoder", "decoder_init", "decoder_with_past"]]
+        else:
+            graphs = [_TorchGraph(torch.jit.load(str(export_dir / f"{name}{suffix}")))
+                      for name in ["encoder", "decoder_init", "decoder_with_past"]]
+
+        return cls(*graphs, config)
+
+    @classmethod
+    def from_model(cls, model):
+        model = model.float().eval()
+        config = {"format": "eager", "num_layers": model.config.num_decoder_layers,
+                  "s_token_id": model.encoder.s_token_id,
+                  "decoder_start_token_id": model.config.decoder_start_token_id,
+                  "eos_token_id": model.config.eos_token_id, "pad_token_id": model.config.pad_token_id}
+
+        return cls(_TorchGraph(EncoderForExport(model)), _TorchGraph(DecoderForExport(model, with_past=False)),
+                   _TorchGraph(DecoderForExport(model, with_past=True)), config)
+
+    def encode(self, batch):
+        return self.encoder(*[batch[name] if name != "got_adj_matrix" else batch[name].float()
+                              for name in ENCODER_INPUTS])[0]
+
+    def translate(self, tokenizer, items, batch_size=8, max_length=64, num_beams=1, length_penalty=1.0,
+                  sort_by_length=True):
+        from utils.model import T5GenerationWithGraph
+
+        collator = GraphDataCollator(tokenizer, self.config["s_token_id"])
+        items = [T5GenerationWithGraph._strip_padding(item) for item in items]
+        order = list(range(len(items)))
+        if sort_by_length:
+            order.sort(key=lambda i: len(items[i]["input_ids"]) + len(items[i]["got_input_ids"]))
+
+        translations = [None] * len(items)
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            batch = collator([items[i] for i in indices])
+            hidden_states = self.encode(batch)
+            if num_beams == 1:
+                output = self.greedy(hidden_states, batch["attention_mask"], max_length)
+            else:
+                output = self.beam_search(hidden_states, batch["attention_mask"], max_length, num_beams,
+                                          length_penalty)
+            for i, text in zip(indices, tokenizer.batch_decode(output, skip_special_tokens=True)):
+                translations[i] = text.strip()
+
+        return translations
+
+    def _step(self, tokens, hidden_states, mask, past):
+        if past is None:
+            outputs = self.decoder_init(tokens, hidden_states, mask)
+            return outputs[0], list(outputs[1:])
+
+        outputs = self.decoder_with_past(tokens[:, -1:], hidden_states, mask, *past)
+        # new self attention states, and the cross attention states of the first step
+        past = [outputs[1 + 2 * (i // 4) + i % 4] if i % 4 < 2 else past[i] for i in range(len(past))]
+
+        return outputs[0], past
+
+    def greedy(self, hidden_states, mask, max_length):
+        """Token ids (with the start token) of greedy decoding, like generate with num_beams=1."""
+        eos, pad = self.config["eos_token_id"], self.config["pad_token_id"]
+        tokens = torch.full((hidden_states.shape[0], 1), self.config["decoder_start_token_id"], dtype=torch.long)
+        finished = torch.zeros(hidden_states.shape[0], dtype=torch.bool)
+        past = None
+        while tokens.shape[1] < max_length and not finished.all():
+            logits, past = self._step(tokens, hidden_states, mask, past)
+            next_tokens = logits.argmax(dim=-1).masked_fill(finished, pad)
+            tokens = torch.cat([tokens, next_tokens.unsqueeze(-1)], dim=1)
+            finished |= next_tokens.eq(eos)
+
+        return tokens
+
+    def beam_search(self, hidden_states, mask, max_length, num_beams, length_penalty=1.0):
+        """
+        Token ids of the best beam of every item. Finished hypotheses are scored by their summed log probabilities
+        divided by length ** length_penalty, and an item stops once num_beams hypotheses are finished and no running
+        beam can beat the worst of them.
+        """
+        eos, pad = self.config["eos_token_id"], self.config["pad_token_id"]
+        batch_size = hidden_states.shape[0]
+        hidden_states = hidden_states.repeat_interleave(num_beams, dim=0)
+        mask = mask.repeat_interleave(num_beams, dim=0)
+        tokens = torch.full((batch_size * num_beams, 1), self.config["decoder_start_token_id"], dtype=torch.long)
+        beam_scores = torch.zeros(batch_size, num_beams)
+        beam_scores[:, 1:] = -1e9  # all beams start the same, only the first one is expanded
+        beam_scores = beam_scores.view(-1)
+        finished = [[] for _ in range(batch_size)]  # (score, tokens) of finished hypotheses
+        done = [False] * batch_size
+        past = None
+
+        while tokens.shape[1] < max_length and not all(done):
+            logits, past = self._step(tokens, hidden_states, mask, past)
+            scores = F.log_softmax(logits.float(), dim=-1) + beam_scores.unsqueeze(-1)
+            vocab_size = scores.shape[-1]
+            top_scores, top_ids = scores.view(batch_size, -1).topk(2 * num_beams, dim=1)
+
+            next_scores, next_tokens, next_beams = [], [], []
+            for b in range(batch_size):
+                candidates = []
+                if not done[b]:
+                    for score, index in zip(top_scores[b].tolist(), top_ids[b].tolist()):
+                        beam, token = b * num_beams + index // vocab_size, index % vocab_size
+                        if token == eos:
+                            finished[b].append((score / tokens.shape[1] ** length_penalty, tokens[beam].tolist()))
+                            finished[b] = sorted(finished[b], reverse=True)[:num_beams]
+                        else:
+                            candidates.append((score, token, beam))
+                        if len(candidates) == num_beams:
+                            break
+                    best_running = candidates[0][0] / tokens.shape[1] ** length_penalty
+                    done[b] = len(finished[b]) == num_beams and finished[b][-1][0] >= best_running
+                if done[b]:
+                    candidates = [(-1e9, pad, b * num_beams)] * num_beams
+                for score, token, beam in candidates:
+                    next_scores.append(score)
+                    next_tokens.append(token)
+                    next_beams.append(beam)
+
+            beams = torch.tensor(next_beams)
+            tokens = torch.cat([tokens[beams], torch.tensor(next_tokens).unsqueeze(-1)], dim=1)
+            beam_scores = torch.tensor(next_scores)
+            past = [state[beams] for state in past]
+
+        outputs = []
+        for b in range(batch_size):
+            if not done[b]:
+                for k in range(num_beams):
+                    beam = b * num_beams + k
+                    score = beam_scores[beam].item() / tokens.shape[1] ** length_penalty
+                    finished[b].append((score, tokens[beam].tolist()))
+            outputs.append(torch.tensor(max(finished[b])[1]))
+
+        return torch.nn.utils.rnn.pad_sequence(outputs, batch_first=True, padding_value=pad)
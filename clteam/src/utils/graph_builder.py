@@ -0,0 +1,95 @@
+from collections import namedtuple
+
+import numpy as np
+
+# nodes: node strings of every graph (at most max_nodes), node_text: the "<s> node </s> <s> node" input of every graph,
+# adjacency: in the format asked for, see build_graphs
+Graphs = namedtuple("Graphs", ["nodes", "node_text", "adjacency"])
+
+
+def node_text(nodes):
+    """
+    Node text the way get_mind_chart has always built it: nodes joined by </s> <s>, except that an empty first node
+    does not get a separator of its own (so its <s> is shared with the second node).
+    """
+    if len(nodes) == 0:
+        return '<pad>'
+    if nodes[0] == "":
+        nodes = nodes[1:]
+
+    return ' <s> ' + ' </s> <s> '.join(nodes)
+
+
+def build_graphs(triple_lists, max_nodes=100, output="edges"):
+    """
+    Build the mind chart graphs of a batch of compressed triple lists ([[subject, relation, object], ...] each).
+
+    Nodes are numbered by first occurrence in subject, relation, object order. Like the original loop, the first
+    element that would become node max_nodes ends the graph: nodes before it are kept, but the edges of its triple
+    and all later triples are not. Every triple links its elements to themselves, subject <-> relation and
+    relation <-> object.
+
+    output selects the adjacency format:
+        "edges": (offsets, edges), edges of graph i are edges[offsets[i]:offsets[i + 1]] as (row, col), in row major
+                 order (the layout of utils.sparse_adjacency.save_edges)
+        "csr":   (indptr, indices) of the block diagonal batch adjacency, of shape (B * max_nodes, max_nodes)
+        "dense": uint8 array of shape (B, max_nodes, max_nodes)
+    """
+    num_graphs = len(triple_lists)
+    num_triples = np.array([len(triples) for triples in triple_lists], dtype=np.int64)
+    elements = [element for triples in triple_lists for triple in triples for element in triple]
+
+    # element -> (graph, position in graph)
+    graph = np.repeat(np.arange(num_graphs), 3 * num_triples)
+    position = np.arange(len(elements)) - np.repeat(np.cumsum(3 * num_triples) - 3 * num_triples, 3 * num_triples)
+
+    # node ids: rank of the first occurrence of every distinct string within its graph
+    if len(elements) > 0:
+        vocabulary, codes = np.unique(np.array(elements, dtype=str), return_inverse=True)
+    else:
+        vocabulary, codes = np.array([], dtype=str), np.zeros(0, dtype=np.int64)
+    keys = graph * max(len(vocabulary), 1) + codes.reshape(-1)
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind="stable")
+    node_graph = graph[first[order]]
+    nodes_per_graph = np.bincount(node_graph, minlength=num_graphs)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[order] = np.arange(len(first)) - np.repeat(np.cumsum(nodes_per_graph) - nodes_per_graph, nodes_per_graph)
+    node_id = rank[inverse.reshape(-1)]
+
+    # the graph ends at the first element of a node beyond max_nodes, only triples before it get edges
+    cut = 3 * num_triples.copy()
+    truncated = node_id >= max_nodes
+    np.minimum.at(cut, graph[truncated], position[truncated])
+    kept = (position // 3) < np.repeat(cut // 3, 3 * num_triples)
+
+    nodes, texts = [], []
+    first_kept = first[order][rank[order] < max_nodes]
+    graph_starts = np.searchsorted(graph[first_kept], np.arange(num_graphs + 1))
+    for i in range(num_graphs):
+        graph_nodes = [elements[j] for j in first_kept[graph_starts[i]:graph_starts[i + 1]]]
+        nodes.append(graph_nodes)
+        texts.append(node_text(graph_nodes))
+
+    # (subject, relation, object) ids of kept triples, and the 7 edges of each
+    triple_ids = node_id[kept].reshape(-1, 3)
+    triple_graph = graph[kept][::3]
+    s, r, o = triple_ids[:, 0], triple_ids[:, 1], triple_ids[:, 2]
+    rows = np.concatenate([s, r, o, s, r, r, o])
+    cols = np.concatenate([s, r, o, r, s, o, r])
+    flat = np.unique((np.tile(triple_graph, 7) * max_nodes + rows) * max_nodes + cols)
+    edge_graph, edge_rows, edge_cols = flat // (max_nodes * max_nodes), flat // max_nodes % max_nodes, flat % max_nodes
+
+    if output == "edges":
+        offsets = np.searchsorted(edge_graph, np.arange(num_graphs + 1)).astype(np.int64)
+        adjacency = (offsets, np.stack([edge_rows, edge_cols], axis=1))
+    elif output == "csr":
+        indptr = np.searchsorted(flat // max_nodes, np.arange(num_graphs * max_nodes + 1)).astype(np.int64)
+        adjacency = (indptr, edge_cols)
+    elif output == "dense":
+        adjacency = np.zeros((num_graphs, max_nodes, max_nodes), dtype=np.uint8)
+        adjacency[edge_graph, edge_rows, edge_cols] = 1
+    else:
+        raise ValueError(f"Unknown adjacency output {output}, use edges, csr or dense")
+
+    return Graphs(nodes, texts, adjacency)
@@ -0,0 +1,155 @@
+import json
+import os
+import pickle
+from pathlib import Path
+
+from utils.array_store import load_arrays
+from utils.sparse_adjacency import save_edges, stream_edges
+
+SHARD_DIR = "shards"
+# part of the settings of every shard directory: bump when a change to dialogue_to_graph changes its output
+SHARD_VERSION = 1
+
+
+def write_shard(shard_dir, name, dialogues, max_nodes=100):
+    """
+    Write the results of a list of (conversation id, input texts, edge lists, coreference clusters) dialogues as
+    shard name, and return its index entry. Safe to call from worker processes; only GraphShardWriter.record touches
+    the index.
+    """
+    shard_dir = Path(shard_dir)
+    save_edges(shard_dir / f"{name}.bin", [edges for dialogue in dialogues for edges in dialogue[2]], max_nodes)
+    tmp_path = shard_dir / f"{name}.pkl.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({"input_text": [text for dialogue in dialogues for text in dialogue[1]],
+                     "coref_clusters": [clusters for dialogue in dialogues for clusters in dialogue[3]]}, f)
+    os.replace(tmp_path, shard_dir / f"{name}.pkl")
+
+    return {"shard": name,
+            "dialogues": [dialogue[0] for dialogue in dialogues],
+            "utterances": [len(dialogue[1]) for dialogue in dialogues]}
+
+
+class GraphShardWriter:
+    """
+    Append only, resumable output of dialogue_to_graph for one split and language.
+
+    Shards of dialogues are written (e.g. by worker processes) with write_shard, under a name from next_shard_name,
+    as shards/shard_XXXXX.bin (edge lists) and shards/shard_XXXXX.pkl (node text and coreference clusters), and then
+    recorded here: a line listing the dialogues of the shard is appended to shards/index.jsonl, so a shard only counts
+    once both files are complete. A restarted run skips the dialogues in the index, and finalize merges the shards
+    into the files read by ChatDatasetWithGraph.
+    """
+
+    def __init__(self, outpath, settings, max_nodes=100):
+        self.shard_dir = Path(outpath) / SHARD_DIR
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.shard_dir / "index.jsonl"
+        self.max_nodes = max_nodes
+
+        # shards written with other settings, or by a version of dialogue_to_graph with other output, cannot be mixed
+        # with new ones
+        settings = dict(settings, version=SHARD_VERSION)
+        meta_path = self.shard_dir / "meta.json"
+        if meta_path.exists():
+            with open(meta_path, 'r') as f:
+                previous = json.load(f)
+            if previous != settings:
+                raise ValueError(f"{self.shard_dir} was written with {previous}, not {settings}. "
+                                 f"Remove it to start over.")
+        else:
+            with open(meta_path, 'w') as f:
+                json.dump(settings, f)
+
+        self.index = self._read_index()
+        self.done = {conversation_id for entry in self.index for conversation_id in entry["dialogues"]}
+        # shards may be recorded out of order, so number new ones after the highest recorded one
+        self._next_shard = max([int(entry["shard"].split("_")[-1]) + 1 for entry in self.index], default=0)
+
+    def _read_index(self):
+        index = []
+        if not self.index_path.exists():
+            return index
+
+        with open(self.index_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # line cut short by a crash: drop it, so the shard is written again and appended after a clean line
+                    with open(self.index_path, 'w') as rewritten:
+                        rewritten.writelines(json.dumps(entry) + "\n" for entry in index)
+                    break
+                index.append(entry)
+
+        return index
+
+    def next_shard_name(self):
+        # names of shards left over from a crash before their index line was written are simply reused
+        name = f"shard_{self._next_shard:05d}"
+        self._next_shard += 1
+
+        return name
+
+    def record(self, entry):
+        """Add the index entry of a shard that has been written completely."""
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.index.append(entry)
+        self.done.update(entry["dialogues"])
+
+    def _locations(self, conversation_ids):
+        """(shard, first utterance, number of utterances) of every dialogue, in the order of conversation_ids."""
+        found = {}
+        for entry in self.index:
+            start = 0
+            for conversation_id, num_utterances in zip(entry["dialogues"], entry["utterances"]):
+                found[conversation_id] = (entry["shard"], start, num_utterances)
+                start += num_utterances
+
+        missing = [conversation_id for conversation_id in conversation_ids if conversation_id not in found]
+        if len(missing) > 0:
+            raise ValueError(f"{len(missing)} dialogues have not been processed yet, e.g. {missing[:5]}")
+
+        return [found[conversation_id] for conversation_id in conversation_ids]
+
+    def finalize(self, conversation_ids, input_text_path, adj_edges_path, coref_clusters_path):
+        """
+        Merge the shards into mc_input_text.pkl, the edge lists and mc_coref_clusters.json, with the dialogues in the
+        order of conversation_ids. Edge lists and clusters are copied a dialogue at a time; the node text is pickled
+        as a single list, the way ChatDatasetWithGraph reads it.
+        """
+        locations = self._locations(conversation_ids)
+        edge_arrays = {entry["shard"]: load_arrays(self.shard_dir / f"{entry['shard']}.bin")[0]
+                       for entry in self.index}
+
+        def edge_pieces():
+            for shard, start, num_utterances in locations:
+                offsets = edge_arrays[shard]["offsets"][start:start + num_utterances + 1]
+                yield offsets - offsets[0], edge_arrays[shard]["edges"][offsets[0]:offsets[-1]]
+
+        num_edges = sum(int(edge_arrays[shard]["offsets"][start + num_utterances] - edge_arrays[shard]["offsets"][start])
+                        for shard, start, num_utterances in locations)
+        stream_edges(adj_edges_path, edge_pieces(), sum(location[2] for location in locations), num_edges,
+                     self.max_nodes)
+
+        input_text, loaded_name, loaded, separator = [], None, None, ""
+        tmp_path = Path(str(coref_clusters_path) + ".tmp")
+        with open(tmp_path, 'w') as f:
+            f.write("[")
+            for shard, start, num_utterances in locations:
+                if shard != loaded_name:
+                    with open(self.shard_dir / f"{shard}.pkl", 'rb') as shard_file:
+                        loaded_name, loaded = shard, pickle.load(shard_file)
+                input_text.extend(loaded["input_text"][start:start + num_utterances])
+                for clusters in loaded["coref_clusters"][start:start + num_utterances]:
+                    f.write(separator + json.dumps(clusters))
+                    separator = ", "
+            f.write("]")
+        os.replace(tmp_path, coref_clusters_path)
+
+        with open(input_text_path, 'wb') as f:
+            pickle.dump(input_text, f)
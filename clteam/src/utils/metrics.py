@@ -0,0 +1,46 @@
+import numpy as np
+from sacrebleu.metrics import CHRF
+
+
+class StreamingChrf:
+    """
+    Corpus chrF accumulated batch by batch from generated and label token ids, for GraphSeq2SeqTrainer.
+
+    chrF is computed from per segment n-gram match counts that add up over the corpus, so only their running sums are
+    kept, never the predictions. The score is that of sacrebleu's (and evaluate's) default chrF; its whitespace
+    handling makes the sentence splitting of postprocess_text irrelevant, so none is done. gen_len is the mean number
+    of generated tokens (eos included, padding and the decoder start token excluded).
+    """
+
+    def __init__(self, tokenizer, label_pad_token_id=-100):
+        self.tokenizer = tokenizer
+        self.label_pad_token_id = label_pad_token_id
+        self.chrf = CHRF()
+        self.num_stats = 3 * (self.chrf.char_order + self.chrf.word_order)
+        self.reset()
+
+    def reset(self):
+        # chrF statistics, then the number of items and of generated tokens
+        self.totals = np.zeros(self.num_stats + 2, dtype=np.int64)
+
+    def _decode(self, ids):
+        ids = np.where(ids != self.label_pad_token_id, ids, self.tokenizer.pad_token_id)
+        texts = self.tokenizer.batch_decode(ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+
+        return [text.strip() for text in texts]
+
+    def update(self, predictions, labels):
+        predictions, labels = np.asarray(predictions), np.asarray(labels)
+        stats = self.chrf._extract_corpus_statistics(self._decode(predictions), [self._decode(labels)])
+        self.totals[:self.num_stats] += np.sum(stats, axis=0, dtype=np.int64)
+        self.totals[-2] += len(predictions)
+        self.totals[-1] += np.count_nonzero((predictions != self.tokenizer.pad_token_id)
+                                            & (predictions != self.label_pad_token_id))
+
+    def compute(self, totals=None):
+        """Metrics of the accumulated totals (or of totals summed over processes)."""
+        totals = self.totals if totals is None else np.asarray(totals)
+        score = self.chrf._compute_score_from_stats(totals[:self.num_stats].tolist())
+
+        return {"score": round(score.score, 4), "char_order": score.char_order, "word_order": score.word_order,
+                "beta": score.beta, "gen_len": round(float(totals[-1] / max(totals[-2], 1)), 4)}
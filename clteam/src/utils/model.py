@@ -4,33 +4,36 @@ Adapted from https://github.com/huggingface/transformers and https://github.com/
 
 import copy
 import warnings
+from contextlib import nullcontext
 from typing import Optional, Tuple, Union
 
 import torch
 import torch.nn.functional as F
 from torch import nn
 from torch.nn import CrossEntropyLoss
-from torch.nn.utils.rnn import pad_sequence
-from torch.utils.checkpoint import checkpoint
 from transformers import T5Config, T5ForConditionalGeneration
 from transformers.modeling_outputs import (BaseModelOutput, Seq2SeqLMOutput, )
 from transformers.modeling_outputs import BaseModelOutputWithPastAndCrossAttentions
 from transformers.models.t5.modeling_t5 import T5Stack, T5Block, T5LayerNorm
+from transformers.utils import logging
 from transformers.utils.model_parallel_utils import assert_device_map, get_device_map
 
+logger = logging.get_logger(__name__)
+
 
 class GraphAttentionLayer(nn.Module):
     """
     GAT layer, adapt from https://aclanthology.org/2021.naacl-main.109/
     """
 
-    def __init__(self, in_features, out_features, dropout, alpha, concat=True):
+    def __init__(self, in_features, out_features, dropout, alpha, concat=True, memory_efficient=False):
         super(GraphAttentionLayer, self).__init__()
         self.dropout = dropout
         self.in_features = in_features
         self.out_features = out_features
         self.alpha = alpha
         self.concat = concat
+        self.memory_efficient = memory_efficient
         self.W = nn.Parameter(torch.empty(size=(in_features, out_features)))
 
         nn.init.xavier_uniform_(self.W.data, gain=1.414)
@@ -40,13 +43,20 @@ class GraphAttentionLayer(nn.Module):
         self.leakyrelu = nn.LeakyReLU(self.alpha)
         self.layer_norm = torch.nn.LayerNorm(out_features, 1e-5, elementwise_affine=True)
 
-    def forward(self, h, adj):
+    def forward(self, h, adj, node_mask=None):
 
         Wh = torch.matmul(h, self.W)  # b,N, N_out_features
-        a_input = self._prepare_attentional_mechanism_input(Wh)
-        e = self.leakyrelu(torch.matmul(a_input, self.a).squeeze(3))  # B, N , N
-        zero_vec = -9e15 * torch.ones_like(e)
-        attention = torch.where(adj > 0, e, zero_vec)
+        if self.memory_efficient:
+            e = self.leakyrelu(self._attention_scores(Wh))  # B, N , N
+            attention = e.masked_fill(adj <= 0, -9e15)
+        else:
+            a_input = self._prepare_attentional_mechanism_input(Wh)
+            e = self.leakyrelu(torch.matmul(a_input, self.a).squeeze(3))  # B, N , N
+            zero_vec = -9e15 * torch.ones_like(e)
+            attention = torch.where(adj > 0, e, zero_vec)
+        if node_mask is not None:
+            # padded nodes get no attention at all, not even from the nodes without edges (which attend to every node)
+            attention = attention.masked_fill(~node_mask.unsqueeze(1), torch.finfo(attention.dtype).min)
         attention = F.softmax(attention, dim=2)  # B, N, N
         attention = F.dropout(attention, self.dropout, training=self.training)
         h_prime = torch.matmul(attention, Wh)
@@ -68,40 +78,52 @@ class GraphAttentionLayer(nn.Module):
 
         return all_combinations_matrix.view(B, N, N, 2 * self.out_features)
 
+    def _attention_scores(self, Wh):
+        # a^T [Wh_i || Wh_j] = a_1^T Wh_i + a_2^T Wh_j, so the B x N x N x 2F pair tensor is never built
+        Wh1 = torch.matmul(Wh, self.a[:self.out_features, :])  # B, N, 1
+        Wh2 = torch.matmul(Wh, self.a[self.out_features:, :])  # B, N, 1
+
+        return Wh1 + Wh2.transpose(1, 2)
+
     def __repr__(self):
         return self.__class__.__name__ + ' (' + str(self.in_features) + ' -> ' + str(self.out_features) + ')'
 
 
 class GAT(nn.Module):
-    def __init__(self, nfeat, nhid, dropout=0.2, alpha=0.02, nheads=2):
+    def __init__(self, nfeat, nhid, dropout=0.2, alpha=0.02, nheads=2, memory_efficient=False):
         """Dense version of GAT."""
         super(GAT, self).__init__()
         self.dropout = dropout
 
         self.attentions = nn.ModuleList(
-            [GraphAttentionLayer(nfeat, nhid, dropout=dropout, alpha=alpha, concat=True) for _ in range(nheads)])
+            [GraphAttentionLayer(nfeat, nhid, dropout=dropout, alpha=alpha, concat=True,
+                                 memory_efficient=memory_efficient) for _ in range(nheads)])
 
-        self.out_att = GraphAttentionLayer(nhid * nheads, nhid, dropout=dropout, alpha=alpha, concat=False)
+        self.out_att = GraphAttentionLayer(nhid * nheads, nhid, dropout=dropout, alpha=alpha, concat=False,
+                                           memory_efficient=memory_efficient)
 
         self.fc = nn.Linear(nhid, nhid)
         self.layer_norm = torch.nn.LayerNorm(nhid, 1e-5, elementwise_affine=True)
 
-    def forward(self, x, adj):
+    def forward(self, x, adj, node_mask=None):
+        """x: (B, N, nfeat) node states, adj: (B, N, N), node_mask: optional (B, N), True for real nodes."""
         res = x
         x = F.dropout(x, self.dropout, training=self.training)
-        x = torch.cat([att(x, adj) for att in self.attentions], dim=-1)
+        x = torch.cat([att(x, adj, node_mask) for att in self.attentions], dim=-1)
 
         x = F.dropout(x, self.dropout, training=self.training)
-        x = F.gelu(self.out_att(x, adj))
+        x = F.gelu(self.out_att(x, adj, node_mask))
         x = self.fc(x)
         x = x + res
         x = self.layer_norm(x)
+        if node_mask is not None:
+            x = x.masked_fill(~node_mask.unsqueeze(-1), 0)
 
         return x
 
 
 class JointEncoderWithGraph(T5Stack):
-    def __init__(self, config, s_token_id, embed_tokens=None):
+    def __init__(self, config, s_token_id, embed_tokens=None, memory_efficient_gat=False, mask_padded_nodes=False):
         super().__init__(config)
 
         self.embed_tokens = embed_tokens
@@ -109,8 +131,12 @@ class JointEncoderWithGraph(T5Stack):
 
         self.mha_layer_got = torch.nn.MultiheadAttention(embed_dim=config.hidden_size, kdim=config.hidden_size,
                                                          vdim=config.hidden_size, num_heads=1, batch_first=True)  ##
-        self.got_encoder = GAT(nfeat=config.d_model, nhid=config.d_model, nheads=1)  ##
+        self.got_encoder = GAT(nfeat=config.d_model, nhid=config.d_model, nheads=1,
+                               memory_efficient=memory_efficient_gat)  ##
         self.s_token_id = s_token_id
+        self.mask_padded_nodes = mask_padded_nodes
+        self.node_store = None
+        self.profiler = None
         self.gate_dense = nn.Linear(2 * config.hidden_size, config.hidden_size)
         self.sigmoid = nn.Sigmoid()
 
@@ -299,14 +325,8 @@ class JointEncoderWithGraph(T5Stack):
                     )
                     use_cache = False
 
-                def create_custom_forward(module):
-                    def custom_forward(*inputs):
-                        return tuple(module(*inputs, use_cache, output_attentions))
-
-                    return custom_forward
-
-                layer_outputs = checkpoint(
-                    create_custom_forward(layer_module),
+                layer_outputs = self._gradient_checkpointing_func(
+                    layer_module.forward,
                     hidden_states,
                     extended_attention_mask,
                     position_bias,
@@ -316,6 +336,8 @@ class JointEncoderWithGraph(T5Stack):
                     layer_head_mask,
                     cross_attn_layer_head_mask,
                     None,  # past_key_value is always None with gradient checkpointing
+                    use_cache,
+                    output_attentions,
                 )
             else:
                 layer_outputs = layer_module(
@@ -369,6 +391,47 @@ class JointEncoderWithGraph(T5Stack):
 
         return hidden_states, present_key_value_states, all_hidden_states, all_attentions, all_cross_attentions
 
+    def gather_nodes(self, node_representations, got_input_ids, max_nodes):
+        """
+        Collect the hidden states at the <s> positions of the node text for the whole batch.
+
+        Returns the nodes (batch, max_nodes, embed_dim), zero padded, and a boolean mask (batch, max_nodes) that is
+        True for real nodes. Nodes beyond max_nodes are dropped.
+        """
+        # padding by max_nodes positions gives at least max_nodes slots without comparing sizes, which a traced or
+        # exported graph would freeze
+        segs = F.pad(got_input_ids.eq(self.s_token_id).long(), (0, max_nodes))  # (batch, src_len + max_nodes)
+        node_representations = F.pad(node_representations, (0, 0, 0, max_nodes))
+
+        # <s> positions get decreasing keys, so the top max_nodes keys are the first max_nodes nodes in order
+        descending = torch.arange(segs.shape[1], 0, -1, device=segs.device)
+        positions = torch.topk(segs * descending, max_nodes, dim=1)[1]
+        batch_index = torch.arange(segs.shape[0], device=segs.device).unsqueeze(-1)
+        nodes = node_representations[batch_index, positions]
+
+        slots = torch.arange(max_nodes, device=segs.device)
+        node_mask = slots.unsqueeze(0) < segs.sum(dim=1, keepdim=True)
+        nodes = nodes.masked_fill(~node_mask.unsqueeze(-1), 0)
+
+        return nodes, node_mask
+
+    def _stage(self, name):
+        # opt-in timers and memory counters (utils.profiling.StageProfiler), a no-op context otherwise
+        if self.profiler is None:
+            return nullcontext()
+
+        return self.profiler.stage(name, self.final_layer_norm.weight.device)
+
+    def fuse(self, hidden_states, graph_outputs, nodes_padding_mask):
+        """Attend from the text states to the GAT outputs and mix the result in through the gate."""
+        got_att, _ = self.mha_layer_got(hidden_states, graph_outputs, graph_outputs,
+                                        key_padding_mask=nodes_padding_mask)
+
+        merge = torch.cat([hidden_states, got_att], dim=-1)
+        gate = self.sigmoid(self.gate_dense(merge))
+
+        return (1 - gate) * hidden_states + gate * got_att
+
     def forward(
             self,
             input_ids=None,
@@ -388,78 +451,77 @@ class JointEncoderWithGraph(T5Stack):
             output_hidden_states=None,
             return_dict=None,
     ):
+        # at inference the node states can come from a precomputed NodeEmbeddingStore
+        use_node_store = self.node_store is not None and not self.training
 
-        hidden_states, present_key_value_states, \
-        all_hidden_states, all_attentions, \
-        all_cross_attentions = self.forward_text(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            encoder_hidden_states=encoder_hidden_states,
-            encoder_attention_mask=encoder_attention_mask,
-            inputs_embeds=inputs_embeds,
-            head_mask=head_mask,
-            cross_attn_head_mask=cross_attn_head_mask,
-            past_key_values=past_key_values,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
+        with self._stage("text_encode"):
+            hidden_states, present_key_value_states, \
+            all_hidden_states, all_attentions, \
+            all_cross_attentions = self.forward_text(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=encoder_attention_mask,
+                inputs_embeds=inputs_embeds,
+                head_mask=head_mask,
+                cross_attn_head_mask=cross_attn_head_mask,
+                past_key_values=past_key_values,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+            )
 
         ##Add GoT###################
-        node_representations, _, _, _, _ = self.forward_text(
-            input_ids=got_input_ids,
-            attention_mask=got_mask,
-            encoder_hidden_states=encoder_hidden_states,
-            encoder_attention_mask=encoder_attention_mask,
-            head_mask=head_mask,
-            cross_attn_head_mask=cross_attn_head_mask,
-            past_key_values=past_key_values,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
+        if not use_node_store:
+            with self._stage("node_encode"):
+                node_representations, _, _, _, _ = self.forward_text(
+                    input_ids=got_input_ids,
+                    attention_mask=got_mask,
+                    encoder_hidden_states=encoder_hidden_states,
+                    encoder_attention_mask=encoder_attention_mask,
+                    head_mask=head_mask,
+                    cross_attn_head_mask=cross_attn_head_mask,
+                    past_key_values=past_key_values,
+                    use_cache=use_cache,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    return_dict=return_dict,
+                )
         # node_representations = action_outputs[0]#(batch,src_len, embed_dim)
-        # print("node_representations",node_representations.shape)
-
-        nodes = [
-            torch.tensor(torch.zeros([got_adj_matrix.shape[1], node_representations.shape[-1]]), requires_grad=True).to(
-                node_representations.device)]  # (max_node_num,embed_dim)
-
-        for i in range(0, got_input_ids.shape[0]):  # [batch_size, sequence_length]
-            # print("actions*********",got_input_ids[i])
-
-            segs = got_input_ids[i].eq(self.s_token_id)
-            # print(segs)
-            nodes.append(node_representations[i][segs])
-            # print("nodes",nodes)
-
-        nodes = pad_sequence(nodes)
-
-        nodes = nodes[:, 1:, :]
-
-        nodes_padding_mask = nodes.sum(-1) == 0  # ignore the padding nodes
-        # N * B * hid
-        nodes = nodes.transpose(1, 0)
-        # print("nodes!!!!",nodes.shape,nodes)
-
-        # print("nodes_padding_mask",nodes_padding_mask.shape,nodes_padding_mask)
-        nodes_padding_mask = nodes_padding_mask.transpose(1, 0).type(torch.float)
-        # print("nodes_padding_mask_after",nodes_padding_mask.shape,nodes_padding_mask)
+        with self._stage("node_gather"):
+            if use_node_store:
+                nodes, node_mask = self.node_store.get_nodes(self, got_input_ids, got_mask, got_adj_matrix.shape[1])
+            else:
+                nodes, node_mask = self.gather_nodes(node_representations, got_input_ids, got_adj_matrix.shape[1])
+        # B * N * hid
+        if self.mask_padded_nodes:
+            # padded nodes take no part in the GAT or the fusion, so the outputs do not depend on how far the graphs
+            # of a batch are padded; items without nodes attend to their (zero) padding rather than to nothing
+            gat_node_mask = node_mask
+            nodes_padding_mask = ~(node_mask | ~node_mask.any(dim=1, keepdim=True))
+        else:
+            # padding nodes are flagged with 1 (as an additive mask, like the earlier checkpoints were trained with)
+            gat_node_mask = None
+            nodes_padding_mask = (~node_mask).type(torch.float)
 
         if self.final_layer_norm.weight.dtype in [torch.float16, torch.bfloat16]:
             nodes = nodes.to(self.final_layer_norm.weight.dtype)
-            nodes_padding_mask = nodes_padding_mask.to(self.final_layer_norm.weight.dtype)
-        graph_outputs = self.got_encoder(nodes, got_adj_matrix)
-
-        ###########################################################
-        got_att, _ = self.mha_layer_got(hidden_states, graph_outputs, graph_outputs,
-                                        key_padding_mask=nodes_padding_mask)
-
-        merge = torch.cat([hidden_states, got_att], dim=-1)
-        gate = self.sigmoid(self.gate_dense(merge))
-        hidden_states = (1 - gate) * hidden_states + gate * got_att
+            if nodes_padding_mask.is_floating_point():
+                nodes_padding_mask = nodes_padding_mask.to(self.final_layer_norm.weight.dtype)
+        if self.gradient_checkpointing and self.training:
+            # the GAT (with its N x N x 2d pair tensor) and the fusion are recomputed in the backward pass as well
+            with self._stage("gat"):
+                graph_outputs = self._gradient_checkpointing_func(self.got_encoder.__call__, nodes, got_adj_matrix,
+                                                                  gat_node_mask)
+            with self._stage("fusion"):
+                hidden_states = self._gradient_checkpointing_func(self.fuse, hidden_states, graph_outputs,
+                                                                  nodes_padding_mask)
+        else:
+            with self._stage("gat"):
+                graph_outputs = self.got_encoder(nodes, got_adj_matrix, gat_node_mask)
+            with self._stage("fusion"):
+                hidden_states = self.fuse(hidden_states, graph_outputs, nodes_padding_mask)
 
         if not return_dict:
             return tuple(
@@ -492,17 +554,22 @@ class T5GenerationWithGraph(T5ForConditionalGeneration):
         r"decoder.block.0.layer.1.EncDecAttention.relative_attention_bias.weight",
     ]
 
-    def __init__(self, config: T5Config, s_token_id):
+    def __init__(self, config: T5Config, s_token_id, memory_efficient_gat=False, mask_padded_nodes=False):
         super().__init__(config)
         self.model_dim = config.d_model
 
         self.shared = nn.Embedding(config.vocab_size, config.d_model)
 
+        # unlike the other options, masking changes the outputs: it is saved with the checkpoint and stays on for it
+        config.mask_padded_nodes = mask_padded_nodes or getattr(config, "mask_padded_nodes", False)
+
         encoder_config = copy.deepcopy(config)
         encoder_config.is_decoder = False
         encoder_config.use_cache = False
         encoder_config.is_encoder_decoder = False
-        self.encoder = JointEncoderWithGraph(encoder_config, s_token_id, self.shared)
+        self.encoder = JointEncoderWithGraph(encoder_config, s_token_id, self.shared,
+                                             memory_efficient_gat=memory_efficient_gat,
+                                             mask_padded_nodes=config.mask_padded_nodes)
 
         decoder_config = copy.deepcopy(config)
         decoder_config.is_decoder = True
@@ -554,7 +621,7 @@ class T5GenerationWithGraph(T5ForConditionalGeneration):
         # assert False
         # assert got_input_ids is not None
 
-        if got_input_ids is None:
+        if got_input_ids is None and encoder_outputs is None:
             print("!!!got_input_ids", got_input_ids)
 
         # FutureWarning: head_mask was separated into two input args - head_mask, decoder_head_mask
@@ -660,43 +727,90 @@ class T5GenerationWithGraph(T5ForConditionalGeneration):
         )
 
     def prepare_inputs_for_generation(
-            self, decoder_input_ids, past=None, attention_mask=None, use_cache=None, encoder_outputs=None, **kwargs
+            self, decoder_input_ids, past_key_values=None, attention_mask=None, use_cache=None, encoder_outputs=None,
+            **kwargs
     ):
         # cut decoder_input_ids if past is used
-        if past is not None:
+        if past_key_values is not None:
             decoder_input_ids = decoder_input_ids[:, -1:]
 
         output = {
             "input_ids": None,  # encoder_outputs is defined. input_ids not needed
             "encoder_outputs": encoder_outputs,
-            "past_key_values": past,
+            "past_key_values": past_key_values,
             "decoder_input_ids": decoder_input_ids,
             "attention_mask": attention_mask,
             "use_cache": use_cache,  # change this to avoid caching (presumably for debugging)
         }
 
-        if "image_ids" in kwargs:
-            output["image_ids"] = kwargs['image_ids']
-        if "got_adj_matrix" in kwargs:
-            output["got_adj_matrix"] = kwargs['got_adj_matrix']
-        if "got_input_ids" in kwargs:
-            output["got_input_ids"] = kwargs['got_input_ids']
-        if "got_mask" in kwargs:
-            output["got_mask"] = kwargs['got_mask']
+        # generate runs the encoder (text and graph) once before decoding, the graph is only needed without it
+        if encoder_outputs is None:
+            for name in ["got_adj_matrix", "got_input_ids", "got_mask"]:
+                if name in kwargs:
+                    output[name] = kwargs[name]
 
         return output
 
+    @torch.no_grad()
+    def translate(self, tokenizer, items, batch_size=8, sort_by_length=True, **generate_kwargs):
+        """
+        Translate dialogue turns given as items of ChatDatasetWithGraph (with or without padding).
+
+        Items are sorted by length (unless sort_by_length is False) and padded per batch with GraphDataCollator, the
+        text and graph encoder runs once per batch and generate decodes with the KV cache. Returns the translations
+        in the order of items.
+        """
+        from utils.dataset import GraphDataCollator
+
+        collator = GraphDataCollator(tokenizer, self.encoder.s_token_id)
+        items = [self._strip_padding(item) for item in items]
+        order = list(range(len(items)))
+        if sort_by_length:
+            order.sort(key=lambda i: len(items[i]["input_ids"]) + len(items[i]["got_input_ids"]))
+
+        translations = [None] * len(items)
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            batch = {name: value.to(self.device) for name, value in collator([items[i] for i in indices]).items()}
+            encoder_outputs = self.get_encoder()(
+                input_ids=batch["input_ids"],
+                attention_mask=batch["attention_mask"],
+                got_adj_matrix=batch["got_adj_matrix"],
+                got_input_ids=batch["got_input_ids"],
+                got_mask=batch["got_mask"],
+                return_dict=True,
+            )
+            output = self.generate(encoder_outputs=encoder_outputs, attention_mask=batch["attention_mask"],
+                                   **generate_kwargs)
+            for i, text in zip(indices, tokenizer.batch_decode(output, skip_special_tokens=True)):
+                translations[i] = text.strip()
+
+        return translations
+
+    @staticmethod
+    def _strip_padding(item):
+        stripped = {}
+        for ids, mask in [("input_ids", "attention_mask"), ("got_input_ids", "got_mask")]:
+            keep = torch.as_tensor(item[mask]).bool()
+            stripped[ids] = torch.as_tensor(item[ids])[keep]
+            stripped[mask] = torch.ones_like(stripped[ids])
+        for name in ["got_adj_edges", "got_adj_matrix"]:
+            if name in item:
+                stripped[name] = item[name]
+
+        return stripped
+
     def test_step(self, tokenizer, batch, **kwargs):
         device = next(self.parameters()).device
         input_ids = batch['input_ids'].to(device)
-        image_ids = batch['image_ids'].to(device)
+        attention_mask = batch['attention_mask'].to(device)
         got_adj_matrix = batch['got_adj_matrix'].to(device)
         got_input_ids = batch['got_input_ids'].to(device)
         got_mask = batch['got_mask'].to(device)
 
         output = self.generate(
             input_ids=input_ids,
-            image_ids=image_ids,
+            attention_mask=attention_mask,
             got_adj_matrix=got_adj_matrix,
             got_input_ids=got_input_ids,
             got_mask=got_mask,
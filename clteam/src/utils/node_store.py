@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import torch
+
+STORE_VERSION = 1
+WEIGHT_FILES = ["pytorch_model.bin", "model.safetensors", "pytorch_model.bin.index.json",
+                "model.safetensors.index.json"]
+
+
+def checkpoint_fingerprint(checkpoint):
+    """Identify a checkpoint by its config and the name, size and modification time of its weight files."""
+    checkpoint_dir = Path(checkpoint)
+    if not checkpoint_dir.is_dir():
+        # hub model id, only the name is known
+        return hashlib.sha256(str(checkpoint).encode()).hexdigest()
+
+    digest = hashlib.sha256()
+    config_path = checkpoint_dir / "config.json"
+    if config_path.exists():
+        digest.update(config_path.read_bytes())
+    for path in sorted(checkpoint_dir.iterdir()):
+        if path.name in WEIGHT_FILES or path.name.startswith(("pytorch_model-", "model-")):
+            stat = path.stat()
+            digest.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+
+    return digest.hexdigest()
+
+
+class NodeEmbeddingStore:
+    """
+    Memory-mapped store of the node embeddings gathered by JointEncoderWithGraph, for inference only.
+
+    Node states are contextual (all nodes of an utterance are encoded as one node text), so entries are keyed by a
+    hash of the whole node text (its non padded token ids) and hold the states of all its nodes. The store records
+    the checkpoint that built it and is emptied when it is opened with a different checkpoint.
+
+    Layout of store_dir:
+        meta.json       checkpoint, fingerprint, hidden size (and whether the model was quantised)
+        index.jsonl     one {"key", "offset", "count"} line per node text, append only
+        embeddings.bin  float32 rows of size hidden_size, append only
+    """
+
+    def __init__(self, store_dir, checkpoint, hidden_size, quantized=False):
+        self.store_dir = Path(store_dir)
+        self.hidden_size = hidden_size
+        self.meta = {"version": STORE_VERSION,
+                     "checkpoint": str(checkpoint),
+                     "fingerprint": checkpoint_fingerprint(checkpoint),
+                     "hidden_size": hidden_size}
+        if quantized:
+            # the node states of a dynamically quantised model differ slightly from those of the checkpoint
+            self.meta["quantized"] = True
+
+        self.meta_path = self.store_dir / "meta.json"
+        self.index_path = self.store_dir / "index.jsonl"
+        self.embeddings_path = self.store_dir / "embeddings.bin"
+
+        if self.meta_path.exists():
+            with open(self.meta_path, 'r') as f:
+                stored_meta = json.load(f)
+            if stored_meta != self.meta:
+                print(f"[NodeEmbeddingStore]: {self.store_dir} was built by {stored_meta.get('checkpoint')}, "
+                      f"rebuilding for {checkpoint}")
+                shutil.rmtree(self.store_dir)
+
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.meta_path, 'w') as f:
+            json.dump(self.meta, f, indent=2)
+
+        self.index = {}
+        self.num_rows = 0
+        self._load_index()
+        self._embeddings = None
+
+        self.hits, self.misses = 0, 0
+        print(f"[NodeEmbeddingStore]: {len(self.index)} node texts in {self.store_dir}")
+
+    def _load_index(self):
+        """
+        Read the index and make embeddings.bin agree with it. Rows are made durable before their index line, so a run
+        that stopped in between leaves rows that no entry points to: they are cut off, else rows added later would be
+        recorded at the wrong offset. Entries whose rows are missing, or a last line cut short, are dropped too.
+        """
+        row_bytes = self.hidden_size * np.dtype(np.float32).itemsize
+        file_rows = self.embeddings_path.stat().st_size // row_bytes if self.embeddings_path.exists() else 0
+        lines, entries = 0, []
+        if self.index_path.exists():
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    if entry["offset"] + entry["count"] <= file_rows:
+                        entries.append(entry)
+
+        for entry in entries:
+            self.index[entry["key"]] = (entry["offset"], entry["count"])
+            self.num_rows = max(self.num_rows, entry["offset"] + entry["count"])
+        if len(entries) < lines:
+            with open(self.index_path, 'w') as f:
+                f.writelines(json.dumps(entry) + "\n" for entry in entries)
+        if self.embeddings_path.exists() and self.embeddings_path.stat().st_size != self.num_rows * row_bytes:
+            print(f"[NodeEmbeddingStore]: dropping {file_rows - self.num_rows} embedding rows without an index entry")
+            with open(self.embeddings_path, 'r+b') as f:
+                f.truncate(self.num_rows * row_bytes)
+
+    def __len__(self):
+        return len(self.index)
+
+    @staticmethod
+    def make_key(input_ids, mask):
+        ids = np.asarray(input_ids, dtype=np.int32)[np.asarray(mask) > 0]
+        return hashlib.sha1(ids.tobytes()).hexdigest()
+
+    def _rows(self, offset, count):
+        if self._embeddings is None or offset + count > self._embeddings.shape[0]:
+            self._embeddings = np.memmap(self.embeddings_path, dtype=np.float32, mode='r',
+                                         shape=(self.num_rows, self.hidden_size))
+        return self._embeddings[offset:offset + count]
+
+    def _add(self, entries):
+        # the rows reach the disk before the index lines that point to them, see _load_index
+        lines, num_rows = [], self.num_rows
+        with open(self.embeddings_path, 'ab') as f:
+            for key, nodes in entries:
+                nodes = np.ascontiguousarray(nodes, dtype=np.float32)
+                f.write(nodes.tobytes())
+                lines.append({"key": key, "offset": num_rows, "count": nodes.shape[0]})
+                num_rows += nodes.shape[0]
+            f.flush()
+            os.fsync(f.fileno())
+
+        with open(self.index_path, 'a') as f:
+            f.writelines(json.dumps(line) + "\n" for line in lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+        for line in lines:
+            self.index[line["key"]] = (line["offset"], line["count"])
+        self.num_rows = num_rows
+
+    @torch.no_grad()
+    def get_nodes(self, encoder, got_input_ids, got_mask, max_nodes):
+        """
+        Same output as encoder.gather_nodes on the encoded node text, (batch, max_nodes, hidden) nodes and their
+        boolean mask. Node texts that are not in the store yet are encoded with the encoder and added.
+        """
+        if got_mask is None:
+            got_mask = torch.ones_like(got_input_ids)
+        ids_cpu, mask_cpu = got_input_ids.cpu().numpy(), got_mask.cpu().numpy()
+        keys = [self.make_key(ids, mask) for ids, mask in zip(ids_cpu, mask_cpu)]
+
+        missing = {}
+        for i, key in enumerate(keys):
+            if key not in self.index and key not in missing:
+                missing[key] = i
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+
+        if missing:
+            rows = torch.tensor(list(missing.values()), device=got_input_ids.device)
+            node_representations, _, _, _, _ = encoder.forward_text(input_ids=got_input_ids[rows],
+                                                                    attention_mask=got_mask[rows])
+            nodes, node_mask = encoder.gather_nodes(node_representations, got_input_ids[rows], max_nodes)
+            counts = node_mask.sum(dim=1).tolist()
+            nodes = nodes.float().cpu().numpy()
+            self._add([(key, nodes[j, :counts[j]]) for j, key in enumerate(missing)])
+
+        nodes = np.zeros((len(keys), max_nodes, self.hidden_size), dtype=np.float32)
+        counts = []
+        for i, key in enumerate(keys):
+            offset, count = self.index[key]
+            count = min(count, max_nodes)
+            nodes[i, :count] = self._rows(offset, count)
+            counts.append(count)
+
+        nodes = torch.from_numpy(nodes).to(got_input_ids.device)
+        node_mask = torch.arange(max_nodes).unsqueeze(0) < torch.tensor(counts).unsqueeze(1)
+
+        return nodes, node_mask.to(got_input_ids.device)
@@ -0,0 +1,104 @@
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+from transformers import TrainerCallback
+
+
+class StageProfiler:
+    """
+    Named wall clock timers and memory counters for the stages of JointEncoderWithGraph.forward, opt-in through
+    encoder.profiler. With synchronize, CUDA work is waited for at both ends of a stage, so that its time is not
+    booked to whichever stage happens to wait next. On CUDA every stage also records the memory it leaves allocated
+    (the activations it keeps for the backward pass) and its peak above what was allocated when it started.
+    """
+
+    def __init__(self, synchronize=True):
+        self.synchronize = synchronize
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.allocated = defaultdict(int)
+        self.peak = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name, device):
+        cuda = device.type == "cuda"
+        if cuda:
+            if self.synchronize:
+                torch.cuda.synchronize(device)
+            allocated = torch.cuda.memory_allocated(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if cuda and self.synchronize:
+                torch.cuda.synchronize(device)
+            self.seconds[name] += time.perf_counter() - start
+            if cuda:
+                self.allocated[name] += torch.cuda.memory_allocated(device) - allocated
+                self.peak[name] = max(self.peak[name], torch.cuda.max_memory_allocated(device) - allocated)
+
+    def summary(self, steps=1):
+        """Milliseconds (and MB on CUDA) of every stage per step, since the last reset."""
+        steps = max(steps, 1)
+        summary = {}
+        for name in self.seconds:
+            summary[f"stage/{name}_ms"] = round(1000 * self.seconds[name] / steps, 3)
+            if name in self.allocated:
+                summary[f"stage/{name}_allocated_mb"] = round(self.allocated[name] / steps / 2 ** 20, 3)
+                summary[f"stage/{name}_peak_mb"] = round(self.peak[name] / 2 ** 20, 3)
+
+        return summary
+
+
+class StageTimingCallback(TrainerCallback):
+    """
+    Aggregate the stage timings of a StageProfiler over the training steps of every logging interval, next to the
+    time of the whole step, and add them to the trainer logs and to a JSON file (a list of one entry per log, in the
+    output directory by default). Timings of evaluation passes are discarded.
+    """
+
+    def __init__(self, profiler, output_path=None):
+        self.profiler = profiler
+        self.output_path = output_path
+        self.entries = []
+        self.steps = 0
+        self.step_seconds = 0.0
+        self._step_start = None
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self._step_start = time.perf_counter()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self._step_start is not None:
+            self.step_seconds += time.perf_counter() - self._step_start
+            self.steps += 1
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self.profiler.reset()
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs is None or "loss" not in logs or self.steps == 0:
+            return
+        timings = self.profiler.summary(self.steps)
+        timings["stage/step_ms"] = round(1000 * self.step_seconds / self.steps, 3)
+        logs.update(timings)
+        if len(state.log_history) > 0 and state.log_history[-1].get("step") == state.global_step:
+            state.log_history[-1].update(timings)
+
+        if state.is_world_process_zero:
+            self.entries.append({"step": state.global_step, "steps": self.steps, **timings})
+            output_path = self.output_path or os.path.join(args.output_dir, "stage_timings.json")
+            os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+            with open(output_path, 'w') as f:
+                json.dump(self.entries, f, indent=2)
+
+        self.profiler.reset()
+        self.steps = 0
+        self.step_seconds = 0.0
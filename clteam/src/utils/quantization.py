@@ -0,0 +1,69 @@
+import copy
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+class LinearMultiheadAttention(nn.Module):
+    """
+    nn.MultiheadAttention (batch_first, without bias_k/bias_v or zero attention) with its packed input projection split
+    into three nn.Linear, so that dynamic quantisation, which only swaps nn.Linear modules, reaches all four
+    projections. Inference only: attention dropout is not applied and no attention weights are returned.
+    """
+
+    def __init__(self, attention):
+        super().__init__()
+        if not attention.batch_first or attention.bias_k is not None or attention.add_zero_attn:
+            raise ValueError("Only batch_first attention without bias_k/bias_v or add_zero_attn can be converted")
+        self.num_heads = attention.num_heads
+        self.head_dim = attention.head_dim
+        embed_dim = attention.embed_dim
+        if attention._qkv_same_embed_dim:
+            weights = attention.in_proj_weight.chunk(3)
+        else:
+            weights = [attention.q_proj_weight, attention.k_proj_weight, attention.v_proj_weight]
+        biases = attention.in_proj_bias.chunk(3) if attention.in_proj_bias is not None else [None] * 3
+
+        self.q_proj, self.k_proj, self.v_proj = [self._linear(weight, bias) for weight, bias in zip(weights, biases)]
+        self.out_proj = self._linear(attention.out_proj.weight, attention.out_proj.bias)
+        assert self.q_proj.out_features == embed_dim
+
+    @staticmethod
+    def _linear(weight, bias):
+        linear = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None)
+        linear.weight = nn.Parameter(weight.detach().clone())
+        if bias is not None:
+            linear.bias = nn.Parameter(bias.detach().clone())
+
+        return linear
+
+    def _heads(self, x):
+        return x.view(x.shape[0], x.shape[1], self.num_heads, self.head_dim).transpose(1, 2)
+
+    def forward(self, query, key, value, key_padding_mask=None):
+        q, k, v = self._heads(self.q_proj(query)), self._heads(self.k_proj(key)), self._heads(self.v_proj(value))
+        attn_mask = None
+        if key_padding_mask is not None:
+            # like nn.MultiheadAttention: boolean masks exclude keys, float masks are added to the scores
+            if key_padding_mask.dtype == torch.bool:
+                key_padding_mask = torch.zeros_like(key_padding_mask, dtype=q.dtype).masked_fill(key_padding_mask,
+                                                                                                float("-inf"))
+            attn_mask = key_padding_mask.to(q.dtype)[:, None, None, :]
+        output = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+        output = output.transpose(1, 2).reshape(query.shape[0], query.shape[1], -1)
+
+        return self.out_proj(output), None
+
+
+def quantize_model(model, dtype=torch.qint8):
+    """
+    A dynamically quantised copy of a T5GenerationWithGraph for CPU inference: the weights of every nn.Linear (the T5
+    attention and feed forward projections, lm_head, GAT.fc, gate_dense and the projections of mha_layer_got) are
+    stored as int8 and activations are quantised on the fly. Embeddings, layer norms and the GAT attention weights
+    stay in float32. The model passed in is not changed.
+    """
+    model = copy.deepcopy(model).float().eval()
+    model.encoder.mha_layer_got = LinearMultiheadAttention(model.encoder.mha_layer_got)
+    # lm_head shares its weight with the embeddings when they are tied, quantising it gives it its own int8 copy
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=dtype)
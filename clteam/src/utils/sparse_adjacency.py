@@ -0,0 +1,94 @@
+import numpy as np
+import torch
+
+from utils.array_store import load_arrays, open_arrays, save_arrays
+
+ADJ_EDGES_FILE = "mc_adj_edges.bin"
+
+
+def index_dtype(max_nodes):
+    return np.uint8 if max_nodes <= np.iinfo(np.uint8).max + 1 else np.uint16
+
+
+def dense_to_edges(matrix):
+    """(num_edges, 2) array with the (row, col) of every non zero entry, in row major order."""
+    return np.argwhere(np.asarray(matrix) != 0)
+
+
+def edges_to_dense(edges, num_nodes, dtype=torch.double):
+    """
+    Adjacency matrix of num_nodes x num_nodes, edges to nodes beyond num_nodes are dropped. The default dtype matches
+    the np.zeros matrices that dialogue_to_graph used to pickle.
+    """
+    edges = torch.as_tensor(np.asarray(edges, dtype=np.int64))
+    edges = edges[(edges < num_nodes).all(dim=1)]
+    matrix = torch.zeros(num_nodes, num_nodes, dtype=dtype)
+    matrix[edges[:, 0], edges[:, 1]] = 1
+
+    return matrix
+
+
+def save_edges(path, edge_lists, max_nodes):
+    """
+    Store the edge lists of all utterances as one CSR-like structure: edges of utterance i are
+    edges[offsets[i]:offsets[i + 1]], as (row, col) node indices.
+    """
+    offsets = np.zeros(len(edge_lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(edges) for edges in edge_lists])
+    edges = np.zeros((offsets[-1], 2), dtype=index_dtype(max_nodes))
+    for i, utterance_edges in enumerate(edge_lists):
+        edges[offsets[i]:offsets[i + 1]] = utterance_edges
+
+    save_arrays(path, {"offsets": offsets, "edges": edges}, meta={"max_nodes": max_nodes})
+
+
+def stream_edges(path, pieces, num_utterances, num_edges, max_nodes):
+    """
+    Same output as save_edges, but from an iterable of (offsets, edges) pieces in the save_edges layout (offsets
+    starting at 0), copied one at a time so memory stays flat. The totals are needed up front to size the file.
+    """
+    specs = {"offsets": (np.int64, (num_utterances + 1,)), "edges": (index_dtype(max_nodes), (num_edges, 2))}
+    with open_arrays(path, specs, meta={"max_nodes": max_nodes}) as out:
+        out["offsets"][0] = 0
+        utterance, edge = 0, 0
+        for offsets, edges in pieces:
+            out["offsets"][utterance + 1:utterance + len(offsets)] = offsets[1:] + edge
+            out["edges"][edge:edge + len(edges)] = edges
+            utterance, edge = utterance + len(offsets) - 1, edge + len(edges)
+
+        if (utterance, edge) != (num_utterances, num_edges):
+            raise ValueError(f"Expected {num_utterances} utterances and {num_edges} edges, got {utterance} and {edge}")
+
+
+class SparseAdjacency:
+    """
+    Read only, memory mapped view of a file written by save_edges.
+
+    Indexing returns the (num_edges, 2) edge array of one utterance; dense matrices are only built on demand with
+    edges_to_dense (per item or per batch).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._arrays = None
+        _, meta = load_arrays(path)
+        self.max_nodes = meta["max_nodes"]
+
+    def __getstate__(self):
+        return {"path": self.path, "_arrays": None, "max_nodes": self.max_nodes}
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays, _ = load_arrays(self.path)
+        return self._arrays
+
+    def __len__(self):
+        return len(self.arrays["offsets"]) - 1
+
+    def __getitem__(self, index):
+        offsets = self.arrays["offsets"]
+        return self.arrays["edges"][offsets[index]:offsets[index + 1]]
+
+    def dense(self, index, dtype=torch.double):
+        return edges_to_dense(self[index], self.max_nodes, dtype=dtype)
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+from functools import partial
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+
+from utils.alignment import ALIGNMENT_VERSION
+from utils.array_store import load_arrays, save_arrays
+from utils.sparse_adjacency import index_dtype
+
+CACHE_VERSION = 2
+FIELDS = ["source", "target", "nodes"]
+
+
+def tokenizer_signature(tokenizer):
+    return {"name": tokenizer.name_or_path,
+            "class": tokenizer.__class__.__name__,
+            "vocab_size": len(tokenizer),
+            "special_tokens": tokenizer.all_special_tokens}
+
+
+def file_signature(path):
+    """Size and modification time of a file: cheap to get however large it is, and changed by any rewrite."""
+    stat = os.stat(path)
+    return [str(path), stat.st_size, stat.st_mtime_ns]
+
+
+def token_cache_path(args, split, tokenizer, dry_run=False, sources=()):
+    """Cache file for a split, keyed on everything that changes its content, including the files it is built from."""
+    key = {"version": CACHE_VERSION,
+           # which graph an utterance gets depends on how match_utterances aligns the raw and prompted dialogues
+           "alignment": ALIGNMENT_VERSION,
+           "tokenizer": tokenizer_signature(tokenizer),
+           "input_len": args.input_len,
+           "output_len": args.output_len,
+           "language": args.language,
+           "exclude_context": args.exclude_context,
+           "full_history": args.full_history,
+           "split": split,
+           "dry_run": dry_run,
+           "data_root": str(args.data_root),
+           "sources": [file_signature(path) for path in sources]}
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+    return Path(args.cache_dir) / "tokens" / f"{split}_{args.language}_{digest}.bin"
+
+
+def _encode(tokenizer, max_length, texts):
+    return tokenizer(texts, max_length=max_length, truncation=True)["input_ids"]
+
+
+def tokenize_texts(tokenizer, texts, max_length, num_proc=1):
+    """Token ids (no padding) of every text, batch encoded and split over num_proc processes."""
+    if num_proc <= 1 or len(texts) < num_proc:
+        return _encode(tokenizer, max_length, texts)
+
+    chunk_size = (len(texts) + num_proc - 1) // num_proc
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    with get_context("spawn").Pool(num_proc) as pool:
+        encoded = pool.map(partial(_encode, tokenizer, max_length), chunks)
+
+    return [ids for chunk in encoded for ids in chunk]
+
+
+def to_flat_arrays(sequences):
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(seq) for seq in sequences])
+    ids = np.fromiter((token for seq in sequences for token in seq), dtype=np.int32, count=offsets[-1])
+
+    return ids, offsets
+
+
+def build_token_cache(path, tokenizer, source_text, target_text, node_text, source_len, summ_len, num_proc=1,
+                      edge_lists=None, max_nodes=None):
+    """
+    Tokenise a whole split once and store it as int32 ids with int64 offsets per field. With edge_lists (the (row, col)
+    edges of the graph of every item), the graphs are stored in the same file in the layout of save_edges, so a
+    dataset can be served from this file alone.
+    """
+    texts = {"source": [" ".join(str(text).split()) for text in source_text],
+             "target": [" ".join(str(text).split()) for text in target_text],
+             "nodes": list(node_text)}
+    max_lengths = {"source": source_len, "target": summ_len, "nodes": source_len}
+
+    arrays = {}
+    for field in FIELDS:
+        ids, offsets = to_flat_arrays(tokenize_texts(tokenizer, texts[field], max_lengths[field], num_proc))
+        arrays[f"{field}_ids"] = ids
+        arrays[f"{field}_offsets"] = offsets
+    meta = {"tokenizer": tokenizer_signature(tokenizer), "num_items": len(source_text)}
+    if edge_lists is not None:
+        arrays["adj_offsets"] = np.zeros(len(edge_lists) + 1, dtype=np.int64)
+        arrays["adj_offsets"][1:] = np.cumsum([len(edges) for edges in edge_lists])
+        arrays["adj_edges"] = np.zeros((arrays["adj_offsets"][-1], 2), dtype=index_dtype(max_nodes))
+        for i, edges in enumerate(edge_lists):
+            arrays["adj_edges"][arrays["adj_offsets"][i]:arrays["adj_offsets"][i + 1]] = edges
+        meta["max_nodes"] = max_nodes
+    save_arrays(path, arrays, meta=meta)
+    print(f"[Data]: Token cache written to {path}")
+
+
+class TokenCache:
+    """
+    Read only view of a token cache; the memory maps are opened lazily in every (worker) process, so a pickled cache
+    (e.g. sent to DataLoader workers) is only its path and nothing of the split is held in memory.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._arrays = None
+        self._meta = None
+
+    def __getstate__(self):
+        return {"path": self.path, "_arrays": None, "_meta": None}
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays, self._meta = load_arrays(self.path)
+        return self._arrays
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            self._arrays, self._meta = load_arrays(self.path)
+        return self._meta
+
+    @property
+    def has_graphs(self):
+        return "adj_edges" in self.arrays
+
+    @property
+    def max_nodes(self):
+        return self.meta.get("max_nodes")
+
+    def __len__(self):
+        return len(self.arrays["source_offsets"]) - 1
+
+    def get(self, field, index):
+        offsets = self.arrays[f"{field}_offsets"]
+        return self.arrays[f"{field}_ids"][offsets[index]:offsets[index + 1]]
+
+    def edges(self, index):
+        """(num_edges, 2) edges of the graph of an item, see utils.sparse_adjacency.save_edges."""
+        offsets = self.arrays["adj_offsets"]
+        return self.arrays["adj_edges"][offsets[index]:offsets[index + 1]]
+
+    def lengths(self, field):
+        return np.diff(self.arrays[f"{field}_offsets"])
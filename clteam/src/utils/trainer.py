@@ -0,0 +1,76 @@
+import torch
+from transformers import Seq2SeqTrainer
+from transformers.trainer_pt_utils import LengthGroupedSampler, find_batch_size
+from transformers.trainer_utils import EvalLoopOutput
+
+from utils.profiling import StageTimingCallback
+
+
+class GraphSeq2SeqTrainer(Seq2SeqTrainer):
+    """
+    Seq2SeqTrainer for ChatDatasetWithGraph.
+
+    With a streaming_metric (e.g. utils.metrics.StreamingChrf), evaluate() generates batch by batch and only updates
+    the metric with each batch, instead of gathering every padded prediction for compute_metrics; predict() still
+    returns all predictions. With a stage_profiler (utils.profiling.StageProfiler), the encoder stages are timed and
+    their per step timings logged at every logging step.
+    """
+
+    def __init__(self, *args, streaming_metric=None, stage_profiler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.streaming_metric = streaming_metric
+        self._streaming_evaluation = False
+        if stage_profiler is not None:
+            self.model.encoder.profiler = stage_profiler
+            # before the reporting integrations, so that the timings it adds to the logs reach them
+            self.callback_handler.callbacks.insert(0, StageTimingCallback(stage_profiler))
+
+    def _get_train_sampler(self):
+        # group_by_length with the lengths precomputed by the dataset, instead of encoding every item to measure it
+        if self.args.group_by_length and getattr(self.train_dataset, "lengths", None) is not None:
+            return LengthGroupedSampler(self.args.train_batch_size * self.args.gradient_accumulation_steps,
+                                        lengths=self.train_dataset.lengths)
+
+        return super()._get_train_sampler()
+
+    def evaluate(self, *args, **kwargs):
+        self._streaming_evaluation = self.streaming_metric is not None and self.args.predict_with_generate
+        try:
+            return super().evaluate(*args, **kwargs)
+        finally:
+            self._streaming_evaluation = False
+
+    def evaluation_loop(self, dataloader, description, prediction_loss_only=None, ignore_keys=None,
+                        metric_key_prefix="eval"):
+        if not self._streaming_evaluation:
+            return super().evaluation_loop(dataloader, description, prediction_loss_only=prediction_loss_only,
+                                           ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix)
+
+        model = self._wrap_model(self.model, training=False, dataloader=dataloader)
+        if len(self.accelerator._models) == 0 and model is self.model:
+            model = self.accelerator.prepare_model(model, evaluation_mode=True)
+        model.eval()
+        self.callback_handler.eval_dataloader = dataloader
+
+        self.streaming_metric.reset()
+        loss_totals = torch.zeros(2, dtype=torch.float64, device=self.args.device)  # summed loss, items
+        for inputs in dataloader:
+            loss, generated_tokens, labels = self.prediction_step(model, inputs, prediction_loss_only=False,
+                                                                  ignore_keys=ignore_keys)
+            if loss is not None:
+                batch_size = find_batch_size(inputs)
+                loss_totals[0] += loss.detach().double() * batch_size
+                loss_totals[1] += batch_size
+            self.streaming_metric.update(generated_tokens.cpu().numpy(), labels.cpu().numpy())
+            self.control = self.callback_handler.on_prediction_step(self.args, self.state, self.control)
+
+        # the statistics add up over processes
+        totals = torch.as_tensor(self.streaming_metric.totals, device=self.args.device)
+        totals = self.accelerator.reduce(totals, reduction="sum").cpu().numpy()
+        metrics = self.streaming_metric.compute(totals)
+        loss_totals = self.accelerator.reduce(loss_totals, reduction="sum")
+        if loss_totals[1] > 0:
+            metrics["loss"] = (loss_totals[0] / loss_totals[1]).item()
+        metrics = {f"{metric_key_prefix}_{name}": value for name, value in metrics.items()}
+
+        return EvalLoopOutput(predictions=None, label_ids=None, metrics=metrics, num_samples=int(totals[-2]))
@@ -32,8 +32,16 @@ def load_all_data(args, split):
     return data_per_language
 
 
+def raw_data_path(args, split, dry_run=False):
+    return Path(args.raw_data_root) / ("mini-valid" if dry_run else f"{split}") / f"{args.language}.csv"
+
+
+def triple_data_path(args, split, dry_run=False):
+    return Path(args.triple_data_root) / ("mini-valid" if dry_run else f"{split}") / f"{args.language}.json"
+
+
 def load_language_data(args, split):
-    datapath = Path(args.raw_data_root) / f"{split}" / f"{args.language}.csv"  # / "mc_coref_clusters.json"
+    datapath = raw_data_path(args, split)  # / "mc_coref_clusters.json"
     dialogues = pd.read_csv(datapath).to_dict('records')
     dialogues = [list(v) for k, v in groupby(dialogues, key=lambda x: x['doc_id'])]
 
@@ -56,11 +64,7 @@ def load_raw_data(args, split, dry_run=False):
 def load_triple_data(args, split, dry_run=False):
     print(f"[Data]: Reading data after prompting...")
 
-    if dry_run:
-        datapath = Path(args.triple_data_root) / "mini-valid" / f"{args.language}.json"
-    else:
-        datapath = Path(args.triple_data_root) / f"{split}" / f"{args.language}.json"
-
+    datapath = triple_data_path(args, split, dry_run=dry_run)
     with open(datapath, 'r', encoding='utf-8') as file:
         problems = json.load(file)
 
@@ -1,152 +1,144 @@
-from typing import Tuple
+from bisect import bisect_left
 
 import nltk
-import pandas as pd
-from fuzzywuzzy import fuzz
 
+from utils.alignment import MATCHED, UNMATCHED, load_or_align, triples_text
 
-def texts_approximately_equal(text1: str, text2: str, threshold: int = 95, look_ahead: str = "") -> Tuple[bool, bool]:
-    # Single utterance, fuzzy matching
-    if fuzz.ratio(text1, text2) >= threshold:
-        return True, False
 
-    # Try two utterances
-    elif fuzz.ratio(text1 + look_ahead, text2) >= threshold:
-        return True, True
+def match_utterances(raw_dialogues, tripled_dialogues, input_txt, input_matrix, cache_path=None):
+    """
+    Attach to every raw utterance the graph (input_txt, input_matrix) of the utterance after prompting it is aligned
+    to (see utils.alignment.align_dialogue), reading the alignment from cache_path when it was computed before.
+    Graphs are indexed by the position of the utterance after prompting over all dialogues. Like before, the reference
+    of an utterance matched by comparison becomes the translated triples it is matched to, when they exist.
+    """
+    indices, kinds = load_or_align(raw_dialogues, tripled_dialogues, cache_path=cache_path)
 
-    return False, False
+    super_idx, utt_idx = 0, 0
+    fixed_og = []
+    for og, post_prompt in zip(raw_dialogues, tripled_dialogues):
+        for og_utt in og:
+            index, kind = int(indices[utt_idx]), int(kinds[utt_idx])
+            utt_idx += 1
+            og_utt["matched"] = False
+            if kind == UNMATCHED:
+                continue
+            if super_idx + index >= len(input_txt):
+                print(f"No graph for utterance {index} of dialogue {og_utt['doc_id']}")
+                continue
+
+            prompted_utt = post_prompt["dialogue"][index]
+            og_utt["matched"] = True
+            og_utt["input_txt"] = input_txt[super_idx + index]
+            og_utt["input_matrix"] = input_matrix[super_idx + index]
+            og_utt["post_prompt"] = prompted_utt["text"]
+            if kind == MATCHED and triples_text(prompted_utt) is not None:
+                og_utt["reference"] = triples_text(prompted_utt)
+
+        super_idx += len(post_prompt["dialogue"])
+        fixed_og.append(og)
 
+    return fixed_og
 
-def clean_text_for_comparison(og_utt, potential_triples):
-    # Check which is the text we need to clean
-    if og_utt["source_language"] == "en":
-        text_to_compare = og_utt["source"]
-    else:
-        if "reference" in og_utt.keys():
-            text_to_compare = og_utt["reference"]
-        else:
-            text_to_compare = [trip["translated_triple"].replace("_", " ") for trip in potential_triples["triples"]]
-            text_to_compare = " ".join(text_to_compare)
 
-    # Clean
-    if text_to_compare.startswith("NAME-M_TEXT:"):
-        text_to_compare = text_to_compare[12:]
+def history_line(utt):
+    """Line of an utterance in the dialogue history, None when it has no text in English or the reference."""
+    if utt["source_language"] == "en":
+        return f'{utt["sender"]}: {utt["source"]}'
+    if "reference" in utt.keys():
+        return f'{utt["sender"]}: {utt["reference"]}'
 
-    return text_to_compare
+    return None
 
 
-def match_utterances(raw_dialogues, tripled_dialogues, input_txt, input_matrix):
-    super_idx = 0
-    fixed_og = []
-    for og, post_prompt in zip(raw_dialogues, tripled_dialogues):
-        # Initialize 'matched' key for all utterances
-        for og_utt in og:
-            og_utt["matched"] = False  # Default to False
-
-        # This dialogue is the right length, leave it alone
-        if len(og) == len(post_prompt["dialogue"]):
-            for i, og_utt in enumerate(og):
-                og_utt["matched"] = True
-                og_utt["input_txt"] = input_txt[super_idx]
-                og_utt["input_matrix"] = input_matrix[super_idx]
-                og_utt["post_prompt"] = post_prompt["dialogue"][i]["text"]
-                super_idx += 1
-
-        # These lengths do not match, try to match
-        else:
-            skipped, count_doubles = 0, 0
-            double_match = False
-            for i, og_utt in enumerate(og):
-                try:
-                    if double_match:
-                        # This was already a match
-                        count_doubles += 1
-                        og_utt["matched"] = True
-                        og_utt["input_txt"] = input_txt[super_idx - 1]
-                        og_utt["input_matrix"] = input_matrix[super_idx - 1]
-                        og_utt["post_prompt"] = post_prompt["dialogue"][i - count_doubles - skipped]["text"]
-                        double_match = False
-                    else:
-                        # Prepare texts to compare
-                        current_prompted_utt = post_prompt["dialogue"][i - count_doubles - skipped]
-                        text_to_compare = clean_text_for_comparison(og_utt, current_prompted_utt)
-                        next_text = ""
-                        if (i + 1) < len(og):
-                            next_text = clean_text_for_comparison(og[i + 1],
-                                                                  post_prompt["dialogue"][
-                                                                      i + 1 - count_doubles - skipped])
-
-                        # Compare
-                        this_match, double_match = texts_approximately_equal(text_to_compare,
-                                                                             current_prompted_utt["text"],
-                                                                             look_ahead=next_text)
-
-                        # Assign accordingly
-                        if this_match:
-                            # This is a match
-                            og_utt["matched"] = True
-                            og_utt["input_txt"] = input_txt[super_idx]
-                            og_utt["input_matrix"] = input_matrix[super_idx]
-                            og_utt["reference"] = " ".join([trip["translated_triple"].replace("_", " ")
-                                                            for trip in current_prompted_utt["triples"]])
-                            og_utt["post_prompt"] = post_prompt["dialogue"][i - count_doubles - skipped]["text"]
-                            super_idx += 1
-                        else:
-                            # Move index by 1
-                            og_utt["matched"] = False
-                            og_utt["post_prompt"] = post_prompt["dialogue"][i - count_doubles - skipped]["text"]
-                            skipped += 1
-
-                except KeyError as e:
-                    print(f"KeyError: {e}")
-                except Exception as e:
-                    print(f"Unhandled exception: {e}")
-                    continue
-        temp = pd.DataFrame.from_dict(og)
-        fixed_og.append(og)
+def build_prompt(to_translate, history=None):
+    if history is None:
+        return f"Source segment:\n{to_translate}\n\n" \
+               f"Translation:\n"
 
-    return fixed_og
+    dialogue_history = "\n".join(history)
+
+    return f"Dialogue History:\n{dialogue_history}\n\n" \
+           f"Source segment:\n{to_translate}\n\n" \
+           f"Translation:\n"
+
+
+def count_tokens(tokenizer, texts, add_special_tokens=False):
+    """Tokens of every text, cleaned the way ChatDatasetWithGraph cleans its source text."""
+    if len(texts) == 0:
+        return []
+    encoded = tokenizer([" ".join(str(text).split()) for text in texts], add_special_tokens=add_special_tokens)
 
+    return [len(ids) for ids in encoded["input_ids"]]
 
-def build_train_pair(og, exclude_context=False):
+
+def build_train_pair(og, exclude_context=False, tokenizer=None, max_length=None):
+    """
+    Prompt, target, node text and adjacency of every matched utterance of a dialogue.
+
+    The dialogue history is extended one utterance at a time. Without a tokenizer it holds every earlier utterance,
+    so long prompts lose their "Source segment" and "Translation:" tail when they are truncated to max_length. With a
+    tokenizer and max_length the history only keeps the most recent utterances that fit in the tokens left after
+    the source segment, counted with the tokenizer: the source segment is always kept (if it does not fit on its own
+    it is truncated, with an empty history).
+    """
     all_inputs, all_targets, all_separator, all_matrix = [], [], [], []
-    for i in range(len(og)):
-        current_dialogue = og[:i + 1]
-        if current_dialogue[-1].get("matched", False):  # Check if 'matched' key exists and is True
+    budgeted = tokenizer is not None and max_length is not None and not exclude_context
+
+    lines = [history_line(utt) for utt in og]
+    history = []  # lines of the utterances before the current one
+    history_tokens = [0]  # history_tokens[k]: tokens of history[:k]
+    if budgeted:
+        line_tokens = iter(count_tokens(tokenizer, [line for line in lines if line is not None]))
+        fixed_tokens = count_tokens(tokenizer, [build_prompt(utt["source"], []) for utt in og],
+                                    add_special_tokens=True)
+    near_limit = []
+
+    for i, utt in enumerate(og):
+        if utt.get("matched", False):  # Check if 'matched' key exists and is True
             # Format text to translate
-            to_translate = current_dialogue[-1]["source"]
-            if "reference" in current_dialogue[-1].keys():
-                target_translation = current_dialogue[-1]["reference"]
+            to_translate = utt["source"]
+            if "reference" in utt.keys():
+                target_translation = utt["reference"]
             else:
                 target_translation = ""
 
             # Create the prompt input
             if exclude_context:
-                prompt_input = f"Source segment:\n{to_translate}\n\n" \
-                               f"Translation:\n"
+                prompt_input = build_prompt(to_translate)
+            elif budgeted:
+                # most recent lines whose tokens fit next to the source segment
+                budget = history_tokens[-1] - (max_length - fixed_tokens[i])
+                first = bisect_left(history_tokens, budget)
+                estimate = fixed_tokens[i] + history_tokens[-1] - history_tokens[min(first, len(history))]
+                if estimate + len(history) - first > max_length:
+                    near_limit.append((len(all_inputs), i, first, len(history)))
+                prompt_input = build_prompt(to_translate, history[first:])
             else:
-                # Build dialogue history
-                dialogue_history = []
-                for utt in current_dialogue[:-1]:
-                    if utt["source_language"] == "en":
-                        dialogue_history.append(f'{utt["sender"]}: {utt["source"]}')
-                    else:
-                        if "reference" in utt.keys():
-                            dialogue_history.append(f'{utt["sender"]}: {utt["reference"]}')
-
-                dialogue_history = "\n".join(dialogue_history)
-
-                prompt_input = f"Dialogue History:\n{dialogue_history}\n\n" \
-                               f"Source segment:\n{to_translate}\n\n" \
-                               f"Translation:\n"
+                prompt_input = build_prompt(to_translate, history)
 
             all_inputs.append(prompt_input)
             all_targets.append(target_translation)
-            all_separator.append(current_dialogue[-1]["input_txt"])
-            all_matrix.append(current_dialogue[-1]["input_matrix"])
+            all_separator.append(utt["input_txt"])
+            all_matrix.append(utt["input_matrix"])
         else:
             print(f"No match found for dialogue at index {i}.")  # Log unmatched dialogues for debugging
 
+        if lines[i] is not None:
+            history.append(lines[i])
+            if budgeted:
+                history_tokens.append(history_tokens[-1] + next(line_tokens))
+
+    # lines tokenised one by one are exact for sentencepiece, but other tokenizers can take up to about a token more
+    # per line once they are joined: check the prompts that could be over the limit, dropping older lines if they are
+    if len(near_limit) > 0:
+        lengths = count_tokens(tokenizer, [all_inputs[item] for item, _, _, _ in near_limit], add_special_tokens=True)
+        for (item, i, first, num_history), length in zip(near_limit, lengths):
+            while length > max_length and first < num_history:
+                first += 1
+                all_inputs[item] = build_prompt(og[i]["source"], history[first:num_history])
+                length = count_tokens(tokenizer, [all_inputs[item]], add_special_tokens=True)[0]
+
     return all_inputs, all_targets, all_separator, all_matrix
 
 